@@ -0,0 +1,162 @@
+# SPDX-FileCopyrightText: 2022 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Measures the throughput of the bridge capability lookups and of ImageWorker.can_generate()
+
+The lookups are compared against how they were done before the reference tables were precompiled.
+can_generate() is then timed for synthetic workers with various bridge agents against synthetic WPs,
+which are deleted again at the end. Run it against a throwaway postgres only, using the usual POSTGRES_* env vars.
+Importing the horde parses the arguments of the server, so it needs the same ones:
+    BENCHMARK_WPS=500 python benchmark_bridge_reference.py --horde stable
+"""
+
+import os
+import time
+from datetime import datetime
+
+import semver
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from horde.bridge_reference import BRIDGE_CAPABILITIES, check_bridge_capability, check_sampler_capability
+from horde.classes.base.user import User
+from horde.classes.base.worker import WorkerModel, WorkerTemplate
+from horde.classes.stable.waiting_prompt import ImageWaitingPrompt
+from horde.classes.stable.worker import ImageWorker
+from horde.flask import HORDE, db
+from horde.logger import logger
+from horde.utils import hash_api_key
+
+WP_COUNT = int(os.getenv("BENCHMARK_WPS", 500))
+LOOKUP_COUNT = int(os.getenv("BENCHMARK_LOOKUPS", 100000))
+NAME_PREFIX = "benchmark_bridge_reference"
+BRIDGE_AGENTS = [
+    "AI Horde Worker reGen:9.0.0:https://github.com/Haidra-Org/horde-worker-reGen",
+    "AI Horde Worker reGen:4.1.0:https://github.com/Haidra-Org/horde-worker-reGen",
+    "AI Horde Worker:24:https://github.com/db0/AI-Horde-Worker",
+    "AI Horde Worker:11:https://github.com/db0/AI-Horde-Worker",
+    "unknown:0:unknown",
+]
+CAPABILITIES = ["img2img", "inpainting", "post-processing", "GFPGAN", "tiling", "controlnet", "hires_fix", "lora", "flux"]
+WP_PARAMS = [
+    {"sampler_name": "k_euler_a", "karras": True},
+    {"sampler_name": "k_dpmpp_2m", "karras": False, "post_processing": ["GFPGAN", "RealESRGAN_x4plus"]},
+    {"sampler_name": "k_euler", "karras": True, "hires_fix": True},
+    {"sampler_name": "lcm", "karras": False, "tiling": True},
+    {"sampler_name": "k_dpmpp_sde", "karras": True, "clip_skip": 2, "post_processing": ["CodeFormers"]},
+]
+
+
+def check_uncompiled(capability, bridge_agent):
+    """How the capabilities were looked up before the reference tables were precompiled"""
+    try:
+        bridge_name, bridge_version, _ = bridge_agent.split(":", 2)
+        bridge_version = semver.Version.parse(bridge_version, True)
+    except Exception:
+        bridge_name = "unknown"
+        bridge_version = semver.Version.parse("0", True)
+    if bridge_name not in BRIDGE_CAPABILITIES:
+        return False
+    total_capabilities = set()
+    for version in BRIDGE_CAPABILITIES[bridge_name]:
+        checked_semver = semver.Version.parse(str(version), True)
+        if checked_semver.compare(bridge_version) <= 0:
+            total_capabilities.update(BRIDGE_CAPABILITIES[bridge_name][version])
+    return capability in total_capabilities
+
+
+def check_compiled(capability, bridge_agent):
+    return check_bridge_capability(capability, bridge_agent)
+
+
+def time_lookups(checker):
+    start = time.perf_counter()
+    for iter in range(LOOKUP_COUNT):
+        checker(CAPABILITIES[iter % len(CAPABILITIES)], BRIDGE_AGENTS[iter % len(BRIDGE_AGENTS)])
+    return time.perf_counter() - start
+
+
+def create_synthetic_data():
+    user = User(
+        username=NAME_PREFIX,
+        oauth_id=NAME_PREFIX,
+        api_key=hash_api_key(NAME_PREFIX),
+        trusted=True,
+    )
+    db.session.add(user)
+    db.session.flush()
+    workers = [
+        ImageWorker(
+            user_id=user.id,
+            name=f"{NAME_PREFIX}_{iter}",
+            last_check_in=datetime.utcnow(),
+            bridge_agent=bridge_agent,
+            max_pixels=1024 * 1024,
+            allow_img2img=True,
+            allow_painting=True,
+            allow_post_processing=True,
+        )
+        for iter, bridge_agent in enumerate(BRIDGE_AGENTS)
+    ]
+    db.session.add_all(workers)
+    db.session.flush()
+    db.session.add_all([WorkerModel(worker_id=worker.id, model="stable_diffusion") for worker in workers])
+    db.session.commit()
+    wps = []
+    for iter in range(WP_COUNT):
+        params = {"width": 512, "height": 512, "steps": 30, "n": 1}
+        params.update(WP_PARAMS[iter % len(WP_PARAMS)])
+        wps.append(
+            ImageWaitingPrompt(
+                worker_ids=[],
+                models=["stable_diffusion"],
+                prompt=f"{NAME_PREFIX} {iter}",
+                user_id=user.id,
+                params=params,
+                nsfw=False,
+                censor_nsfw=False,
+                trusted_workers=False,
+                safe_ip=True,
+                r2=True,
+                shared=False,
+                client_agent=NAME_PREFIX,
+            ),
+        )
+    db.session.commit()
+    return workers, wps
+
+
+def delete_synthetic_data(wps):
+    for wp in wps:
+        db.session.delete(wp)
+    db.session.query(WorkerTemplate).filter(WorkerTemplate.name.like(f"{NAME_PREFIX}_%")).delete(synchronize_session=False)
+    db.session.query(User).filter(User.oauth_id == NAME_PREFIX).delete(synchronize_session=False)
+    db.session.commit()
+
+
+if __name__ == "__main__":
+    for checker in [check_uncompiled, check_compiled]:
+        elapsed = time_lookups(checker)
+        logger.message(f"{checker.__name__}(): {elapsed:.2f}s for {LOOKUP_COUNT} lookups ({elapsed / LOOKUP_COUNT * 1000000:.2f}us each)")
+    start = time.perf_counter()
+    for iter in range(LOOKUP_COUNT):
+        check_sampler_capability(WP_PARAMS[iter % len(WP_PARAMS)]["sampler_name"], BRIDGE_AGENTS[iter % len(BRIDGE_AGENTS)])
+    elapsed = time.perf_counter() - start
+    logger.message(f"check_sampler_capability(): {elapsed:.2f}s for {LOOKUP_COUNT} lookups ({elapsed / LOOKUP_COUNT * 1000000:.2f}us each)")
+    with HORDE.app_context():
+        workers, wps = create_synthetic_data()
+        try:
+            for worker in workers:
+                # The first pass loads the relationships, so we only time the second one
+                for wp in wps:
+                    worker.can_generate(wp)
+                start = time.perf_counter()
+                generated = sum(1 for wp in wps if worker.can_generate(wp)[0])
+                elapsed = time.perf_counter() - start
+                logger.message(
+                    f"can_generate() for '{worker.bridge_agent}': {len(wps) / elapsed:.0f} WPs/s ({generated}/{len(wps)} possible)",
+                )
+        finally:
+            delete_synthetic_data(wps)
@@ -0,0 +1,83 @@
+# SPDX-FileCopyrightText: 2022 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Compares scanning prompts with the full filter regex against the prefiltered ones the PromptChecker uses
+
+It uses the filters the horde currently has cached, so run it with the env of a node with redis.
+The corpus is read from BENCHMARK_PROMPTS_FILE, one prompt per line. Without it, it generates prompts
+of the max length we accept with the replacement filter. Importing the horde parses the arguments of the server,
+so it needs the same ones:
+    BENCHMARK_PROMPTS_FILE=prompts.txt python benchmark_prompt_checker.py --horde stable
+"""
+
+import os
+import random
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import emoji
+import regex as re
+
+from horde.detection import prompt_checker
+from horde.logger import logger
+
+PROMPT_COUNT = int(os.getenv("BENCHMARK_PROMPTS", 1000))
+PROMPT_WORDS = (
+    "masterpiece, best quality, (detailed:1.2) portrait of a woman in a red dress, cinematic lighting, 8k, "
+    "trending on artstation, by greg rutkowski, a castle on a hill at sunset, fantasy landscape, volumetric fog, "
+    "highly detailed, sharp focus, octane render, ((bokeh)), 🌅 🏰 concept art, studio ghibli style"
+).split()
+
+
+def load_corpus():
+    prompts_file = os.getenv("BENCHMARK_PROMPTS_FILE")
+    if prompts_file:
+        with open(prompts_file) as corpus:
+            return [line.strip() for line in corpus if line.strip()]
+    prompts = []
+    for _ in range(PROMPT_COUNT):
+        prompt = ""
+        while len(prompt) < 7000:
+            prompt += random.choice(PROMPT_WORDS) + " "
+        prompts.append(prompt[:7000])
+    return prompts
+
+
+def check_unfiltered(prompts, compiled):
+    """How the prompts were checked before the prefilter"""
+    for prompt in prompts:
+        norm_prompt = prompt_checker.normalize_prompt.__wrapped__(prompt)
+        for filter_id in ["filter_10", "filter_11", "filter_20"]:
+            emoji.emoji_list(prompt)
+            if compiled[filter_id]:
+                compiled[filter_id].search(norm_prompt)
+
+
+def check_prefiltered(prompts, compiled):
+    for prompt in prompts:
+        prompt_checker(prompt)
+
+
+if __name__ == "__main__":
+    prompts = load_corpus()
+    compiled = {
+        filter_id: re.compile(regex_string, re.IGNORECASE) if regex_string else None
+        for filter_id, regex_string in prompt_checker.regex.items()
+    }
+    for filter_id, prefiltered in prompt_checker.compiled.items():
+        if prefiltered is None:
+            continue
+        literal_count = len(prefiltered.literals.named_lists["literals"]) if prefiltered.literals else 0
+        logger.message(
+            f"{filter_id}: {literal_count} prefilter literals. "
+            f"Always running: {prefiltered.residual.pattern if prefiltered.residual else None}",
+        )
+    for checker in [check_unfiltered, check_prefiltered]:
+        start = time.perf_counter()
+        checker(prompts, compiled)
+        elapsed = time.perf_counter() - start
+        logger.message(f"{checker.__name__}(): {elapsed:.2f}s for {len(prompts)} prompts ({elapsed / len(prompts) * 1000:.2f}ms each)")
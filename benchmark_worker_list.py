@@ -0,0 +1,105 @@
+# SPDX-FileCopyrightText: 2022 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Compares serializing the workers list through the ORM against serialize_active_workers()
+
+Creates synthetic active workers of every type, times both serializers, checks that they produce the same workers list
+and then deletes the workers again. Run it against a throwaway postgres only, using the usual POSTGRES_* env vars.
+Importing the horde parses the arguments of the server, so it needs the same ones:
+    BENCHMARK_WORKERS=5000 python benchmark_worker_list.py --horde stable
+"""
+
+import json
+import os
+import time
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from horde.classes.base.user import User
+from horde.classes.base.worker import WorkerModel, WorkerTemplate
+from horde.classes.kobold.worker import TextWorker
+from horde.classes.stable.interrogation_worker import InterrogationWorker
+from horde.classes.stable.worker import ImageWorker
+from horde.database.functions import get_active_workers, serialize_active_workers
+from horde.flask import HORDE, db
+from horde.horde_redis import datetime_json_converter
+from horde.logger import logger
+from horde.utils import hash_api_key
+
+WORKER_COUNT = int(os.getenv("BENCHMARK_WORKERS", 5000))
+WORKERS_PER_USER = 5
+NAME_PREFIX = "benchmark_worker_list"
+
+
+def create_synthetic_workers():
+    users = [
+        User(
+            username=f"{NAME_PREFIX}_{iter}",
+            oauth_id=f"{NAME_PREFIX}_{iter}",
+            api_key=hash_api_key(f"{NAME_PREFIX}_{iter}"),
+            public_workers=iter % 2 == 0,
+        )
+        for iter in range(WORKER_COUNT // WORKERS_PER_USER + 1)
+    ]
+    db.session.add_all(users)
+    db.session.flush()
+    workers = []
+    for iter in range(WORKER_COUNT):
+        worker_class = [TextWorker, InterrogationWorker, ImageWorker, ImageWorker][iter % 4]
+        workers.append(
+            worker_class(
+                user_id=users[iter // WORKERS_PER_USER].id,
+                name=f"{NAME_PREFIX}_{iter}",
+                last_check_in=datetime.utcnow(),
+                bridge_agent="AI Horde Worker reGen:9.0.0:https://github.com/Haidra-Org/horde-worker-reGen",
+                cached_speed=[1500000.0, 0.0, None][iter % 3],
+            ),
+        )
+    db.session.add_all(workers)
+    db.session.flush()
+    db.session.add_all(
+        [WorkerModel(worker_id=w.id, model=f"model_{iter}") for w in workers if w.wtype != "interrogation" for iter in range(3)],
+    )
+    db.session.commit()
+
+
+def delete_synthetic_workers():
+    db.session.query(WorkerTemplate).filter(WorkerTemplate.name.like(f"{NAME_PREFIX}_%")).delete(synchronize_session=False)
+    db.session.query(User).filter(User.oauth_id.like(f"{NAME_PREFIX}_%")).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def serialize_through_orm():
+    serialized_workers = []
+    serialized_workers_privileged = []
+    for worker in get_active_workers():
+        serialized_workers.append(worker.get_details())
+        serialized_workers_privileged.append(worker.get_details(2))
+    return (
+        json.dumps(serialized_workers, default=datetime_json_converter),
+        json.dumps(serialized_workers_privileged, default=datetime_json_converter),
+    )
+
+
+if __name__ == "__main__":
+    with HORDE.app_context():
+        create_synthetic_workers()
+        try:
+            results = []
+            for serializer in [serialize_through_orm, serialize_active_workers]:
+                db.session.expire_all()
+                start = time.perf_counter()
+                json_workers, json_workers_privileged = serializer()
+                logger.message(
+                    f"{serializer.__name__}(): {time.perf_counter() - start:.2f}s for {len(json.loads(json_workers))} workers "
+                    f"({len(json_workers)} + {len(json_workers_privileged)} bytes)",
+                )
+                results.append((json.loads(json_workers), json.loads(json_workers_privileged)))
+            if results[0] != results[1]:
+                logger.error("serialize_active_workers() does not produce the same workers list as get_details()")
+        finally:
+            delete_synthetic_workers()
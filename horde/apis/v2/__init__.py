@@ -13,6 +13,8 @@ from horde.apis.v2.base import api
 api.add_resource(stable.ImageAsyncGenerate, "/generate/async")
 api.add_resource(stable.ImageAsyncStatus, "/generate/status/<string:id>")
 api.add_resource(stable.ImageAsyncCheck, "/generate/check/<string:id>")
+api.add_resource(stable.ImageAsyncCheckWait, "/generate/check/<string:id>/wait")
+api.add_resource(stable.ImageAsyncCheckStream, "/generate/check/<string:id>/stream")
 api.add_resource(stable.Aesthetics, "/generate/rate/<string:id>")
 api.add_resource(stable.ImageJobPop, "/generate/pop")
 api.add_resource(stable.ImageJobSubmit, "/generate/submit")
@@ -20,6 +20,7 @@ import horde.classes.base.stats as stats
 from horde import exceptions as e
 from horde.apis.models.v2 import Models, Parsers
 from horde.argparser import args
+from horde.change_events import notify_change
 from horde.classes.base import settings
 from horde.classes.base.detection import Filter
 from horde.classes.base.news import News
@@ -490,10 +491,10 @@ class JobPopTemplate(Resource):
                 if not wp.needs_gen():  # this says if < 1
                     continue
                 worker_ret = self.start_worker(wp)
-                worker_ret["messages"] = database.get_all_active_worker_messages(self.worker.id)
                 # logger.debug(worker_ret)
                 if worker_ret is None:
                     continue
+                worker_ret["messages"] = database.get_all_active_worker_messages(self.worker.id)
                 # logger.debug(worker_ret)
                 return worker_ret, 200
             db.session.commit()  # Unlock all locked wp rows before picking up new ones
@@ -2483,6 +2484,7 @@ class Filters(Resource):
             )
             db.session.add(new_filter)
             db.session.commit()
+            notify_change("filter")
             logger.info(f"Mod {mod.get_unique_alias()} added new filter {new_filter.id}")
         return (new_filter.get_details(), 200)
 
@@ -2687,6 +2689,7 @@ class FilterSingle(Resource):
         if self.args.replacement:
             filter.replacement = self.args.replacement
         db.session.commit()
+        notify_change("filter")
         logger.info(f"Mod {mod.get_unique_alias()} modified filter {filter.id}")
         return (filter.get_details(), 200)
 
@@ -2717,6 +2720,7 @@ class FilterSingle(Resource):
         logger.info(f"Mod {mod.get_unique_alias()} deleted filter {filter.id}")
         db.session.delete(filter)
         db.session.commit()
+        notify_change("filter")
         return ({"message": "OK"}, 200)
 
 
@@ -2753,6 +2757,7 @@ class Heartbeat(Resource):
             "threads": waitress_metrics.threads,
             "active_count": waitress_metrics.active_count,
             "db_connection": db_conn,
+            "redis_l1_cache": hr.l1_cache.get_stats(),
         }, 200
 
 
@@ -296,6 +296,8 @@ class TextAsyncStatus(Resource):
         # The WPCleaner is going to clean it up anyway
         wp.n = 0
         db.session.commit()
+        wp.refresh_queue_stats()
+        wp.notify_status_change("cancel")
         return (wp_status, 200)
 
 
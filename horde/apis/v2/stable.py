@@ -2,13 +2,15 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import json
 import random
+import time
 from collections import defaultdict
 from datetime import datetime
 
 import requests
-from flask import request
-from flask_restx import Resource, reqparse
+from flask import Response, request, stream_with_context
+from flask_restx import Resource, marshal, reqparse
 
 import horde.apis.limiter_api as lim
 import horde.classes.base.stats as stats
@@ -40,6 +42,13 @@ from horde.limiter import limiter
 from horde.logger import logger
 from horde.model_reference import model_reference
 from horde.patreon import patrons
+from horde.source_image_cache import source_image_cache
+from horde.status_events import (
+    STATUS_REFRESH_SECONDS,
+    STATUS_STREAM_MAX_SECONDS,
+    get_status_snapshot,
+    status_change_listener,
+)
 from horde.utils import does_extra_text_reference_exist, hash_dictionary
 from horde.validation import ParamValidator
 from horde.vars import horde_title
@@ -326,21 +335,23 @@ class ImageAsyncGenerate(GenerateTemplate):
     def activate_waiting_prompt(self):
         self.source_image = None
         self.source_mask = None
+        src_img = None
+        msk_img = None
         if self.args.source_image:
             (
                 self.source_image,
-                img,
+                src_img,
                 self.source_image_r2stored,
             ) = ensure_source_image_uploaded(self.args.source_image, f"{self.wp.id}_src", force_r2=True)
             if self.args.source_mask:
                 (
                     self.source_mask,
-                    img,
+                    msk_img,
                     self.source_mask_r2stored,
                 ) = ensure_source_image_uploaded(self.args.source_mask, f"{self.wp.id}_msk", force_r2=True)
             elif self.args.source_processing == "inpainting":
                 try:
-                    _red, _green, _blue, _alpha = img.split()
+                    _red, _green, _blue, _alpha = src_img.split()
                 except ValueError:
                     raise e.ImageValidationFailed(
                         "Inpainting requests must either include a mask, or an alpha channel.",
@@ -360,6 +371,12 @@ class ImageAsyncGenerate(GenerateTemplate):
             extra_source_images=self.args.extra_source_images,
             kudos_adjustment=2 if self.style_kudos is not None else 0,
         )
+        # Bridges without r2_source support receive the source images as base64
+        # so if any of them could pick up this WP, we prepare them now, while we still have them in memory
+        if src_img is not None and database.wp_needs_base64_source(self.wp):
+            source_image_cache.warm(self.wp.id, "src", src_img)
+            if msk_img is not None:
+                source_image_cache.warm(self.wp.id, "msk", msk_img)
 
     def apply_style(self):
         if self.args.style is None:
@@ -480,6 +497,8 @@ class ImageAsyncStatus(Resource):
         wp.n = 0
         wp.jobs = wp_status["finished"]
         db.session.commit()
+        wp.refresh_queue_stats()
+        wp.notify_status_change("cancel")
         return (wp_status, 200)
 
 
@@ -513,6 +532,11 @@ class ImageAsyncCheck(Resource):
         # Sending lite mode to try and reduce the amount of bandwidth
         # This will not retrieve procgens, so ETA will not be completely accurate
         self.args = self.get_parser.parse_args()
+        lite_status = self.get_lite_status_by_id(id)
+        logger.debug(lite_status)
+        return (lite_status, 200)
+
+    def check_client(self):
         ip_timeout = CounterMeasures.retrieve_timeout(request.remote_addr)
         if ip_timeout and self.args["Client-Agent"] == "unknown:0:unknown":
             raise e.Forbidden(
@@ -520,6 +544,9 @@ class ImageAsyncCheck(Resource):
                 "which is sending too many garbage requests. Please contact us on discord.",
                 log=f"Check request via IP {request.remote_addr} on unknown client blocked.",
             )
+
+    def get_wp(self, id):
+        self.check_client()
         wp = database.get_wp_by_id(id)
         if not wp:
             raise e.RequestNotFound(
@@ -528,14 +555,133 @@ class ImageAsyncCheck(Resource):
                 client_agent=self.args["Client-Agent"],
                 ipaddr=request.remote_addr,
             )
-        lite_status = wp.get_lite_status(
+        return wp
+
+    def get_lite_status(self, wp):
+        return wp.get_lite_status(
             request_avg=database.get_request_avg("image"),
             has_valid_workers=database.wp_has_valid_workers(wp),
             wp_queue_stats=database.get_wp_queue_stats(wp),
             active_worker_count=database.count_active_workers(),
         )
-        logger.debug(lite_status)
-        return (lite_status, 200)
+
+    def get_lite_status_by_id(self, id):
+        """Returns the lite status from the snapshot of the WP
+        Only when it doesn't have a usable snapshot do we calculate the status from the DB
+        """
+        self.check_client()
+        lite_status = self.get_snapshot_lite_status(id)
+        if lite_status is not None:
+            return lite_status
+        return self.get_lite_status(self.get_wp(id))
+
+    def get_snapshot_lite_status(self, id):
+        """Returns the lite status from the snapshot of the WP, checking its requirements against the active workers
+        Returns None if we can't answer without the DB
+        """
+        lite_status = get_status_snapshot(id, "image")
+        if lite_status is None:
+            return None
+        worker_requirements = lite_status.pop("worker_requirements")
+        if lite_status["faulted"]:
+            lite_status["is_possible"] = False
+            return lite_status
+        is_possible = database.worker_requirements_are_possible("image", worker_requirements)
+        if is_possible is None:
+            return None
+        lite_status["is_possible"] = is_possible
+        return lite_status
+
+
+class ImageAsyncCheckWait(ImageAsyncCheck):
+    get_parser = ImageAsyncCheck.get_parser.copy()
+    get_parser.add_argument(
+        "timeout",
+        default=30,
+        type=int,
+        required=False,
+        help="The max seconds to wait for the status to change (1-60)",
+        location="args",
+    )
+
+    decorators = [limiter.limit("2/second", key_func=lim.get_request_path)]
+
+    @api.expect(get_parser)
+    @api.marshal_with(
+        models.response_model_wp_status_lite,
+        code=200,
+        description="Async Request Status Check",
+    )
+    @api.response(404, "Request Not found", models.response_model_error)
+    def get(self, id):
+        """Long-poll the status of an Asynchronous generation request without images.
+        Waits until the status of the request changes, or the timeout passes, and then returns it.
+        If the server is too busy to wait, it returns the current status immediately.
+        """
+        self.args = self.get_parser.parse_args()
+        lite_status = self.get_lite_status_by_id(id)
+        if lite_status["done"] or lite_status["faulted"] or not status_change_listener.acquire_waiter_slot():
+            return (lite_status, 200)
+        try:
+            with status_change_listener.subscribe(id) as subscription:
+                # The status might have changed before we subscribed
+                lite_status = self.get_lite_status_by_id(id)
+                if lite_status["done"] or lite_status["faulted"]:
+                    return (lite_status, 200)
+                # We don't want to keep a DB connection while we're waiting
+                db.session.close()
+                subscription.wait(min(max(self.args.timeout, 1), 60))
+        finally:
+            status_change_listener.release_waiter_slot()
+        return (self.get_lite_status_by_id(id), 200)
+
+
+class ImageAsyncCheckStream(ImageAsyncCheck):
+    decorators = [limiter.limit("1/second", key_func=lim.get_request_path)]
+
+    @api.expect(ImageAsyncCheck.get_parser)
+    @api.response(200, "A text/event-stream of the Async Request Status Check", models.response_model_wp_status_lite)
+    @api.response(404, "Request Not found", models.response_model_error)
+    def get(self, id):
+        """Stream the status of an Asynchronous generation request without images, as Server-Sent Events.
+        A new event is sent whenever the status changes, until the request is done or faulted.
+        The stream also closes after a few minutes, or immediately if the server is too busy,
+        in which case the client should reconnect after the indicated retry time.
+        """
+        self.args = self.get_parser.parse_args()
+        # Makes sure the WP exists before we start streaming
+        self.get_lite_status_by_id(id)
+        return Response(
+            stream_with_context(self.stream_status(id)),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    def stream_status(self, wp_id):
+        has_slot = status_change_listener.acquire_waiter_slot()
+        try:
+            yield f"retry: {STATUS_REFRESH_SECONDS * 1000}\n\n"
+            with status_change_listener.subscribe(wp_id) as subscription:
+                stream_end = time.monotonic() + STATUS_STREAM_MAX_SECONDS
+                while True:
+                    lite_status = self.get_snapshot_lite_status(wp_id)
+                    if lite_status is None:
+                        wp = database.get_wp_by_id(wp_id)
+                        if not wp:
+                            yield "event: deleted\ndata: {}\n\n"
+                            return
+                        lite_status = self.get_lite_status(wp)
+                    lite_status = marshal(lite_status, models.response_model_wp_status_lite)
+                    # We don't want to keep a DB connection while we're waiting
+                    db.session.close()
+                    yield f"data: {json.dumps(lite_status)}\n\n"
+                    if lite_status["done"] or lite_status["faulted"] or not has_slot or time.monotonic() >= stream_end:
+                        return
+                    # Even without changes, we send the status periodically to keep the ETA up to date
+                    subscription.wait(STATUS_REFRESH_SECONDS)
+        finally:
+            if has_slot:
+                status_change_listener.release_waiter_slot()
 
 
 class ImageJobPop(JobPopTemplate):
@@ -560,6 +706,7 @@ class ImageJobPop(JobPopTemplate):
         self.blacklist = []
         if self.args.blacklist:
             self.blacklist = self.args.blacklist
+        self.wp_candidates = {}
         post_ret, retcode = super().post()
         if "ids" not in post_ret or len(post_ret["ids"]) == 0:
             db_skipped = database.count_skipped_image_wp(
@@ -610,6 +757,8 @@ class ImageJobPop(JobPopTemplate):
             self.blacklist,
             priority_user_ids=priority_user_ids,
             page=self.wp_page,
+            # The prioritized WPs are only looked up once, so only the rest need to carry on from the previous page
+            candidates=None if priority_user_ids else self.wp_candidates,
         )
         return sorted_wps
 
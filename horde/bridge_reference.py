@@ -2,6 +2,8 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+from functools import lru_cache
+
 import semver
 
 from horde.consts import KNOWN_POST_PROCESSORS
@@ -173,7 +175,45 @@ LLM_VALIDATED_BACKENDS = {
 }
 
 
+def compile_version_table(version_table, extract):
+    """Turns a {version: values} table into a list of (semver, frozenset) sorted by version
+    where each frozenset contains all the values available up to and including that version
+    """
+    compiled = []
+    cumulative = set()
+    for version in sorted(version_table, key=lambda v: semver.Version.parse(str(v), True)):
+        cumulative.update(extract(version_table[version]))
+        compiled.append((semver.Version.parse(str(version), True), frozenset(cumulative)))
+    return compiled
+
+
+# We precompile the reference tables once at import, so that lookups don't need to parse versions anymore
+COMPILED_BRIDGE_CAPABILITIES = {
+    bridge_name: compile_version_table(versions, lambda capabilities: capabilities) for bridge_name, versions in BRIDGE_CAPABILITIES.items()
+}
+COMPILED_BRIDGE_SAMPLERS = {
+    bridge_name: {
+        True: compile_version_table(versions, lambda samplers: samplers["karras"]),
+        # If karras == True, only karras samplers can be used.
+        # Else, all samplers can be used
+        False: compile_version_table(versions, lambda samplers: set(samplers["karras"]) | set(samplers["no karras"])),
+    }
+    for bridge_name, versions in BRIDGE_SAMPLERS.items()
+}
+
+
+def lookup_compiled_table(compiled_table, bridge_semver):
+    """Returns the frozenset of the highest version in the compiled table which is not above the given version"""
+    available = frozenset()
+    for checked_semver, values in compiled_table:
+        if checked_semver.compare(bridge_semver) > 0:
+            break
+        available = values
+    return available
+
+
 @logger.catch(reraise=True)
+@lru_cache(maxsize=4096)
 def parse_bridge_agent(bridge_agent):
     try:
         bridge_name, bridge_version, _ = bridge_agent.split(":", 2)
@@ -189,21 +229,20 @@ def parse_bridge_agent(bridge_agent):
     return bridge_name, bridge_semver
 
 
+@lru_cache(maxsize=4096)
+def get_bridge_capabilities(bridge_agent):
+    """Returns a frozenset with all the capabilities of this bridge_agent
+    There's only a handful of distinct bridge agents at any time, so we cache them by their raw string
+    """
+    bridge_name, bridge_version = parse_bridge_agent(bridge_agent)
+    if bridge_name not in COMPILED_BRIDGE_CAPABILITIES:
+        return frozenset()
+    return lookup_compiled_table(COMPILED_BRIDGE_CAPABILITIES[bridge_name], bridge_version)
+
+
 @logger.catch(reraise=True)
 def check_bridge_capability(capability, bridge_agent):
-    bridge_name, bridge_version = parse_bridge_agent(bridge_agent)
-    # logger.debug([bridge_name, bridge_version])
-    if bridge_name not in BRIDGE_CAPABILITIES:
-        return False
-    total_capabilities = set()
-    # Because we start from 0
-    for version in BRIDGE_CAPABILITIES[bridge_name]:
-        checked_semver = semver.Version.parse(str(version), True)
-        if checked_semver.compare(bridge_version) <= 0:
-            total_capabilities.update(BRIDGE_CAPABILITIES[bridge_name][version])
-    # logger.debug([total_capabilities, capability, capability in total_capabilities])
-    # logger.debug([bridge_name, BRIDGE_CAPABILITIES[bridge_name]])
-    return capability in total_capabilities
+    return capability in get_bridge_capabilities(bridge_agent)
 
 
 @logger.catch(reraise=True)
@@ -212,58 +251,40 @@ def is_backed_validated(bridge_agent):
     return bridge_name in LLM_VALIDATED_BACKENDS
 
 
-@logger.catch(reraise=True)
-def get_supported_samplers(bridge_agent, karras=True):
+@lru_cache(maxsize=4096)
+def get_bridge_samplers(bridge_agent, karras):
     bridge_name, bridge_version = parse_bridge_agent(bridge_agent)
-    if bridge_name not in BRIDGE_SAMPLERS:
+    if bridge_name not in COMPILED_BRIDGE_SAMPLERS:
         # When it's an unknown worker agent we treat it like AI Horde Worker
         bridge_name = "AI Horde Worker"
         bridge_version = semver.Version.parse("23.0.0", True)
-    available_samplers = set()
-    for version in BRIDGE_SAMPLERS[bridge_name]:
-        checked_semver = semver.Version.parse(str(version), True)
-        if checked_semver.compare(bridge_version) <= 0:
-            available_samplers.update(BRIDGE_SAMPLERS[bridge_name][version]["karras"])
-            # If karras == True, only karras samplers can be used.
-            # Else, all samplers can be used
-            if not karras:
-                available_samplers.update(BRIDGE_SAMPLERS[bridge_name][version]["no karras"])
-    # logger.debug([available_samplers, sampler, sampler in available_samplers])
-    return available_samplers
+    return lookup_compiled_table(COMPILED_BRIDGE_SAMPLERS[bridge_name][bool(karras)], bridge_version)
+
+
+@logger.catch(reraise=True)
+def get_supported_samplers(bridge_agent, karras=True):
+    return get_bridge_samplers(bridge_agent, karras)
 
 
 @logger.catch(reraise=True)
 def check_sampler_capability(sampler, bridge_agent, karras=True):
-    return sampler in get_supported_samplers(bridge_agent, karras)
+    return sampler in get_bridge_samplers(bridge_agent, karras)
 
 
 @logger.catch(reraise=True)
 def get_supported_pp(bridge_agent):
-    bridge_name, bridge_version = parse_bridge_agent(bridge_agent)
+    bridge_name, _ = parse_bridge_agent(bridge_agent)
     if bridge_name not in BRIDGE_SAMPLERS:
         # When it's an unknown worker agent we treat it like AI Horde Worker
-        bridge_name = "AI Horde Worker"
-        bridge_version = 23
-    available_pp = set()
-    for version in BRIDGE_CAPABILITIES[bridge_name]:
-        checked_semver = semver.Version.parse(str(version), True)
-        if checked_semver.compare(bridge_version) <= 0:
-            for capability in BRIDGE_CAPABILITIES[bridge_name][version]:
-                if capability in KNOWN_POST_PROCESSORS:
-                    available_pp.add(capability)
-    return available_pp
+        capabilities = lookup_compiled_table(COMPILED_BRIDGE_CAPABILITIES["AI Horde Worker"], semver.Version.parse("23", True))
+    else:
+        capabilities = get_bridge_capabilities(bridge_agent)
+    return {capability for capability in capabilities if capability in KNOWN_POST_PROCESSORS}
 
 
 @logger.catch(reraise=True)
 def get_latest_version(bridge_name):
-    latest_semver = None
-    for version in BRIDGE_CAPABILITIES[bridge_name]:
-        chkver = semver.Version.parse(str(version), True)
-        if latest_semver is None:
-            latest_semver = semver.Version.parse(str(version), True)
-        elif latest_semver.compare(chkver) < 0:
-            latest_semver = chkver
-    return latest_semver
+    return COMPILED_BRIDGE_CAPABILITIES[bridge_name][-1][0]
 
 
 @logger.catch(reraise=True)
@@ -0,0 +1,88 @@
+# SPDX-FileCopyrightText: 2022 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Notifications of changes to the data the primary caches, so that it only recomputes a cache when it's stale.
+
+Whatever changes WPs, workers or filters publishes the topic it touched on a redis channel, after committing.
+Each node runs a single listener on that channel, which wakes up the primary functions that depend on that topic.
+"""
+
+import threading
+import time
+
+from horde.horde_redis import horde_redis as hr
+from horde.logger import logger
+
+CHANGE_CHANNEL = "horde_changes"
+# The same topic is published at most this often per node. This is shorter than the delay with which
+# the primary functions react to a change, so any change we skip is already committed by the time they run.
+CHANGE_COALESCE_SECONDS = 0.1
+
+
+class ChangeNotifier:
+    def __init__(self):
+        self.last_published = {}
+
+    def notify(self, topic):
+        """Lets the primary know that the data of this topic has changed. Call it after committing the change"""
+        if hr.horde_r is None:
+            return
+        now = time.monotonic()
+        if now - self.last_published.get(topic, 0) < CHANGE_COALESCE_SECONDS:
+            return
+        self.last_published[topic] = now
+        try:
+            hr.horde_r.publish(CHANGE_CHANNEL, topic)
+        except Exception as err:
+            logger.warning(f"Could not publish the {topic} change: {err}")
+
+
+class ChangeListener:
+    def __init__(self):
+        self.functions = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def register(self, function, topics):
+        """The function's notify_change() is called whenever one of the topics changes"""
+        with self.lock:
+            # We start the thread on first use, so that just importing this doesn't start it
+            if self.thread is None and hr.horde_r is not None:
+                self.thread = threading.Thread(target=self.listen, daemon=True)
+                self.thread.start()
+            for topic in topics:
+                self.functions.setdefault(topic, []).append(function)
+
+    def notify(self, topic=None):
+        """Wakes up the functions of the topic, or all of them if no topic is given"""
+        with self.lock:
+            if topic is None:
+                functions = {function for topic_functions in self.functions.values() for function in topic_functions}
+            else:
+                functions = list(self.functions.get(topic, []))
+        for function in functions:
+            function.notify_change()
+
+    def listen(self):
+        while True:
+            try:
+                pubsub = hr.horde_r.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANGE_CHANNEL)
+                # We might have missed changes while we were disconnected, so everything should run again
+                self.notify()
+                for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    self.notify(message["data"])
+            except Exception as err:
+                logger.warning(f"Lost the change notification subscription. Reconnecting: {err}")
+                time.sleep(1)
+
+
+change_notifier = ChangeNotifier()
+change_listener = ChangeListener()
+
+
+def notify_change(topic):
+    change_notifier.notify(topic)
@@ -5,14 +5,15 @@
 import random
 from datetime import datetime
 
-import requests
 from sqlalchemy import JSON
 from sqlalchemy.dialects.postgresql import JSONB, UUID
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.sql import expression
 
 from horde.flask import SQLITE_MODE, db
 from horde.logger import logger
 from horde.utils import get_db_uuid
+from horde.webhooks import webhook_dispatcher
 
 uuid_column_type = lambda: UUID(as_uuid=True) if not SQLITE_MODE else db.String(36)  # FIXME # noqa E731
 json_column_type = JSONB if not SQLITE_MODE else JSON
@@ -55,10 +56,18 @@ class ProcessingGeneration(db.Model):
     created = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
     def __init__(self, *args, **kwargs):
+        # When popping a batch, the WP adds and commits all its procgens together
+        # So it sends us its own wp and worker objects, as we can't load them before we're in the DB
+        batch_wp = kwargs.pop("batch_wp", None)
+        batch_worker = kwargs.pop("batch_worker", None)
         super().__init__(*args, **kwargs)
+        if batch_wp is None:
+            db.session.add(self)
+            db.session.commit()
+        else:
+            set_committed_value(self, "wp", batch_wp)
+            set_committed_value(self, "worker", batch_worker)
         # If there has been no explicit model requested by the user, we just choose the first available from the worker
-        db.session.add(self)
-        db.session.commit()
         if kwargs.get("model") is None:
             worker_models = self.worker.get_model_names()
             if len(worker_models):
@@ -82,7 +91,8 @@ class ProcessingGeneration(db.Model):
         else:
             self.model = kwargs["model"]
         self.set_job_ttl()
-        db.session.commit()
+        if batch_wp is None:
+            db.session.commit()
 
     def set_generation(self, generation, things_per_sec, **kwargs):
         if self.is_completed():
@@ -100,6 +110,8 @@ class ProcessingGeneration(db.Model):
         self.record(things_per_sec, kudos)
         self.send_webhook(kudos)
         db.session.commit()
+        self.wp.refresh_queue_stats()
+        self.wp.notify_status_change("submit")
         return kudos
 
     def cancel(self):
@@ -113,6 +125,8 @@ class ProcessingGeneration(db.Model):
         self.cancelled = True
         self.record(things_per_sec, kudos)
         db.session.commit()
+        self.wp.refresh_queue_stats()
+        self.wp.notify_status_change("cancel")
         return kudos * self.worker.get_bridge_kudos_multiplier()
 
     def record(self, things_per_sec, kudos):
@@ -148,6 +162,8 @@ class ProcessingGeneration(db.Model):
         self.worker.log_aborted_job()
         self.log_aborted_generation()
         db.session.commit()
+        self.wp.refresh_queue_stats()
+        self.wp.notify_status_change("fault")
 
     def log_aborted_generation(self):
         logger.info(f"Aborted Stale Generation {self.id} from by worker: {self.worker.name} ({self.worker.id})")
@@ -214,22 +230,10 @@ class ProcessingGeneration(db.Model):
         data["id"] = str(self.id)
         data["kudos"] = kudos
         data["worker_id"] = str(data["worker_id"])
-        for riter in range(3):
-            try:
-                req = requests.post(self.wp.webhook, json=data, timeout=3)
-                if not req.ok:
-                    logger.debug(
-                        f"Something went wrong when sending generation webhook: {req.status_code} - {req.text}. "
-                        f"Will retry {3-riter-1} more times...",
-                    )
-                    continue
-                break
-            except Exception as err:
-                logger.debug(f"Exception when sending generation webhook: {err}. Will retry {3-riter-1} more times...")
+        webhook_dispatcher.send(self.wp.webhook, data, "generation")
 
     def set_job_ttl(self):
         """Returns how many seconds each job request should stay waiting before considering it stale and cancelling it
         This function should be overriden by the invididual hordes depending on how the calculating ttl
         """
         self.job_ttl = 150
-        db.session.commit()
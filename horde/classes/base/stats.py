@@ -69,6 +69,12 @@ def get_things_per_min(thing_type="image"):
     return things_per_min
 
 
+def get_all_model_avgs():
+    """Returns the average performance of every model with a single query, as a dict of model -> avg"""
+    model_avgs = db.session.query(ModelPerformance.model, func.avg(ModelPerformance.performance)).group_by(ModelPerformance.model).all()
+    return {model: round(avg, 1) for model, avg in model_avgs if avg is not None}
+
+
 def get_model_avg(model_name):
     model_performances_count = db.session.query(ModelPerformance).filter_by(model=model_name).count()
     if model_performances_count == 0:
@@ -13,6 +13,7 @@ from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.ext.hybrid import hybrid_property
 
 from horde import vars as hv
+from horde.change_events import notify_change
 from horde.countermeasures import CounterMeasures
 from horde.discord import send_problem_user_notification
 from horde.enums import UserRecordTypes, UserRoleTypes
@@ -20,6 +21,7 @@ from horde.flask import SQLITE_MODE, db
 from horde.horde_redis import horde_redis as hr
 from horde.logger import logger
 from horde.patreon import patrons
+from horde.stats_ledger import get_pending_deltas, record_delta
 from horde.suspicions import SUSPICION_LOGS, Suspicions
 from horde.utils import generate_client_id, get_db_uuid, is_profane, sanitize_string
 
@@ -514,10 +516,15 @@ class User(db.Model):
         # Anonymous can never be trusted
         if self.is_anon():
             return
+        was_trusted = self.trusted
         self.set_user_role(UserRoleTypes.TRUSTED, is_trusted)
         if self.trusted:
             for worker in self.workers:
                 worker.paused = False
+            db.session.commit()
+        # Which requests the workers of this user can pick up depends on their trust
+        if self.trusted != was_trusted and len(self.workers) > 0:
+            notify_change("worker")
 
     def set_flagged(self, is_flagged):
         # Anonymous can never be flagged
@@ -568,6 +575,9 @@ class User(db.Model):
         return f"{self.username}#{self.id}"
 
     def update_user_record(self, record_type, record, increment_value):
+        # The records are only used for reporting, so we let the primary flush them in bulk
+        if record_delta("user_records", self.id, f"{record_type.name}|{record}", increment_value):
+            return
         record_details = db.session.query(UserRecords).filter_by(user_id=self.id, record_type=record_type, record=record).first()
         if not record_details:
             record_details = UserRecords(
@@ -708,6 +718,10 @@ class User(db.Model):
         logger.debug(f"modifying existing {self.kudos} kudos of {self.get_unique_alias()} by {kudos} for {action}")
         self.kudos = round(self.kudos + kudos, 2)
         self.ensure_kudos_positive()
+        # The balance is always committed immediately. Only the kudos details go through the ledger
+        if record_delta("user_stats", self.id, action, kudos):
+            db.session.commit()
+            return
         kudos_details = db.session.query(UserStats).filter_by(user_id=self.id).filter_by(action=action).first()
         if not kudos_details:
             kudos_details = UserStats(user_id=self.id, action=action, value=round(kudos, 2))
@@ -845,18 +859,25 @@ class User(db.Model):
         kudos_details_dict = {}
         for stat in self.stats:
             kudos_details_dict[stat.action] = stat.value
+        for action, delta in get_pending_deltas("user_stats", self.id).items():
+            kudos_details_dict[action] = round(kudos_details_dict.get(action, 0) + delta, 2)
         return kudos_details_dict
 
     def compile_records_details(self):
         records_dict = {}
-        for r in self.records:
-            rtype = r.record_type.name.lower()
+        record_values = {(r.record_type, r.record): r.value for r in self.records}
+        for field, delta in get_pending_deltas("user_records", self.id).items():
+            record_type_name, record = field.split("|", 1)
+            record_type = UserRecordTypes[record_type_name]
+            record_values[(record_type, record)] = round(record_values.get((record_type, record), 0) + delta, 2)
+        for (record_type, record), value in record_values.items():
+            rtype = record_type.name.lower()
             if rtype not in records_dict:
                 records_dict[rtype] = {}
-            record_key = r.record
-            if r.record_type in {UserRecordTypes.USAGE, UserRecordTypes.CONTRIBUTION} and r.record in hv.thing_names:
-                record_key = hv.thing_names[r.record]
-            records_dict[rtype][record_key] = r.value
+            record_key = record
+            if record_type in {UserRecordTypes.USAGE, UserRecordTypes.CONTRIBUTION} and record in hv.thing_names:
+                record_key = hv.thing_names[record]
+            records_dict[rtype][record_key] = value
         return records_dict
 
     @logger.catch(reraise=True)
@@ -3,22 +3,27 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import json
+import time
 import uuid
 from datetime import datetime, timedelta
 
-from sqlalchemy import JSON, or_
+from sqlalchemy import JSON, or_, update
 from sqlalchemy.dialects.postgresql import JSONB, UUID
 from sqlalchemy.ext.mutable import MutableDict
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.sql import expression
 
 from horde import vars as hv
 from horde.bridge_reference import check_bridge_capability
+from horde.change_events import notify_change
 from horde.classes.base.processing_generation import ProcessingGeneration
 from horde.classes.kobold.processing_generation import TextProcessingGeneration
 from horde.classes.stable.processing_generation import ImageProcessingGeneration
 from horde.flask import SQLITE_MODE, db
 from horde.horde_redis import horde_redis as hr
 from horde.logger import logger
+from horde.queue_stats import sync_wp_contribution
+from horde.status_events import delete_status_snapshot, publish_status_change, store_status_snapshot
 from horde.utils import get_db_uuid, get_expiry_date, get_extra_slow_expiry_date
 
 procgen_classes = {
@@ -191,6 +196,9 @@ class WaitingPrompt(db.Model):
         self.record_usage(raw_things=0, kudos=horde_tax, usage_type=self.wp_type, avoid_burn=True)
         # logger.debug(f"wp {self.id} initiated and paying horde tax: {horde_tax}")
         db.session.commit()
+        notify_change("wp")
+        self.refresh_queue_stats()
+        self.refresh_status_snapshot()
 
     def get_model_names(self):
         return [m.model for m in self.models]
@@ -236,21 +244,26 @@ class WaitingPrompt(db.Model):
             safe_amount = self.n
         if self.disable_batching:
             safe_amount = 1
-        # We use a local var to avoid touching the DB through self.n
-        # due to all the commits clearing row lock,
-        # can we can't ensure a race-condition won't have changed self.n between iterations
         current_n = self.n
-        self.n -= safe_amount
         payload = self.get_job_payload(current_n)
-        # This does a commit as well
-        self.refresh(worker)
+        # We claim all the gens we're about to send in one go, so that we only need to commit once at the end
+        if not self.claim_generations(safe_amount):
+            return None
+        self.extend_expiry(worker)
         procgen_class = procgen_classes[self.wp_type]
         gens_list = []
         model = None
         while safe_amount >= 1:
             safe_amount -= 1
             current_n -= 1
-            new_gen = procgen_class(wp_id=self.id, worker_id=worker.id, model=model)
+            new_gen = procgen_class(
+                id=get_db_uuid(),
+                wp_id=self.id,
+                worker_id=worker.id,
+                model=model,
+                batch_wp=self,
+                batch_worker=worker,
+            )
             # For batched requests, we need all procgens to use the same model
             model = new_gen.model
             logger.info(
@@ -258,8 +271,16 @@ class WaitingPrompt(db.Model):
                 f"('{worker.name}' / {worker.ipaddr}) - {current_n} gens left",
             )
             gens_list.append(new_gen)
-            if self.faulted:
-                break
+        # The procgens are all inserted together along with the expiry of this WP
+        db.session.add_all(gens_list)
+        db.session.commit()
+        # The commit expired the procgens, so we reload them all with one query
+        # instead of letting each of them do its own on first access
+        db.session.query(procgen_class).filter(procgen_class.id.in_([g.id for g in gens_list])).all()
+        self.notify_status_change("pop")
+        # Popping moves jobs from n to processing, so the queue stats only change once n runs out
+        if self.n < 1:
+            self.refresh_queue_stats()
         pop_payload = self.get_pop_payload(gens_list, payload)
         return pop_payload
 
@@ -464,6 +485,10 @@ class WaitingPrompt(db.Model):
             db.session.delete(model)
         db.session.delete(self)
         db.session.commit()
+        notify_change("wp")
+        sync_wp_contribution(self.wp_type, self.id, [], 0, 0)
+        delete_status_snapshot(self.id)
+        publish_status_change(self.id, "delete")
 
     def abort_for_maintenance(self):
         """sets all waiting requests to 0, so that all clients pick them up once the client gen is completed"""
@@ -472,16 +497,98 @@ class WaitingPrompt(db.Model):
                 return
             self.n = 0
             db.session.commit()
+            self.refresh_queue_stats()
+            self.notify_status_change("abort")
         except Exception as err:
             logger.warning(f"Error when aborting WP. Skipping: {err}")
 
-    def refresh(self, worker=None):
+    def refresh_queue_stats(self):
+        """Syncs the contribution of this WP to the per-model queue stats of the models status
+        Only WPs which still have gens to give out are counted, along with their gens in progress
+        """
+        jobs = 0
+        if self.active and not self.faulted and self.n >= 1:
+            jobs = self.n + self.count_processing_jobs()
+        models = [model for model in self.get_model_names() if "horde_special" not in model]
+        sync_wp_contribution(self.wp_type, self.id, models, jobs, self.things if jobs > 0 else 0)
+
+    def refresh_status_snapshot(self):
+        """Stores the current state of this WP in its status snapshot
+        The queue position and wait are refreshed by the primary while the WP is in the queue
+        """
+        snapshot = self.count_processing_gens()
+        snapshot["waiting"] = max(self.n, 0)
+        snapshot["done"] = self.is_completed()
+        snapshot["faulted"] = self.faulted
+        snapshot["kudos"] = round(self.consumed_kudos)
+        highest_expected_time_left = max([procgen.get_expected_time_left() for procgen in self.processing_gens], default=0)
+        snapshot["processing_until"] = time.time() + highest_expected_time_left
+        if not self.needs_gen():
+            snapshot["queue_position"] = 0
+            snapshot["queue_wait"] = 0
+        snapshot["wp_type"] = self.wp_type
+        # Every change of state makes this grow: a pop moves gens from waiting to processing,
+        # and a submit or a fault moves them from processing to finished or restarted.
+        # So a snapshot calculated before another node committed its change can't overwrite the one calculated after it
+        snapshot["version"] = (
+            2 * snapshot["finished"]
+            + snapshot["processing"]
+            + 3 * snapshot["restarted"]
+            - snapshot["waiting"]
+            + int(snapshot["faulted"])
+            + int(snapshot["done"])
+        )
+        store_status_snapshot(self.id, snapshot, self.expiry)
+
+    def store_worker_requirements(self):
+        """Stores what a worker needs to serve this WP in its status snapshot
+        so that the status checks can tell whether it's possible without loading it
+        Has to be called once the WP is fully activated
+        """
+        # The database package imports the WP classes, so we can only import it once everything is loaded
+        from horde.database.classes import WorkerCapabilityIndex
+
+        worker_requirements = WorkerCapabilityIndex.get_wp_requirements(self)
+        # Workers can get tricked after the WP was activated, so the snapshot can't know about them
+        del worker_requirements["tricked_workers"]
+        store_status_snapshot(self.id, {"worker_requirements": json.dumps(worker_requirements)}, self.expiry)
+
+    def notify_status_change(self, event):
+        """Refreshes the status snapshot and lets anyone waiting on this WP know that its status changed"""
+        self.refresh_status_snapshot()
+        publish_status_change(self.id, event)
+        notify_change("wp")
+
+    def claim_generations(self, amount):
+        """Reserves the requested amount of generations from this WP with a single atomic UPDATE
+        Returns False if the WP doesn't have that many generations left anymore
+        """
+        claimed_row = db.session.execute(
+            update(WaitingPrompt)
+            .where(
+                WaitingPrompt.id == self.id,
+                WaitingPrompt.n >= amount,
+            )
+            .values(n=WaitingPrompt.n - amount)
+            .returning(WaitingPrompt.n)
+            .execution_options(synchronize_session=False),
+        ).first()
+        if claimed_row is None:
+            return False
+        # We've already set n in the DB, so we don't want the session to try and set it again
+        set_committed_value(self, "n", claimed_row.n)
+        return True
+
+    def extend_expiry(self, worker=None):
         if worker is not None and worker.extra_slow_worker is True:
             self.expiry = get_extra_slow_expiry_date()
         else:
             new_expiry = get_expiry_date()
             if self.expiry < new_expiry:
                 self.expiry = new_expiry
+
+    def refresh(self, worker=None):
+        self.extend_expiry(worker)
         db.session.commit()
 
     def is_stale(self):
@@ -5,16 +5,21 @@
 import json
 from datetime import datetime, timedelta
 
-from sqlalchemy import func
+from sqlalchemy import func, update
 from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm.attributes import set_committed_value
 
 from horde import vars as hv
+from horde.change_events import notify_change
 from horde.classes.base import settings
 from horde.discord import send_pause_notification
 from horde.flask import SQLITE_MODE, db
 from horde.horde_redis import horde_redis as hr
 from horde.logger import logger
+from horde.stats_ledger import get_pending_deltas, record_delta
 from horde.suspicions import SUSPICION_LOGS, Suspicions
 from horde.utils import get_db_uuid, get_message_expiry_date, is_profane, sanitize_string
 
@@ -36,6 +41,14 @@ class WorkerStats(db.Model):
 
 class WorkerPerformance(db.Model):
     __tablename__ = "worker_performances"
+    __table_args__ = (
+        db.Index(
+            "idx_worker_performances_worker_id_slot",
+            "worker_id",
+            "slot",
+            unique=True,
+        ),
+    )
     id = db.Column(db.Integer, primary_key=True)
     worker_id = db.Column(
         uuid_column_type(),
@@ -44,6 +57,8 @@ class WorkerPerformance(db.Model):
     )
     worker = db.relationship("Worker", back_populates="performance")
     performance = db.Column(db.Float, primary_key=False)
+    # Each worker keeps a fixed ring of performances. The slot is the position in that ring
+    slot = db.Column(db.SmallInteger, nullable=False, default=0)
     created = db.Column(
         db.DateTime,
         default=datetime.utcnow,
@@ -139,6 +154,9 @@ class WorkerTemplate(db.Model):
     # The value of this column is dfferent per worker type
     max_power = db.Column(db.Integer, default=20, nullable=False)
     extra_slow_worker = db.Column(db.Boolean, default=False, nullable=False, index=True)
+    # Rolling mean of the worker's stored performances, maintained by refresh_speed()
+    # so that we don't have to aggregate the performances table every time we need the speed
+    cached_speed = db.Column(db.Float, default=None, nullable=True, index=True)
 
     paused = db.Column(db.Boolean, default=False, nullable=False)
     maintenance = db.Column(db.Boolean, default=False, nullable=False)
@@ -156,25 +174,75 @@ class WorkerTemplate(db.Model):
 
     require_upfront_kudos = False
     prioritized_users = []
+    # How many of the latest performances we keep for each worker to calculate its speed
+    performance_slots = 20
+    # The columns set on check-in which the summaries of the active workers depend on
+    summary_columns = ["bridge_agent", "require_upfront_kudos", "allow_unsafe_ipaddr"]
     # Because I didn't use worker_type correctly. I should have called them "text" and "image"
     # TODO: Normalize this to the standard
     wtype = "image"
 
     @hybrid_property
     def speed(self) -> int:
-        performance_avg = db.session.query(func.avg(WorkerPerformance.performance)).filter_by(worker_id=self.id).scalar()
-        if performance_avg:
-            return performance_avg
+        if self.cached_speed:
+            return self.cached_speed
         # We return a baseline speed if the workers hasn't fulfilled anything
         # in order to avoid a division by zero
         return 1 * hv.thing_divisors[self.wtype]
 
     @speed.expression
     def speed(cls):
-        performance_avg = db.select(func.avg(WorkerPerformance.performance)).where(WorkerPerformance.worker_id == cls.id).label("speed")
-        return db.case(
-            (performance_avg == None, 1 * hv.thing_divisors[cls.wtype]),  # noqa E712
-            else_=performance_avg,
+        return func.coalesce(cls.cached_speed, 1 * hv.thing_divisors[cls.wtype])
+
+    def refresh_speed(self):
+        """Recalculates the cached speed from the stored performances.
+        Has to be called whenever the performances of this worker change.
+        The caller is responsible for committing.
+        """
+        db.session.flush()
+        self.cached_speed = db.session.query(func.avg(WorkerPerformance.performance)).filter_by(worker_id=self.id).scalar()
+
+    def increment_fulfilments(self):
+        """Counts one more fulfilment in the DB itself and returns the new count
+        Concurrent submits of the same worker would otherwise read the same count and get the same performance slot.
+        """
+        fulfilments = db.session.execute(
+            update(WorkerTemplate)
+            .where(WorkerTemplate.id == self.id)
+            .values(fulfilments=WorkerTemplate.fulfilments + 1)
+            .returning(WorkerTemplate.fulfilments)
+            .execution_options(synchronize_session=False),
+        ).scalar()
+        # So that the ORM doesn't write the count it had loaded back over it
+        set_committed_value(self, "fulfilments", fulfilments)
+        return fulfilments
+
+    def record_performance(self, performance, fulfilments):
+        """Stores the newest performance by overwriting the oldest slot in the worker's performance ring
+        So we only ever need a single write instead of counting and trimming the performances table.
+        fulfilments has to be the count increment_fulfilments() returned for this job.
+        The caller is responsible for committing.
+        """
+        self.store_performance(fulfilments % self.performance_slots, performance)
+        self.refresh_speed()
+
+    def store_performance(self, slot, performance):
+        """Inserts the performance in its slot, or overwrites it once the ring is full, as a single atomic write"""
+        insert = sqlite_insert if SQLITE_MODE else postgresql_insert
+        insert_statement = insert(WorkerPerformance).values(
+            worker_id=self.id,
+            slot=slot,
+            performance=performance,
+            created=datetime.utcnow(),
+        )
+        db.session.execute(
+            insert_statement.on_conflict_do_update(
+                index_elements=[WorkerPerformance.worker_id, WorkerPerformance.slot],
+                set_={
+                    "performance": insert_statement.excluded.performance,
+                    "created": insert_statement.excluded.created,
+                },
+            ),
         )
 
     def create(self, **kwargs):
@@ -245,6 +313,7 @@ class WorkerTemplate(db.Model):
             return "Too Long"
         self.name = sanitize_string(new_name)
         db.session.commit()
+        notify_change("worker")
         return "OK"
 
     def set_info(self, new_info):
@@ -256,11 +325,13 @@ class WorkerTemplate(db.Model):
             return "Too Long"
         self.info = sanitize_string(new_info)
         db.session.commit()
+        notify_change("worker")
         return "OK"
 
     def set_team(self, new_team):
         self.team_id = new_team.id
         db.session.commit()
+        notify_change("worker")
         return "OK"
 
     # This should be overwriten by each specific horde
@@ -273,13 +344,18 @@ class WorkerTemplate(db.Model):
         if self.maintenance and maintenance_msg not in [None, ""]:
             self.maintenance_msg = sanitize_string(maintenance_msg)
         db.session.commit()
+        notify_change("worker")
 
     def toggle_paused(self, is_paused_active):
         self.paused = is_paused_active
         db.session.commit()
+        notify_change("worker")
 
     # This should be extended by each worker type
     def check_in(self, **kwargs):
+        # So that commit_check_in() can tell whether the summaries of the active workers need to be refreshed
+        self.summary_changed = self.is_stale()
+        self.summary_values = self.get_summary_values()
         self.ipaddr = kwargs.get("ipaddr", None)
         self.bridge_agent = sanitize_string(kwargs.get("bridge_agent", "unknown:0:unknown"))
         self.threads = kwargs.get("threads", 1)
@@ -313,6 +389,18 @@ class WorkerTemplate(db.Model):
             self.last_reward_uptime = self.uptime
         self.last_check_in = datetime.utcnow()
 
+    def get_summary_values(self):
+        return [getattr(self, column) for column in self.summary_columns]
+
+    def commit_check_in(self):
+        """Commits the check-in of this worker
+        If the worker came back online or changed what it can serve, the primary is notified after the commit
+        """
+        summary_changed = self.summary_changed or self.summary_values != self.get_summary_values()
+        db.session.commit()
+        if summary_changed:
+            notify_change("worker")
+
     def get_human_readable_uptime(self):
         if self.uptime < 60:
             return f"{self.uptime} seconds"
@@ -343,24 +431,10 @@ class WorkerTemplate(db.Model):
         self.user.record_contributions(raw_things=raw_things, kudos=kudos, contrib_type=self.wtype)
         self.modify_kudos(kudos, "generated")
         converted_amount = self.convert_contribution(raw_things)
-        self.fulfilments += 1
+        fulfilments = self.increment_fulfilments()
         if self.team and self.wtype == "image":
             self.team.record_contribution(converted_amount, kudos)
-        performances = db.session.query(WorkerPerformance).filter_by(worker_id=self.id).order_by(WorkerPerformance.created.asc())
-        if performances.count() >= 20:
-            # Ensure we don't forget anything
-            subquery = (
-                db.session.query(WorkerPerformance.id)
-                .filter_by(worker_id=self.id)
-                .order_by(WorkerPerformance.created.asc())
-                .offset(20)
-                .subquery()
-            )
-            db.session.query(WorkerPerformance).filter_by(worker_id=self.id).filter(
-                WorkerPerformance.id.notin_(subquery),
-            ).delete(synchronize_session=False)
-        new_performance = WorkerPerformance(worker_id=self.id, performance=things_per_sec)
-        db.session.add(new_performance)
+        self.record_performance(things_per_sec, fulfilments)
         db.session.commit()
         if things_per_sec / hv.thing_divisors[self.wtype] > hv.suspicion_thresholds[self.wtype]:
             self.report_suspicion(
@@ -370,6 +444,10 @@ class WorkerTemplate(db.Model):
 
     def modify_kudos(self, kudos, action="generated"):
         self.kudos = round(self.kudos + kudos, 2)
+        # The balance is always committed immediately. Only the kudos details go through the ledger
+        if record_delta("worker_stats", self.id, action, kudos):
+            db.session.commit()
+            return
         kudos_details = db.session.query(WorkerStats).filter_by(worker_id=self.id).filter_by(action=action).first()
         if not kudos_details:
             kudos_details = WorkerStats(worker_id=self.id, action=action, value=round(kudos, 2))
@@ -413,8 +491,14 @@ class WorkerTemplate(db.Model):
 
     # def is_slow(self):
 
+    @classmethod
+    def format_performance(cls, cached_speed):
+        """Formats the cached speed of a worker the way its details display it"""
+        speed = cached_speed if cached_speed else 1 * hv.thing_divisors[cls.wtype]
+        return f"{round(speed / hv.thing_divisors[cls.wtype], 1)} {hv.thing_names[cls.wtype]} per second"
+
     def get_performance(self):
-        return f"{round(self.speed / hv.thing_divisors[self.wtype], 1)} {hv.thing_names[self.wtype]} per second"
+        return self.format_performance(self.cached_speed)
         # #TODO: Need to figure how to handle this using self.speed
         return "No requests fulfilled yet"
 
@@ -436,12 +520,15 @@ class WorkerTemplate(db.Model):
             db.session.delete(suspicion)
         db.session.delete(self)
         db.session.commit()
+        notify_change("worker")
 
     def get_kudos_details(self):
         kudos_details = db.session.query(WorkerStats).filter_by(worker_id=self.id).all()
         ret_dict = {}
         for kd in kudos_details:
             ret_dict[kd.action] = kd.value
+        for action, delta in get_pending_deltas("worker_stats", self.id).items():
+            ret_dict[action] = round(ret_dict.get(action, 0) + delta, 2)
         return ret_dict
 
     def import_kudos_details(self, kudos_details):
@@ -451,9 +538,10 @@ class WorkerTemplate(db.Model):
         db.session.commit()
 
     def import_performances(self, performances):
-        for p in performances:
-            new_kd = WorkerPerformance(worker_id=self.id, performance=p)
-            db.session.add(new_kd)
+        # We number the slots like the 4.47.0 migration, so that the next performance overwrites the oldest one
+        for riter, p in enumerate(reversed(performances[-self.performance_slots :])):
+            self.store_performance((self.fulfilments - riter) % self.performance_slots, p)
+        self.refresh_speed()
         db.session.commit()
 
     def import_suspicions(self, suspicions):
@@ -465,52 +553,74 @@ class WorkerTemplate(db.Model):
     def get_active_messages(self):
         return [m for m in self.messages if m.expiry > datetime.utcnow()]
 
-    # Should be extended by each specific horde
-    @logger.catch(reraise=True)
-    def get_details(self, details_privilege=0):
-        """We display these in the workers list json"""
+    @classmethod
+    def format_details(cls, worker, details_privilege, *, user, trusted, flagged, team_name, kudos_details, suspicious, messages):
+        """Formats the details shared by all worker types for the workers list json
+        The worker can be an instance of this class or a row of the workers table, so that serialize_active_workers()
+        can build the exact same details in bulk. Each caller fetches the related data its own way and passes it in.
+        """
         ret_dict = {
-            "name": self.name,
-            "id": str(self.id),
-            "type": self.wtype,
-            "requests_fulfilled": self.fulfilments,
-            "uncompleted_jobs": self.uncompleted_jobs,
-            "kudos_rewards": self.kudos,
-            "kudos_details": self.get_kudos_details(),
-            "performance": self.get_performance(),
-            "threads": self.threads,
-            "uptime": self.uptime,
-            "maintenance_mode": self.maintenance,
-            "info": self.info,
-            "trusted": self.user.trusted,
-            "flagged": self.user.flagged,
-            "online": not self.is_stale(),
-            "team": {"id": str(self.team.id), "name": self.team.name} if self.team else "None",
-            "bridge_agent": self.bridge_agent,
+            "name": worker.name,
+            "id": str(worker.id),
+            "type": cls.wtype,
+            "requests_fulfilled": worker.fulfilments,
+            "uncompleted_jobs": worker.uncompleted_jobs,
+            "kudos_rewards": worker.kudos,
+            "kudos_details": kudos_details,
+            "performance": cls.format_performance(worker.cached_speed),
+            "threads": worker.threads,
+            "uptime": worker.uptime,
+            "maintenance_mode": worker.maintenance,
+            "info": worker.info,
+            "trusted": trusted,
+            "flagged": flagged,
+            "online": worker.last_check_in is not None and (datetime.utcnow() - worker.last_check_in).total_seconds() <= 300,
+            "team": {"id": str(worker.team_id), "name": team_name} if team_name is not None else "None",
+            "bridge_agent": worker.bridge_agent,
         }
         if details_privilege >= 2:
-            ret_dict["paused"] = self.paused
-            ret_dict["suspicious"] = len(self.suspicions)
-        if details_privilege >= 1 or self.user.public_workers:
-            ret_dict["owner"] = self.user.get_unique_alias()
-            msgs = []
-            for m in self.get_active_messages():
-                msgs.append(
-                    {
-                        "worker_id": str(self.id),
-                        "user_id": m.user_id,
-                        "message": m.message,
-                        "origin": m.origin,
-                        "created": m.created,
-                        "expiry": m.expiry,
-                    },
-                )
-            ret_dict["messages"] = msgs
+            ret_dict["paused"] = worker.paused
+            ret_dict["suspicious"] = suspicious
+        if details_privilege >= 1 or user.public_workers:
+            ret_dict["owner"] = f"{user.username}#{user.id}"
+            ret_dict["messages"] = [
+                {
+                    "worker_id": str(worker.id),
+                    "user_id": m.user_id,
+                    "message": m.message,
+                    "origin": m.origin,
+                    "created": m.created,
+                    "expiry": m.expiry,
+                }
+                for m in messages
+            ]
         if details_privilege >= 1:
-            ret_dict["ipaddr"] = self.ipaddr
-            ret_dict["contact"] = self.user.contact
+            ret_dict["ipaddr"] = worker.ipaddr
+            ret_dict["contact"] = user.contact
         return ret_dict
 
+    # Should be extended by each specific horde
+    @classmethod
+    def format_type_details(cls, worker, names):
+        """Formats the details specific to this worker type. The names are its models or its forms"""
+        return {}
+
+    # Should be extended by each specific horde
+    @logger.catch(reraise=True)
+    def get_details(self, details_privilege=0):
+        """We display these in the workers list json"""
+        return self.format_details(
+            self,
+            details_privilege,
+            user=self.user,
+            trusted=self.user.trusted,
+            flagged=self.user.flagged,
+            team_name=self.team.name if self.team else None,
+            kudos_details=self.get_kudos_details(),
+            suspicious=len(self.suspicions) if details_privilege >= 2 else 0,
+            messages=self.get_active_messages() if details_privilege >= 1 or self.user.public_workers else [],
+        )
+
     # Should be extended by each specific horde
     @logger.catch(reraise=True)
     def get_lite_details(self):
@@ -535,6 +645,7 @@ class Worker(WorkerTemplate):
         "polymorphic_identity": "worker",
     }
     nsfw = db.Column(db.Boolean, default=False, nullable=False)
+    summary_columns = WorkerTemplate.summary_columns + ["nsfw", "extra_slow_worker"]
 
     blacklist = db.relationship("WorkerBlackList", back_populates="worker", cascade="all, delete-orphan")
     models = db.relationship("WorkerModel", back_populates="worker", cascade="all, delete-orphan")
@@ -560,6 +671,8 @@ class Worker(WorkerTemplate):
         if existing_blacklist_words == blacklist:
             return
         existing_blacklist.delete()
+        # Workers with a blacklist are summarized differently
+        self.summary_changed = True
         for word in blacklist:
             blacklisted_word = WorkerBlackList(worker_id=self.id, word=word[0:15])
             db.session.add(blacklisted_word)
@@ -605,6 +718,7 @@ class Worker(WorkerTemplate):
             db.session.add(model)
         db.session.commit()
         self.refresh_model_cache()
+        notify_change("worker")
 
     def parse_models(self, models):
         """Parses the models provided by the worker into a set
@@ -669,10 +783,16 @@ class Worker(WorkerTemplate):
     def get_details(self, details_privilege=0):
         """We display these in the workers list json"""
         ret_dict = super().get_details(details_privilege)
-        ret_dict["nsfw"] = self.nsfw
-        ret_dict["models"] = self.get_model_names()
+        ret_dict.update(self.format_type_details(self, self.get_model_names()))
         return ret_dict
 
+    @classmethod
+    def format_type_details(cls, worker, names):
+        return {
+            "nsfw": worker.nsfw,
+            "models": names,
+        }
+
     def delete(self):
         for word in self.blacklist:
             db.session.delete(word)
@@ -66,6 +66,7 @@ class TextWaitingPrompt(WaitingPrompt):
         # We separate the activation from __init__ as often we want to check if there's a valid worker for it
         # Before we add it to the queue
         super().activate(downgrade_wp_priority, extra_source_images=extra_source_images, kudos_adjustment=kudos_adjustment)
+        self.store_worker_requirements()
         proxied_account = ""
         if self.proxied_account:
             proxied_account = f":{self.proxied_account}"
@@ -41,6 +41,7 @@ class TextWorker(Worker):
     # TODO: Switch to max_power
     max_length = db.Column(db.Integer, default=80, nullable=False)
     max_context_length = db.Column(db.Integer, default=2048, nullable=False)
+    summary_columns = Worker.summary_columns + ["max_length", "max_context_length"]
 
     softprompts = db.relationship("TextWorkerSoftprompts", back_populates="worker", cascade="all, delete-orphan")
     wtype = "text"
@@ -57,7 +58,7 @@ class TextWorker(Worker):
             f"{paused_string}Text Worker {self.name} checked-in, offering models {self.models} "
             f"at {self.max_length} max tokens and {self.max_context_length} max content length.",
         )
-        db.session.commit()
+        self.commit_check_in()
 
     def refresh_softprompt_cache(self):
         softprompts_list = [s.softprompt for s in self.softprompts]
@@ -102,6 +103,8 @@ class TextWorker(Worker):
         )
         db.session.query(TextWorkerSoftprompts).filter_by(worker_id=self.id).delete()
         db.session.flush()
+        # The softprompts are part of the summary of the active text workers
+        self.summary_changed = True
         for softprompt_name in softprompts:
             softprompt = TextWorkerSoftprompts(worker_id=self.id, softprompt=softprompt_name)
             db.session.add(softprompt)
@@ -145,10 +148,11 @@ class TextWorker(Worker):
             return [False, "matching_softprompt"]
         return [True, None]
 
-    def get_details(self, is_privileged=False):
-        ret_dict = super().get_details(is_privileged)
-        ret_dict["max_length"] = self.max_length
-        ret_dict["max_context_length"] = self.max_context_length
+    @classmethod
+    def format_type_details(cls, worker, names):
+        ret_dict = super().format_type_details(worker, names)
+        ret_dict["max_length"] = worker.max_length
+        ret_dict["max_context_length"] = worker.max_context_length
         return ret_dict
 
     def parse_models(self, unchecked_models):
@@ -2,12 +2,17 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import atexit
+import queue
+import threading
+import time
 from datetime import datetime
 
-from sqlalchemy import Enum
+from sqlalchemy import Enum, insert
 
 from horde.enums import ImageGenState
-from horde.flask import db
+from horde.flask import HORDE, db
+from horde.logger import logger
 
 
 class ImageGenerationStatisticPP(db.Model):
@@ -113,55 +118,133 @@ def record_image_statistic(procgen):
         state = ImageGenState.CANCELLED
     elif procgen.faulted:
         state = ImageGenState.FAULTED
-    statistic = ImageGenerationStatistic(
-        created=procgen.start_time,
-        model=procgen.model,
-        width=procgen.wp.width,
-        height=procgen.wp.height,
-        steps=procgen.wp.params["steps"],
-        cfg=procgen.wp.params["cfg_scale"],
-        sampler=procgen.wp.params["sampler_name"],
-        prompt_length=len(procgen.wp.prompt),
-        negprompt="###" in procgen.wp.prompt,
-        hires_fix=procgen.wp.params.get("hires_fix", False),
-        tiling=procgen.wp.params.get("tiling", False),
-        img2img=procgen.wp.source_image != None,  # noqa E711
-        nsfw=procgen.wp.nsfw,
-        bridge_agent=procgen.worker.bridge_agent,
-        client_agent=procgen.wp.client_agent,
-        state=state,
-    )
-    db.session.add(statistic)
-    db.session.commit()
+    # We only extract plain values here, as the ORM objects cannot be passed to the writer thread
+    statistic = {
+        "finished": datetime.utcnow(),
+        "created": procgen.start_time,
+        "model": procgen.model,
+        "width": procgen.wp.width,
+        "height": procgen.wp.height,
+        "steps": procgen.wp.params["steps"],
+        "cfg": procgen.wp.params["cfg_scale"],
+        "sampler": procgen.wp.params["sampler_name"],
+        "prompt_length": len(procgen.wp.prompt),
+        "negprompt": "###" in procgen.wp.prompt,
+        "hires_fix": procgen.wp.params.get("hires_fix", False),
+        "tiling": procgen.wp.params.get("tiling", False),
+        "img2img": procgen.wp.source_image != None,  # noqa E711
+        "nsfw": procgen.wp.nsfw,
+        "bridge_agent": procgen.worker.bridge_agent,
+        "client_agent": procgen.wp.client_agent,
+        "state": state,
+    }
     # face_fixers = ["GFPGAN", "CodeFormers"]
     # upscalers = ["RealESRGAN_x4plus"]
     post_processors = procgen.wp.params.get("post_processing", [])
-    if len(post_processors) > 0:
-        for pp in post_processors:
-            new_pp_entry = ImageGenerationStatisticPP(imgstat_id=statistic.id, pp=pp)
-            db.session.add(new_pp_entry)
-        db.session.commit()
     # For now we support only one control_type per request, but in the future we might allow more
     # So I set it up on an external table to be able to expand
+    control_types = []
     if procgen.wp.params.get("control_type", None):
-        new_cn_entry = ImageGenerationStatisticCN(
-            imgstat_id=statistic.id,
-            control_type=procgen.wp.params["control_type"],
-        )
-        db.session.add(new_cn_entry)
-        db.session.commit()
-    loras = procgen.wp.params.get("loras", [])
-    if len(loras) > 0:
-        for lora in loras:
-            new_lora_entry = ImageGenerationStatisticLora(imgstat_id=statistic.id, lora=lora["name"])
-            db.session.add(new_lora_entry)
-        db.session.commit()
-    tis = procgen.wp.params.get("tis", [])
-    if len(tis) > 0:
-        for ti in tis:
-            new_ti_entry = ImageGenerationStatisticTI(imgstat_id=statistic.id, ti=ti["name"])
-            db.session.add(new_ti_entry)
-        db.session.commit()
+        control_types.append(procgen.wp.params["control_type"])
+    loras = [lora["name"] for lora in procgen.wp.params.get("loras", [])]
+    tis = [ti["name"] for ti in procgen.wp.params.get("tis", [])]
+    image_stats_batcher.add(
+        {
+            "statistic": statistic,
+            "post_processors": list(post_processors),
+            "control_types": control_types,
+            "loras": loras,
+            "tis": tis,
+        },
+    )
+
+
+def write_image_statistics(records):
+    """Writes a batch of image statistics with one multi-row INSERT for the statistics
+    and one for each kind of child row
+    """
+    stat_ids = db.session.scalars(
+        insert(ImageGenerationStatistic).returning(ImageGenerationStatistic.id, sort_by_parameter_order=True),
+        [record["statistic"] for record in records],
+    ).all()
+    for child_class, record_key, value_column in (
+        (ImageGenerationStatisticPP, "post_processors", "pp"),
+        (ImageGenerationStatisticCN, "control_types", "control_type"),
+        (ImageGenerationStatisticLora, "loras", "lora"),
+        (ImageGenerationStatisticTI, "tis", "ti"),
+    ):
+        child_rows = [
+            {"imgstat_id": stat_id, value_column: value} for stat_id, record in zip(stat_ids, records) for value in record[record_key]
+        ]
+        if len(child_rows) > 0:
+            db.session.execute(insert(child_class), child_rows)
+    db.session.commit()
+
+
+class ImageStatisticsBatcher:
+    """Queues the image statistics in-process and writes them in bulk from a background thread
+    This takes the statistics writes out of the worker submit request.
+    A batch is written once it reaches batch_size records, or max_wait seconds after its first record.
+    """
+
+    def __init__(self, batch_size=250, max_wait=5):
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.thread = None
+        self.thread_lock = threading.Lock()
+
+    def add(self, record):
+        # We start the thread on first use, so that just importing the models doesn't start it
+        if self.thread is None:
+            with self.thread_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, daemon=True)
+                    self.thread.start()
+                    atexit.register(self.flush_remaining)
+        self.queue.put(record)
+
+    def get_batch(self):
+        # We block until there's at least one record to write
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.get_batch()
+            self.write_batch(batch)
+
+    def write_batch(self, batch):
+        with HORDE.app_context():
+            try:
+                write_image_statistics(batch)
+                logger.debug(f"Wrote {len(batch)} image statistics")
+            except Exception as err:
+                db.session.rollback()
+                # These are only statistics, so we don't retry the batch, to avoid getting stuck on a bad record
+                logger.error(f"Failed to write {len(batch)} image statistics: {err}")
+
+    def flush_remaining(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if len(batch) > 0:
+            self.write_batch(batch)
+
+
+image_stats_batcher = ImageStatisticsBatcher()
 
 
 class CompiledImageGenStatsTotals(db.Model):
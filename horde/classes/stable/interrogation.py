@@ -5,7 +5,6 @@
 import json
 from datetime import datetime, timedelta
 
-import requests
 from sqlalchemy import JSON, Enum
 from sqlalchemy.dialects.postgresql import JSONB, UUID
 
@@ -16,6 +15,7 @@ from horde.horde_redis import horde_redis as hr
 from horde.logger import logger
 from horde.r2 import generate_procgen_download_url, generate_procgen_upload_url
 from horde.utils import get_db_uuid, get_expiry_date, get_interrogation_form_expiry_date
+from horde.webhooks import webhook_dispatcher
 
 uuid_column_type = lambda: UUID(as_uuid=True) if not SQLITE_MODE else db.String(36)  # FIXME # noqa E731
 json_column_type = JSONB if not SQLITE_MODE else JSON
@@ -188,18 +188,7 @@ class InterrogationForms(db.Model):
         data["id"] = str(self.id)
         data["kudos"] = kudos
         data["worker_id"] = str(data["worker_id"])
-        for riter in range(3):
-            try:
-                req = requests.post(self.interrogation.webhook, json=data, timeout=3)
-                if not req.ok:
-                    logger.debug(
-                        f"Something went wrong when sending alchemy webhook: {req.status_code} - {req.text}. "
-                        f"Will retry {3-riter-1} more times...",
-                    )
-                    continue
-                break
-            except Exception as err:
-                logger.debug(f"Exception when sending alchemy webhook: {err}. Will retry {3-riter-1} more times...")
+        webhook_dispatcher.send(self.interrogation.webhook, data, "alchemy")
 
 
 class Interrogation(db.Model):
@@ -5,7 +5,6 @@
 from sqlalchemy import func
 
 from horde.classes.base.worker import (
-    WorkerPerformance,
     WorkerTemplate,
     uuid_column_type,
 )
@@ -48,7 +47,7 @@ class InterrogationWorker(WorkerTemplate):
         paused_string = ""
         if self.paused:
             paused_string = "(Paused) "
-        db.session.commit()
+        self.commit_check_in()
         logger.trace(
             f"{paused_string}Interrogation Worker {self.name} checked-in, offering forms: {form_names} @ {self.max_power} max tiles",
         )
@@ -85,13 +84,8 @@ class InterrogationWorker(WorkerTemplate):
         """We record the servers newest interrogation contribution"""
         self.user.record_contributions(raw_things=0, kudos=kudos, contrib_type=self.wtype)
         self.modify_kudos(kudos, "interrogated")
-        self.fulfilments += 1
-        # TODO: Switch to use desc() and offset to ensure we don't have performances left over
-        performances = db.session.query(WorkerPerformance).filter_by(worker_id=self.id).order_by(WorkerPerformance.created.asc())
-        if performances.count() >= 20:
-            db.session.delete(performances.first())
-        new_performance = WorkerPerformance(worker_id=self.id, performance=seconds_taken)
-        db.session.add(new_performance)
+        fulfilments = self.increment_fulfilments()
+        self.record_performance(seconds_taken, fulfilments)
         db.session.commit()
         # if things_per_sec / thing_divisor > things_per_sec_suspicion_threshold:
         #     self.report_suspicion(reason = Suspicions.UNREASONABLY_FAST, formats=[round(things_per_sec / thing_divisor,2)])
@@ -116,15 +110,18 @@ class InterrogationWorker(WorkerTemplate):
             db.session.add(form)
         db.session.commit()
 
-    def get_performance(self):
-        performances = [p.performance for p in self.performance]
-        if len(performances):
-            ret_str = f"{round(sum(performances) / len(performances),1)} seconds per form"
-        else:
-            ret_str = "No requests fulfilled yet"
-        return ret_str
+    @classmethod
+    def format_performance(cls, cached_speed):
+        # Interrogation performances are stored as seconds per form
+        if cached_speed is None:
+            return "No requests fulfilled yet"
+        return f"{round(cached_speed,1)} seconds per form"
 
     def get_details(self, details_privilege=0):
         ret_dict = super().get_details(details_privilege)
-        ret_dict["forms"] = self.get_form_names()
+        ret_dict.update(self.format_type_details(self, self.get_form_names()))
         return ret_dict
+
+    @classmethod
+    def format_type_details(cls, worker, names):
+        return {"forms": names}
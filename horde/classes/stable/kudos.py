@@ -6,7 +6,10 @@ import copy
 import pathlib
 import pickle
 import sys
+import threading
+import time
 
+import numpy as np
 import torch
 from loguru import logger
 
@@ -16,12 +19,15 @@ class KudosModel:
 
     Simple usage example:
 
-        # Initial one time setup (filename of the model)
-        kudos_model = KudosModel("kudos-v12-10.ckpt")
+        # The model is loaded once and shared by the whole process
+        kudos_model = KudosModel()
 
         # If our job JSON is in "payload":
         kudos = kudos_model.calculate_kudos(payload)
 
+        # Or for many payloads at once:
+        kudos_list = kudos_model.calculate_kudos_batch(payloads)
+
     """
 
     # "The general idea is for a 50 step 512x512 image to cost 10 Kudos"
@@ -100,27 +106,47 @@ class KudosModel:
     _model = None
     """Static singleton instance to copy from, preventing having to load from disk each time."""
 
-    model = None
-    """Instance copy - use this"""
+    _instance = None
+    """The single inference instance shared by the whole process"""
 
-    def __new__(cls):
-        # Our basis time
-        cls.time_basis = 0
+    _instance_lock = threading.Lock()
 
-        # Avoid any terrible mistakes in one hot encoding
-        KudosModel.KNOWN_POST_PROCESSORS.sort()
-        KudosModel.KNOWN_SAMPLERS.sort()
-        KudosModel.KNOWN_CONTROL_TYPES.sort()
-        KudosModel.KNOWN_SOURCE_PROCESSING.sort()
+    model = None
+    """Instance copy - use this"""
 
-        if not cls._model:
-            cls._model = cls.load_model(cls)
+    layers = None
+    """The model weights extracted as numpy arrays, which we use for inference"""
 
-        return super().__new__(cls)
+    def __new__(cls):
+        # The model never changes once loaded and inference doesn't modify it,
+        # so we can safely share one instance between all threads instead of copying the model for each job
+        if cls._instance is not None:
+            return cls._instance
+        with cls._instance_lock:
+            if cls._instance is not None:
+                return cls._instance
+            # Our basis time
+            cls.time_basis = 0
+
+            # Avoid any terrible mistakes in one hot encoding
+            KudosModel.KNOWN_POST_PROCESSORS.sort()
+            KudosModel.KNOWN_SAMPLERS.sort()
+            KudosModel.KNOWN_CONTROL_TYPES.sort()
+            KudosModel.KNOWN_SOURCE_PROCESSING.sort()
+
+            if not cls._model:
+                cls._model = cls.load_model(cls)
+
+            instance = super().__new__(cls)
+            instance.model = cls._model
+            instance.layers = cls.extract_numpy_layers(cls._model)
+            instance.calculate_basis_time()
+            cls._instance = instance
+        return cls._instance
 
     def __init__(self):
-        self.model = KudosModel.copy_model()
-        self.calculate_basis_time()
+        # All the setup is done only once, in __new__
+        pass
 
     # Payload to kudos
     def calculate_kudos(self, payload, basis_adjustment=1, basis_scale=1):
@@ -133,7 +159,20 @@ class KudosModel:
 
         # Get time for this job
         job_time = self.payload_to_time(payload)
+        return self.job_time_to_kudos(job_time, basis_adjustment, basis_scale)
 
+    def calculate_kudos_batch(self, payloads, basis_adjustment=1, basis_scale=1):
+        """Calculates the kudos for many payloads at once, running them all through the model in a single pass"""
+        if not self.model:
+            raise Exception("No kudos model loaded")
+        if not self.time_basis:
+            raise Exception("Kudos model failed to calculate basis time.")
+        if len(payloads) == 0:
+            return []
+        job_times = self.payloads_to_times(payloads)
+        return [self.job_time_to_kudos(job_time, basis_adjustment, basis_scale) for job_time in job_times]
+
+    def job_time_to_kudos(self, job_time, basis_adjustment=1, basis_scale=1):
         # What is the ratio between our basis time and this job time? i.e. How much longer
         # will this job take than our reference job that's worth 10 kudos?
         job_ratio = job_time / self.time_basis
@@ -167,6 +206,55 @@ class KudosModel:
 
         return torch.sum(one_hot, dim=0, keepdim=True)
 
+    @classmethod
+    def one_hot_encode_list(cls, string, unique_strings):
+        one_hot = [0.0] * len(unique_strings)
+        one_hot[unique_strings.index(string)] = 1.0
+        return one_hot
+
+    @classmethod
+    def payload_to_features(cls, payload):
+        """Converts a payload into the list of input values the model expects
+        This matches the tensor produced by payload_to_tensor(), but avoids going through torch
+        """
+        denoising_strength = 1.0
+        control_strength = 1.0
+
+        has_source_image = bool(payload.get("source_image", None))
+        has_control_type = bool(payload.get("control_type", None))
+
+        if has_source_image:
+            denoising_strength = payload.get("denoising_strength", 1.0)
+            if has_control_type:
+                control_strength = payload.get("control_strength", payload.get("denoising_strength", 1.0))
+                denoising_strength = 1.0
+
+        features = [
+            payload["height"] / 1024,
+            payload["width"] / 1024,
+            payload["steps"] / 100,  # Name doesn't match worker side (ddim_steps vs steps)
+            payload["cfg_scale"] / 30,
+            denoising_strength,
+            control_strength,
+            1.0 if payload["karras"] else 0.0,
+            1.0 if payload.get("hires_fix", False) else 0.0,
+            1.0 if payload.get("source_image", False) else 0.0,
+            1.0 if payload.get("source_mask", False) else 0.0,
+        ]
+        sampler_name = payload["sampler_name"] if payload["sampler_name"] in KudosModel.KNOWN_SAMPLERS else "k_euler"
+        features += cls.one_hot_encode_list(sampler_name, KudosModel.KNOWN_SAMPLERS)
+        features += cls.one_hot_encode_list(payload.get("control_type", "None"), KudosModel.KNOWN_CONTROL_TYPES)
+        sp = payload.get("source_processing", "txt2img")
+        # Little hack until new model is out
+        if sp == "remix":
+            sp = "img2img"
+        features += cls.one_hot_encode_list(sp, KudosModel.KNOWN_SOURCE_PROCESSING)
+        post_processors = [0.0] * len(KudosModel.KNOWN_POST_PROCESSORS)
+        for post_processor in payload.get("post_processing", []):
+            post_processors[KudosModel.KNOWN_POST_PROCESSORS.index(post_processor)] += 1.0
+        features += post_processors
+        return features
+
     @classmethod
     def payload_to_tensor(cls, payload):
         data = []
@@ -252,12 +340,48 @@ class KudosModel:
     def copy_model(cls):
         return copy.deepcopy(cls._model)
 
+    @classmethod
+    def extract_numpy_layers(cls, model):
+        """Converts our torch model into a list of numpy operations.
+        The model is a small MLP in eval mode, so we only need to know about Linear, ReLU and Dropout layers.
+        """
+        layers = []
+        for layer in model:
+            if isinstance(layer, torch.nn.Linear):
+                layers.append(
+                    (
+                        "linear",
+                        layer.weight.detach().numpy().T.copy(),
+                        layer.bias.detach().numpy().copy(),
+                    ),
+                )
+            elif isinstance(layer, torch.nn.ReLU):
+                layers.append(("relu", None, None))
+            elif isinstance(layer, torch.nn.Dropout):
+                # Dropout does nothing during inference
+                continue
+            else:
+                raise Exception(f"Unsupported kudos model layer {type(layer).__name__}")
+        return layers
+
+    def forward(self, inputs):
+        """Runs a 2D array of model inputs through the model, one row per payload"""
+        outputs = inputs
+        for layer_type, weight, bias in self.layers:
+            if layer_type == "linear":
+                outputs = outputs @ weight + bias
+            else:
+                outputs = np.maximum(outputs, 0)
+        return outputs
+
     # Pass in a horde payload, get back a predicted time in seconds
     def payload_to_time(self, payload):
-        inputs = self.payload_to_tensor(payload).squeeze()
-        with torch.no_grad():
-            output = self.model(inputs)
-        return round(float(output.item()), 2)
+        return self.payloads_to_times([payload])[0]
+
+    def payloads_to_times(self, payloads):
+        inputs = np.array([self.payload_to_features(payload) for payload in payloads], dtype=np.float32)
+        outputs = self.forward(inputs)
+        return [round(float(output), 2) for output in outputs.reshape(-1)]
 
     # Determine how long the basic job that costs KUDOS_BASIS kudos takes to run
     def calculate_basis_time(self):
@@ -268,7 +392,8 @@ if __name__ == "__main__":
     if len(sys.argv) != 2:
         logger.message("Syntax: kudos.py <model_filename>")
 
-    kudos_model = KudosModel(sys.argv[1])
+    KudosModel._model = KudosModel.load_model(KudosModel, sys.argv[1])
+    kudos_model = KudosModel()
 
     logger.message(f"Kudos basis is {kudos_model.KUDOS_BASIS}")
     logger.message(f"Time basis is {kudos_model.time_basis} seconds")
@@ -286,6 +411,26 @@ if __name__ == "__main__":
     logger.message(
         f"Adjusting a job by +5 and +25% worth {job_kudos}, " f"expected {(KudosModel.KUDOS_BASIS+5)*1.25} kudos",
     )
+
+    # Compare the per-job cost of copying the model for every job, like we used to, against the shared instance
+    iterations = 1000
+    start = time.perf_counter()
+    for _ in range(iterations):
+        copied_model = KudosModel.copy_model()
+        with torch.no_grad():
+            copied_model(KudosModel.payload_to_tensor(KudosModel.BASIS_PAYLOAD).squeeze())
+            copied_model(KudosModel.payload_to_tensor(KudosModel.BASIS_PAYLOAD).squeeze())
+    copy_time = (time.perf_counter() - start) / iterations
+    start = time.perf_counter()
+    for _ in range(iterations):
+        KudosModel().calculate_kudos(KudosModel.BASIS_PAYLOAD)
+    shared_time = (time.perf_counter() - start) / iterations
+    start = time.perf_counter()
+    kudos_model.calculate_kudos_batch([KudosModel.BASIS_PAYLOAD] * iterations)
+    batch_time = (time.perf_counter() - start) / iterations
+    logger.message(
+        f"Per job: copied model {copy_time * 1000:.4f}ms, shared instance {shared_time * 1000:.4f}ms, batched {batch_time * 1000:.4f}ms",
+    )
 else:
     kudos_model = KudosModel()
     # logger.info(f"Kudos basis is {KudosModel.KUDOS_BASIS}")
@@ -172,4 +172,3 @@ class ImageProcessingGeneration(ProcessingGeneration):
             self.job_ttl = 150
         if self.worker.extra_slow_worker is True:
             self.job_ttl = self.job_ttl * 3
-        db.session.commit()
@@ -21,14 +21,10 @@ from horde.consts import (
     SECOND_ORDER_SAMPLERS,
 )
 from horde.flask import db
-from horde.image import convert_pil_to_b64
 from horde.logger import logger
 from horde.model_reference import model_reference
-from horde.r2 import (
-    download_source_image,
-    download_source_mask,
-    generate_procgen_upload_url,
-)
+from horde.r2 import generate_procgen_upload_urls
+from horde.source_image_cache import source_image_cache
 from horde.utils import get_random_seed
 
 
@@ -70,6 +66,15 @@ class ImageWaitingPrompt(WaitingPrompt):
         cascade="all, delete-orphan",
     )
 
+    # These match the columns query_image_wp_match_rows() retrieves, so that the WP can be checked the same way
+    @property
+    def has_source_image(self):
+        return self.source_image is not None
+
+    @property
+    def has_extra_source_images(self):
+        return self.extra_source_images is not None
+
     @logger.catch(reraise=True)
     def extract_params(self):
         self.n = self.params.pop("n", 1)
@@ -205,27 +210,28 @@ class ImageWaitingPrompt(WaitingPrompt):
                 if check_bridge_capability("r2_source", procgen.worker.bridge_agent):
                     prompt_payload["source_image"] = self.source_image
                 else:
-                    src_img = download_source_image(self.id)
+                    src_img = source_image_cache.get_encoded(self.id, "src")
                     if src_img:
-                        prompt_payload["source_image"] = convert_pil_to_b64(src_img, 50)
+                        prompt_payload["source_image"] = src_img
                 prompt_payload["source_processing"] = self.source_processing
                 if self.source_mask:
                     if check_bridge_capability("r2_source", procgen.worker.bridge_agent):
                         prompt_payload["source_mask"] = self.source_mask
                     else:
-                        src_msk = download_source_mask(self.id)
+                        src_msk = source_image_cache.get_encoded(self.id, "msk")
                         if src_msk:
-                            prompt_payload["source_mask"] = convert_pil_to_b64(src_msk, 50)
+                            prompt_payload["source_mask"] = src_msk
             if self.extra_source_images and check_bridge_capability("extra_source_images", procgen.worker.bridge_agent):
                 prompt_payload["extra_source_images"] = self.extra_source_images["esi"]
             # We always ask the workers to upload the generation to R2 instead of sending it back as b64
             # If they send it back as b64 anyway, we upload it outselves
-            prompt_payload["r2_upload"] = generate_procgen_upload_url(str(procgen.id), self.shared)
-            prompt_payload["r2_uploads"] = [generate_procgen_upload_url(str(p.id), self.shared) for p in procgen_list]
+            prompt_payload["r2_uploads"] = generate_procgen_upload_urls([str(p.id) for p in procgen_list], self.shared)
+            prompt_payload["r2_upload"] = prompt_payload["r2_uploads"][0]
         else:
             prompt_payload = {}
             self.faulted = True
             db.session.commit()
+            self.notify_status_change("fault")
         # logger.debug([payload,prompt_payload])
         return prompt_payload
 
@@ -237,6 +243,7 @@ class ImageWaitingPrompt(WaitingPrompt):
             self.source_image = source_image
             self.source_mask = source_mask
             db.session.commit()
+        self.store_worker_requirements()
         prompt_type = "txt2img"
         if self.source_image:
             prompt_type = self.source_processing
@@ -251,6 +258,10 @@ class ImageWaitingPrompt(WaitingPrompt):
             f"== {self.total_usage} Total MPs for {self.kudos} kudos.",
         )
 
+    def delete(self):
+        source_image_cache.discard(self.id)
+        super().delete()
+
     def seed_to_int(self, s=None):
         if isinstance(s, int):
             return s
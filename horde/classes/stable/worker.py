@@ -31,6 +31,16 @@ class ImageWorker(Worker):
     allow_sdxl_controlnet = db.Column(db.Boolean, default=False, nullable=False, index=True)
     allow_lora = db.Column(db.Boolean, default=False, nullable=False, index=True)
     limit_max_steps = db.Column(db.Boolean, default=False, nullable=False, index=True)
+    summary_columns = Worker.summary_columns + [
+        "max_pixels",
+        "allow_img2img",
+        "allow_painting",
+        "allow_post_processing",
+        "allow_controlnet",
+        "allow_sdxl_controlnet",
+        "allow_lora",
+        "limit_max_steps",
+    ]
     wtype = "image"
 
     def check_in(self, max_pixels, **kwargs):
@@ -51,7 +61,7 @@ class ImageWorker(Worker):
         paused_string = ""
         if self.paused:
             paused_string = "(Paused) "
-        db.session.commit()
+        self.commit_check_in()
         logger.trace(
             f"{paused_string}Stable Worker {self.name} checked-in, offering models {self.get_model_names()} "
             f"at {self.max_pixels} max pixels",
@@ -206,16 +216,17 @@ class ImageWorker(Worker):
                 return [False, "kudos"]
         return [True, None]
 
-    def get_details(self, details_privilege=0):
-        ret_dict = super().get_details(details_privilege)
-        ret_dict["max_pixels"] = self.max_pixels
-        ret_dict["megapixelsteps_generated"] = self.contributions
-        ret_dict["img2img"] = self.allow_img2img if check_bridge_capability("img2img", self.bridge_agent) else False
-        ret_dict["painting"] = self.allow_painting if check_bridge_capability("inpainting", self.bridge_agent) else False
-        ret_dict["post-processing"] = self.allow_post_processing
-        ret_dict["controlnet"] = self.allow_controlnet
-        ret_dict["sdxl_controlnet"] = self.allow_sdxl_controlnet
-        ret_dict["lora"] = self.allow_lora
+    @classmethod
+    def format_type_details(cls, worker, names):
+        ret_dict = super().format_type_details(worker, names)
+        ret_dict["max_pixels"] = worker.max_pixels
+        ret_dict["megapixelsteps_generated"] = worker.contributions
+        ret_dict["img2img"] = worker.allow_img2img if check_bridge_capability("img2img", worker.bridge_agent) else False
+        ret_dict["painting"] = worker.allow_painting if check_bridge_capability("inpainting", worker.bridge_agent) else False
+        ret_dict["post-processing"] = worker.allow_post_processing
+        ret_dict["controlnet"] = worker.allow_controlnet
+        ret_dict["sdxl_controlnet"] = worker.allow_sdxl_controlnet
+        ret_dict["lora"] = worker.allow_lora
         return ret_dict
 
     def parse_models(self, unchecked_models):
@@ -4,6 +4,8 @@
 
 import ipaddress
 import os
+import threading
+import time
 from datetime import timedelta
 
 import requests
@@ -33,6 +35,119 @@ else:
 test_timeout = 0
 
 
+class IPBlockIndex:
+    """Keeps a local copy of the IP block timeouts, so that we don't have to scan redis for every IP we check.
+    The blocks are stored per prefix length, keyed by their network address,
+    so finding the blocks matching an IP is a dict lookup for each prefix length we have blocks for.
+    """
+
+    # How often we reload the blocks from redis, to pick up those set by other nodes
+    REFRESH_INTERVAL = 10
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.blocks = {}
+        self.last_refresh = None
+
+    def refresh(self):
+        blocks = {}
+        ip_block_keys = list(ip_t_r.scan_iter("ipblock_*"))
+        pipe = ip_t_r.pipeline()
+        for ip_block_key in ip_block_keys:
+            pipe.ttl(ip_block_key)
+        ttls = pipe.execute()
+        now = time.time()
+        for ip_block_key, ttl in zip(ip_block_keys, ttls):
+            if ttl is None or ttl < 0:
+                continue
+            ip_range = ip_block_key.decode().split("_", 1)[1]
+            try:
+                ip_network = ipaddress.ip_network(ip_range, strict=False)
+            except ValueError:
+                logger.warning(f"Ignoring invalid IP block timeout {ip_range}")
+                continue
+            self.store_block(blocks, ip_network, ip_range, now + ttl)
+        self.blocks = blocks
+        self.last_refresh = time.monotonic()
+
+    @staticmethod
+    def store_block(blocks, ip_network, ip_range, expiry):
+        prefixes = blocks.setdefault(ip_network.version, {})
+        prefixes.setdefault(ip_network.prefixlen, {})[int(ip_network.network_address)] = (ip_range, expiry)
+
+    def ensure_fresh(self):
+        if self.last_refresh is not None and time.monotonic() - self.last_refresh < self.REFRESH_INTERVAL:
+            return
+        # Only one thread needs to do the refresh. The others can keep using the previous copy meanwhile
+        if not self.lock.acquire(blocking=self.last_refresh is None):
+            return
+        try:
+            # Another thread might have refreshed while we were waiting on the first load
+            if self.last_refresh is None or time.monotonic() - self.last_refresh >= self.REFRESH_INTERVAL:
+                self.refresh()
+        except Exception as err:
+            logger.error(f"Failed to refresh IP block timeouts: {err}")
+            # Keep using what we have until the next interval, instead of retrying on every request while redis is down
+            self.last_refresh = time.monotonic()
+        finally:
+            self.lock.release()
+
+    def copy_blocks(self):
+        """Copies the index so that readers never see it while we're modifying it"""
+        return {
+            version: {prefixlen: dict(networks) for prefixlen, networks in prefixes.items()} for version, prefixes in self.blocks.items()
+        }
+
+    def add_block(self, ip_block, seconds):
+        """Adds a block we just set, so that this node doesn't have to wait for the next refresh to see it"""
+        try:
+            ip_network = ipaddress.ip_network(ip_block, strict=False)
+        except ValueError:
+            return
+        # Holding the lock so that a refresh which scanned redis before we set the block doesn't drop it
+        with self.lock:
+            blocks = self.copy_blocks()
+            self.store_block(blocks, ip_network, ip_block, time.time() + seconds)
+            self.blocks = blocks
+
+    def remove_block(self, ip_block):
+        try:
+            ip_network = ipaddress.ip_network(ip_block, strict=False)
+        except ValueError:
+            return
+        with self.lock:
+            blocks = self.copy_blocks()
+            blocks.get(ip_network.version, {}).get(ip_network.prefixlen, {}).pop(int(ip_network.network_address), None)
+            self.blocks = blocks
+
+    def get_matching_blocks(self, ipaddr):
+        """Returns all the block timeouts matching this IP, as a list of dicts with their range and remaining seconds"""
+        self.ensure_fresh()
+        ip = ipaddress.ip_address(ipaddr)
+        ip_int = int(ip)
+        now = time.time()
+        matching_blocks = []
+        for prefixlen, networks in self.blocks.get(ip.version, {}).items():
+            host_bits = ip.max_prefixlen - prefixlen
+            block = networks.get(ip_int >> host_bits << host_bits)
+            if block is None:
+                continue
+            ip_range, expiry = block
+            seconds = round(expiry - now)
+            if seconds <= 0:
+                continue
+            matching_blocks.append(
+                {
+                    "ipaddr": ip_range,
+                    "seconds": seconds,
+                },
+            )
+        return matching_blocks
+
+
+ip_block_index = IPBlockIndex()
+
+
 class CounterMeasures:
     @staticmethod
     def set_safe(ipaddr, is_safe):
@@ -163,18 +278,17 @@ class CounterMeasures:
             logger.warning(f"Attempted to inset non-block {ip_block} IP as a block timeout")
             return
         ip_t_r.setex(f"ipblock_{ip_block}", timedelta(minutes=minutes), int(True))
+        ip_block_index.add_block(ip_block, minutes * 60)
 
     @staticmethod
     def retrieve_block_timeout(ipaddr):
         """Checks if the IP is in a block timeout"""
         if not ip_t_r:
             return None
-        for ip_block_key in ip_t_r.scan_iter("ipblock_*"):
-            ip_range = ip_block_key.decode().split("_", 1)[1]
-            if ipaddress.ip_address(ipaddr) in ipaddress.ip_network(ip_range):
-                ttl = ip_t_r.ttl(ip_block_key)
-                return int(ttl)
-        return 0
+        matching_blocks = ip_block_index.get_matching_blocks(ipaddr)
+        if len(matching_blocks) == 0:
+            return 0
+        return max(block["seconds"] for block in matching_blocks)
 
     @staticmethod
     def delete_block_timeout(ip_block):
@@ -185,6 +299,7 @@ class CounterMeasures:
             logger.warning(f"Attempted to inset non-block {ip_block} IP as a block timeout")
             return
         ip_t_r.delete(f"ipblock_{ip_block}")
+        ip_block_index.remove_block(ip_block)
 
     @staticmethod
     def get_block_timeouts():
@@ -203,12 +318,7 @@ class CounterMeasures:
     @staticmethod
     def get_block_timeouts_matching_ip(ipaddr):
         """Returns all known IP block timeouts which match a specific IP address"""
-        ip_blocks = CounterMeasures.get_block_timeouts()
-        timeouts = []
-        for block in ip_blocks:
-            if ipaddress.ip_address(ipaddr) in ipaddress.ip_network(block["ipaddr"]):
-                timeouts.append(block)
-        return timeouts
+        return ip_block_index.get_matching_blocks(ipaddr)
 
     @staticmethod
     def is_ipv6(ipaddr):
@@ -6,13 +6,18 @@ import horde.database.threads as threads
 from horde.argparser import args
 from horde.database.classes import Quorum
 from horde.logger import logger
-from horde.threads import PrimaryTimedFunction
+from horde.threads import PrimaryEventFunction, PrimaryTimedFunction
 
 # Threads
 quorum = Quorum(1, threads.get_quorum)
-wp_list_cacher = PrimaryTimedFunction(1, threads.store_prioritized_wp_queue, quorum=quorum)
-worker_cacher = PrimaryTimedFunction(30, threads.store_worker_list, quorum=quorum)
-model_cacher = PrimaryTimedFunction(10, threads.store_available_models, quorum=quorum)
+# These only run when the data they cache changes, or when their interval passes without any change.
+# The WP caches expire after 5 seconds, so they still have to be refreshed before that.
+wp_list_cacher = PrimaryEventFunction(3, threads.store_prioritized_wp_queue, ["wp"], min_interval=1, quorum=quorum)
+wp_match_index_cacher = PrimaryEventFunction(3, threads.store_image_wp_match_index, ["wp"], min_interval=1, quorum=quorum)
+worker_cacher = PrimaryEventFunction(30, threads.store_worker_list, ["worker"], min_interval=5, quorum=quorum)
+# Workers also go offline without any notification, so we don't let this go stale for long
+worker_capabilities_cacher = PrimaryEventFunction(15, threads.store_worker_capabilities, ["worker"], min_interval=2, quorum=quorum)
+model_cacher = PrimaryEventFunction(60, threads.store_available_models, ["wp", "worker"], min_interval=10, quorum=quorum)
 if not args.check_prompts:
     wp_cleaner = PrimaryTimedFunction(60, threads.check_waiting_prompts, quorum=quorum)
 interrogations_cleaner = PrimaryTimedFunction(60, threads.check_interrogations, quorum=quorum)
@@ -20,16 +25,21 @@ patreon_cacher = PrimaryTimedFunction(3600, threads.store_patreon_members, quoru
 monthly_kudos = PrimaryTimedFunction(3600, threads.assign_monthly_kudos, quorum=quorum)
 totals_store = PrimaryTimedFunction(60, threads.store_totals, quorum=quorum)
 prune_stats = PrimaryTimedFunction(60, threads.prune_stats, quorum=quorum)
+stats_ledger_flusher = PrimaryTimedFunction(5, threads.flush_stats_ledger, quorum=quorum)
 priority_increaser = PrimaryTimedFunction(10, threads.increment_extra_priority, quorum=quorum)
-compiled_filter_cacher = PrimaryTimedFunction(10, threads.store_compiled_filter_regex, quorum=quorum)
-regex_replacements_cacher = PrimaryTimedFunction(10, threads.store_compiled_filter_regex_replacements, quorum=quorum)
+compiled_filter_cacher = PrimaryEventFunction(300, threads.store_compiled_filter_regex, ["filter"], quorum=quorum)
+regex_replacements_cacher = PrimaryEventFunction(300, threads.store_compiled_filter_regex_replacements, ["filter"], quorum=quorum)
 known_image_models_cacher = PrimaryTimedFunction(300, threads.store_known_image_models, quorum=quorum)
 
 if args.reload_all_caches:
     logger.info("store_prioritized_wp_queue()")
     threads.store_prioritized_wp_queue()
+    logger.info("store_image_wp_match_index()")
+    threads.store_image_wp_match_index()
     logger.info("store_worker_list()")
     threads.store_worker_list()
+    logger.info("store_worker_capabilities()")
+    threads.store_worker_capabilities()
     logger.info("store_totals()")
     threads.store_totals()
     logger.info("store_patreon_members()")
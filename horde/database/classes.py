@@ -5,6 +5,9 @@
 import uuid
 from datetime import datetime
 
+from horde.bridge_reference import check_bridge_capability, check_sampler_capability, is_backed_validated
+from horde.consts import KNOWN_POST_PROCESSORS
+from horde.model_reference import model_reference
 from horde.threads import PrimaryTimedFunction
 from horde.vars import horde_instance_id
 
@@ -18,6 +21,26 @@ class FakeWPRow:
         self.created = datetime.strptime(json_row["created"], "%Y-%m-%d %H:%M:%S")
 
 
+class WPQueueIndex:
+    """Precomputes the position of each WP in the priority queue, along with the things and n queued up to and including it"""
+
+    def __init__(self, priority_sorted_list, thing_divisor):
+        self.positions = {}
+        things_ahead_in_queue = 0
+        n_ahead_in_queue = 0
+        for riter, iter_wp in enumerate(priority_sorted_list):
+            queued_things = round(iter_wp.things * iter_wp.n / thing_divisor, 2)
+            things_ahead_in_queue += queued_things
+            n_ahead_in_queue += iter_wp.n
+            # We keep the first position, in case a WP appears twice
+            if iter_wp.id not in self.positions:
+                self.positions[iter_wp.id] = (riter, round(things_ahead_in_queue, 2), n_ahead_in_queue)
+
+    def get_queue_stats(self, wp_id):
+        # -1 means the WP is done and not in the queue
+        return self.positions.get(wp_id, (-1, 0, 0))
+
+
 class Quorum(PrimaryTimedFunction):
     quorum = None
 
@@ -26,3 +49,373 @@ class Quorum(PrimaryTimedFunction):
 
     def is_primary(self):
         return self.quorum == horde_instance_id
+
+
+class ImageWPMatchIndex:
+    """An in-memory index of the open image WPs, used to figure out which WPs a worker could pick up
+    without asking the DB to run the full filter on every pop.
+    Each WP is stored with a bitmask of the capabilities a worker needs to have to serve it,
+    so matching a worker is just a pixel comparison and a bitwise AND per WP.
+    """
+
+    NSFW = 1 << 0
+    IMG2IMG = 1 << 1
+    PAINTING = 1 << 2
+    EXTRA_SOURCE_IMAGES = 1 << 3
+    UNSAFE_IP = 1 << 4
+    R2 = 1 << 5
+    LORA = 1 << 6
+    TIS = 1 << 7
+    POST_PROCESSING = 1 << 8
+    CONTROLNET = 1 << 9
+    FAST_WORKER = 1 << 10
+    NOT_EXTRA_SLOW = 1 << 11
+    TRANSPARENT = 1 << 12
+
+    def __init__(self, json_rows):
+        # The rows are stored already in priority order, as we got them from the primary
+        self.rows = []
+        self.model_map = {}
+        self.modelless = []
+        for json_row in json_rows:
+            row = {
+                "id": uuid.UUID(json_row["id"]),
+                "pixels": json_row["pixels"],
+                "required": json_row["required"],
+                "user_id": json_row["user_id"],
+                "worker_blacklist": json_row["worker_blacklist"],
+                "workers": {uuid.UUID(worker_id) for worker_id in json_row["workers"]},
+            }
+            position = len(self.rows)
+            self.rows.append(row)
+            if len(json_row["models"]) == 0:
+                self.modelless.append(position)
+            for model_name in json_row["models"]:
+                self.model_map.setdefault(model_name, []).append(position)
+
+    @classmethod
+    def get_required_capabilities(cls, wp):
+        """Converts the WP requirements into a bitmask
+        Expects a row as retrieved by query_image_wp_match_rows()
+        """
+        required = 0
+        params = wp.params or {}
+        if wp.nsfw:
+            required |= cls.NSFW
+        if wp.has_source_image:
+            required |= cls.IMG2IMG
+        if wp.source_processing in ["inpainting", "outpainting"]:
+            required |= cls.PAINTING
+        if wp.has_extra_source_images:
+            required |= cls.EXTRA_SOURCE_IMAGES
+        if not wp.safe_ip:
+            required |= cls.UNSAFE_IP
+        if wp.r2:
+            required |= cls.R2
+        if "loras" in params:
+            required |= cls.LORA
+        if "tis" in params:
+            required |= cls.TIS
+        if "post-processing" in params:
+            required |= cls.POST_PROCESSING
+        if "control_type" in params:
+            required |= cls.CONTROLNET
+        if not wp.slow_workers:
+            required |= cls.FAST_WORKER
+        if not wp.extra_slow_workers:
+            required |= cls.NOT_EXTRA_SLOW
+        if params.get("transparent"):
+            required |= cls.TRANSPARENT
+        return required
+
+    @classmethod
+    def get_worker_capabilities(cls, worker):
+        """Converts the worker settings and its bridge capabilities into a bitmask"""
+        capabilities = 0
+        if worker.nsfw:
+            capabilities |= cls.NSFW
+        if worker.allow_img2img:
+            capabilities |= cls.IMG2IMG
+        if worker.allow_painting:
+            capabilities |= cls.PAINTING
+        if check_bridge_capability("extra_source_images", worker.bridge_agent):
+            capabilities |= cls.EXTRA_SOURCE_IMAGES
+        if worker.allow_unsafe_ipaddr:
+            capabilities |= cls.UNSAFE_IP
+        if check_bridge_capability("r2", worker.bridge_agent):
+            capabilities |= cls.R2
+        if worker.allow_lora and check_bridge_capability("lora", worker.bridge_agent):
+            capabilities |= cls.LORA
+        if check_bridge_capability("textual_inversion", worker.bridge_agent):
+            capabilities |= cls.TIS
+        if worker.allow_post_processing and check_bridge_capability("post-processing", worker.bridge_agent):
+            capabilities |= cls.POST_PROCESSING
+        if worker.allow_controlnet and check_bridge_capability("controlnet", worker.bridge_agent):
+            capabilities |= cls.CONTROLNET
+        if worker.speed >= 500000:  # 0.5 MPS/s
+            capabilities |= cls.FAST_WORKER
+        if not worker.extra_slow_worker:
+            capabilities |= cls.NOT_EXTRA_SLOW
+        if worker.allow_sdxl_controlnet and check_bridge_capability("layer_diffuse", worker.bridge_agent):
+            capabilities |= cls.TRANSPARENT
+        return capabilities
+
+    def get_candidate_ids(self, worker, worker_capabilities, models_list, priority_user_ids=None, require_matched_targeting=False):
+        """Returns the IDs of all WPs this worker could pick up, in priority order"""
+        positions = set()
+        for model_name in models_list:
+            positions.update(self.model_map.get(model_name, []))
+        if not any("horde_special" in mname for mname in models_list) and "SDXL_beta::stability.ai#6901" not in models_list:
+            positions.update(self.modelless)
+        candidate_ids = []
+        for position in sorted(positions):
+            row = self.rows[position]
+            if row["pixels"] > worker.max_pixels:
+                continue
+            if row["required"] & ~worker_capabilities:
+                continue
+            if priority_user_ids:
+                if row["user_id"] not in priority_user_ids:
+                    continue
+            elif worker.maintenance and row["user_id"] != worker.user_id:
+                continue
+            if row["workers"]:
+                if row["worker_blacklist"]:
+                    if worker.id in row["workers"]:
+                        continue
+                elif require_matched_targeting and not priority_user_ids:
+                    continue
+                elif worker.id not in row["workers"]:
+                    continue
+            candidate_ids.append(row["id"])
+        return candidate_ids
+
+
+class WorkerCapabilityIndex:
+    """An in-memory summary of the active workers of one type, used to figure out whether any of them could serve a WP
+    without loading and checking every worker from the DB.
+    Image workers use the same capability bitmask as the ImageWPMatchIndex, so a WP is only possible
+    if some worker would also be able to pop it. On top of that they get a bitmask of the features
+    that ImageWorker.can_generate() checks, along with their bridge agent for the samplers and post-processors.
+    Workers whose checks depend on the prompt or on the kudos of the user can't be summarized, so when only
+    those could serve a WP, we can't tell and the WP needs to be checked against the DB.
+    """
+
+    # Text workers have far fewer capabilities, so they get their own bitmask
+    TEXT_NSFW = 1 << 0
+    TEXT_UNSAFE_IP = 1 << 1
+    TEXT_FAST_WORKER = 1 << 2
+    TEXT_VALIDATED_BACKEND = 1 << 3
+
+    # The features of the image workers which the pop filters don't look at
+    IMAGE_SUPPORTED_MODELS = 1 << 0
+    IMAGE_IMG2IMG = 1 << 1
+    IMAGE_INPAINTING = 1 << 2
+    IMAGE_NOT_ONLY_INPAINTING = 1 << 3
+    IMAGE_POST_PROCESSING = 1 << 4
+    IMAGE_TILING = 1 << 5
+    IMAGE_RETURN_CONTROL_MAP = 1 << 6
+    IMAGE_CONTROLNET = 1 << 7
+    IMAGE_QR_CODE = 1 << 8
+    IMAGE_HIRES_FIX = 1 << 9
+    IMAGE_CLIP_SKIP = 1 << 10
+    IMAGE_LORA_VERSIONS = 1 << 11
+
+    def __init__(self, json_workers):
+        self.workers = []
+        self.model_map = {}
+        for json_worker in json_workers:
+            position = len(self.workers)
+            self.workers.append(json_worker)
+            for model_name in json_worker["models"]:
+                self.model_map.setdefault(model_name, []).append(position)
+
+    @classmethod
+    def get_worker_capabilities(cls, wp_type, worker):
+        """Converts the worker settings and its bridge capabilities into a bitmask
+        Expects a row as retrieved by query_worker_capability_rows()
+        """
+        if wp_type == "image":
+            return ImageWPMatchIndex.get_worker_capabilities(worker)
+        capabilities = 0
+        if worker.nsfw:
+            capabilities |= cls.TEXT_NSFW
+        if worker.allow_unsafe_ipaddr:
+            capabilities |= cls.TEXT_UNSAFE_IP
+        if worker.speed >= 2:
+            capabilities |= cls.TEXT_FAST_WORKER
+        if is_backed_validated(worker.bridge_agent):
+            capabilities |= cls.TEXT_VALIDATED_BACKEND
+        return capabilities
+
+    @classmethod
+    def get_worker_features(cls, wp_type, worker, model_names):
+        """Converts the checks of ImageWorker.can_generate() which depend only on the worker into a bitmask
+        Expects a row as retrieved by query_worker_capability_rows()
+        """
+        if wp_type != "image":
+            return 0
+        baselines = model_reference.get_all_model_baselines(model_names)
+        features = 0
+        # Workers serving flux without a bridge that supports it can't generate anything
+        if "flux_1" not in baselines or check_bridge_capability("flux", worker.bridge_agent):
+            features |= cls.IMAGE_SUPPORTED_MODELS
+        if worker.allow_img2img and check_bridge_capability("img2img", worker.bridge_agent):
+            features |= cls.IMAGE_IMG2IMG
+        if (
+            worker.allow_painting
+            and check_bridge_capability("inpainting", worker.bridge_agent)
+            and model_reference.has_inpainting_models(model_names)
+        ):
+            features |= cls.IMAGE_INPAINTING
+        if not model_reference.has_only_inpainting_models(model_names):
+            features |= cls.IMAGE_NOT_ONLY_INPAINTING
+        if worker.allow_post_processing and check_bridge_capability("post-processing", worker.bridge_agent):
+            features |= cls.IMAGE_POST_PROCESSING
+        if check_bridge_capability("tiling", worker.bridge_agent):
+            features |= cls.IMAGE_TILING
+        if check_bridge_capability("return_control_map", worker.bridge_agent):
+            features |= cls.IMAGE_RETURN_CONTROL_MAP
+        if (
+            worker.allow_controlnet
+            and check_bridge_capability("controlnet", worker.bridge_agent)
+            and check_bridge_capability("image_is_control", worker.bridge_agent)
+        ):
+            features |= cls.IMAGE_CONTROLNET
+        if (
+            check_bridge_capability("controlnet", worker.bridge_agent)
+            and check_bridge_capability("qr_code", worker.bridge_agent)
+            and ("stable_diffusion_xl" not in baselines or worker.allow_sdxl_controlnet)
+        ):
+            features |= cls.IMAGE_QR_CODE
+        if check_bridge_capability("hires_fix", worker.bridge_agent) and (
+            "stable_cascade" not in baselines or check_bridge_capability("stable_cascade_2pass", worker.bridge_agent)
+        ):
+            features |= cls.IMAGE_HIRES_FIX
+        if check_bridge_capability("clip_skip", worker.bridge_agent):
+            features |= cls.IMAGE_CLIP_SKIP
+        if check_bridge_capability("lora_versions", worker.bridge_agent):
+            features |= cls.IMAGE_LORA_VERSIONS
+        return features
+
+    @classmethod
+    def get_image_wp_requirements(cls, wp):
+        """Returns what ImageWorker.can_generate() needs from a worker on top of the pop filters"""
+        params = wp.params or {}
+        gen_payload = wp.gen_payload or {}
+        features = cls.IMAGE_SUPPORTED_MODELS
+        if wp.source_image:
+            features |= cls.IMAGE_IMG2IMG
+        if wp.source_processing in ["inpainting", "outpainting"]:
+            features |= cls.IMAGE_INPAINTING
+        else:
+            # This also covers can_generate() skipping txt2img for workers serving only "stable_diffusion_inpainting",
+            # as the model reference marks it as an inpainting model
+            features |= cls.IMAGE_NOT_ONLY_INPAINTING
+        post_processing = gen_payload.get("post_processing", [])
+        if len(post_processing) >= 1:
+            features |= cls.IMAGE_POST_PROCESSING
+        if params.get("tiling"):
+            features |= cls.IMAGE_TILING
+        if params.get("return_control_map"):
+            features |= cls.IMAGE_RETURN_CONTROL_MAP
+        if params.get("control_type"):
+            features |= cls.IMAGE_CONTROLNET
+        if params.get("workflow") == "qr_code":
+            features |= cls.IMAGE_QR_CODE
+        if params.get("hires_fix"):
+            features |= cls.IMAGE_HIRES_FIX
+        if params.get("clip_skip", 1) > 1:
+            features |= cls.IMAGE_CLIP_SKIP
+        if any(lora.get("is_version") for lora in params.get("loras", [])):
+            features |= cls.IMAGE_LORA_VERSIONS
+        return {
+            "features": features,
+            "sampler": [gen_payload.get("sampler_name", "k_euler_a"), gen_payload.get("karras", False)],
+            "post_processors": [pp for pp in post_processing if pp in KNOWN_POST_PROCESSORS],
+            # Untrusted workers don't get generations from unsafe IPs, unless the user is trusted
+            "untrusted_workers": wp.safe_ip or wp.user.trusted,
+        }
+
+    @classmethod
+    def get_worker_limits(cls, wp_type, worker):
+        if wp_type == "image":
+            return [worker.max_pixels]
+        return [worker.max_length, worker.max_context_length]
+
+    @classmethod
+    def get_wp_requirements(cls, wp):
+        """Returns what a worker needs to be able to serve this WP, in a form that can be stored as json"""
+        if wp.wp_type == "image":
+            required = ImageWPMatchIndex.get_required_capabilities(wp)
+            limits = [wp.width * wp.height]
+            type_requirements = cls.get_image_wp_requirements(wp)
+        else:
+            required = 0
+            if wp.nsfw:
+                required |= cls.TEXT_NSFW
+            if not wp.safe_ip:
+                required |= cls.TEXT_UNSAFE_IP
+            if not wp.slow_workers:
+                required |= cls.TEXT_FAST_WORKER
+            if wp.validated_backends:
+                required |= cls.TEXT_VALIDATED_BACKEND
+            limits = [wp.max_length, wp.max_context_length]
+            type_requirements = {"softprompt": wp.softprompt}
+        return {
+            "required": required,
+            "limits": limits,
+            "models": wp.get_model_names(),
+            "workers": [str(worker_id) for worker_id in wp.get_worker_ids()],
+            "worker_blacklist": wp.worker_blacklist,
+            "trusted_workers": wp.trusted_workers,
+            "user_id": wp.user_id,
+            "tricked_workers": [str(tricked_worker.worker_id) for tricked_worker in wp.tricked_workers],
+            **type_requirements,
+        }
+
+    def has_valid_worker(self, requirements):
+        """Returns True if any of the workers can serve a WP with these requirements
+        Returns None if only workers we couldn't summarize might, in which case the WP needs to be checked against the DB
+        """
+        if len(requirements["models"]) == 0:
+            positions = range(len(self.workers))
+        else:
+            positions = {position for model_name in requirements["models"] for position in self.model_map.get(model_name, [])}
+        targeted_workers = set(requirements["workers"])
+        tricked_workers = set(requirements.get("tricked_workers", []))
+        needs_db_check = False
+        for position in positions:
+            worker = self.workers[position]
+            if any(wp_limit > worker_limit for wp_limit, worker_limit in zip(requirements["limits"], worker["limits"])):
+                continue
+            if requirements["required"] & ~worker["capabilities"]:
+                continue
+            if requirements["trusted_workers"] and not worker["trusted"]:
+                continue
+            # Workers in maintenance or paused only serve their owner
+            if worker["owner_only"] and worker["user_id"] != requirements["user_id"]:
+                continue
+            if targeted_workers and (worker["id"] in targeted_workers) == requirements["worker_blacklist"]:
+                continue
+            if worker["id"] in tricked_workers:
+                continue
+            if requirements.get("features", 0) & ~worker["features"]:
+                continue
+            if "sampler" in requirements and not check_sampler_capability(
+                requirements["sampler"][0],
+                worker["bridge_agent"],
+                requirements["sampler"][1],
+            ):
+                continue
+            if any(not check_bridge_capability(pp, worker["bridge_agent"]) for pp in requirements.get("post_processors", [])):
+                continue
+            if not requirements.get("untrusted_workers", True) and not worker["trusted"]:
+                continue
+            if requirements.get("softprompt") and requirements["softprompt"] not in worker["softprompts"]:
+                continue
+            if worker["needs_db_check"]:
+                needs_db_check = True
+                continue
+            return True
+        return None if needs_db_check else False
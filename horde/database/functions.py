@@ -4,12 +4,13 @@
 
 import json
 import os
+import threading
 import time
 import urllib.parse
 import uuid
 from datetime import datetime, timedelta
 
-from sqlalchemy import Boolean, and_, func, not_, or_
+from sqlalchemy import Boolean, Float, and_, cast, column, func, not_, or_, update, values
 from sqlalchemy.orm import noload
 
 import horde.classes.base.stats as stats
@@ -20,23 +21,35 @@ from horde.bridge_reference import (
 )
 from horde.classes.base.detection import Filter
 from horde.classes.base.style import Style, StyleCollection, StyleModel, StyleTag
-from horde.classes.base.user import KudosTransferLog, User, UserRecords, UserSharedKey
+from horde.classes.base.team import Team
+from horde.classes.base.user import KudosTransferLog, User, UserRecords, UserRole, UserSharedKey, UserStats
 from horde.classes.base.waiting_prompt import WPAllowedWorkers, WPModels
-from horde.classes.base.worker import WorkerMessage, WorkerModel, WorkerPerformance
+from horde.classes.base.worker import (
+    WorkerBlackList,
+    WorkerMessage,
+    WorkerModel,
+    WorkerPerformance,
+    WorkerStats,
+    WorkerSuspicions,
+    WorkerTemplate,
+)
 from horde.classes.kobold.processing_generation import TextProcessingGeneration
 from horde.classes.kobold.waiting_prompt import TextWaitingPrompt
-from horde.classes.kobold.worker import TextWorker
+from horde.classes.kobold.worker import TextWorker, TextWorkerSoftprompts
 from horde.classes.stable.interrogation import Interrogation, InterrogationForms
-from horde.classes.stable.interrogation_worker import InterrogationWorker
+from horde.classes.stable.interrogation_worker import InterrogationWorker, WorkerInterrogationForm
 from horde.classes.stable.processing_generation import ImageProcessingGeneration
 from horde.classes.stable.waiting_prompt import ImageWaitingPrompt
 from horde.classes.stable.worker import ImageWorker
-from horde.database.classes import FakeWPRow
-from horde.enums import State
+from horde.database.classes import FakeWPRow, ImageWPMatchIndex, WorkerCapabilityIndex, WPQueueIndex
+from horde.enums import State, UserRecordTypes, UserRoleTypes
 from horde.flask import SQLITE_MODE, db
+from horde.horde_redis import datetime_json_converter
 from horde.horde_redis import horde_redis as hr
 from horde.logger import logger
 from horde.model_reference import model_reference
+from horde.queue_stats import get_model_queue_stats
+from horde.stats_ledger import get_pending_deltas_bulk
 from horde.utils import hash_api_key, validate_regex
 
 ALLOW_ANONYMOUS = True
@@ -49,6 +62,18 @@ WP_CLASS_MAP = {
     "image": ImageWaitingPrompt,
     "text": TextWaitingPrompt,
 }
+# Each node keeps its own decoded copy of the image WP match index
+# and only rebuilds it when the primary stores a different version
+wp_match_index_lock = threading.Lock()
+wp_match_index = {
+    "version": None,
+    "index": None,
+}
+# Each node also keeps the decoded WP queue per wp_type, along with the cached value it was decoded from
+wp_queue_indexes = {}
+# And the decoded worker capability summary per wp_type, along with its version
+worker_capability_index_lock = threading.Lock()
+worker_capability_indexes = {}
 
 
 def get_anon():
@@ -99,6 +124,135 @@ def get_active_workers(worker_type=None):
     return active_workers
 
 
+def group_rows_by_worker(rows):
+    """Groups (worker_id, value) rows into a dict of worker_id -> list of values"""
+    grouped = {}
+    for worker_id, value in rows:
+        grouped.setdefault(worker_id, []).append(value)
+    return grouped
+
+
+def serialize_active_workers():
+    """Serializes the details of all active workers for both the public and the privileged workers list
+    Instead of loading every worker through the ORM and calling get_details() on it, which lazy-loads
+    each relationship one worker at a time, we fetch only the columns we need and every related table
+    in one set-based query each, then write the json for both privilege levels in the same pass.
+    The details themselves are formatted by the same classmethods that get_details() uses.
+    Returns the json strings for details_privilege 0 and 2
+    """
+    workers_table = WorkerTemplate.__table__
+    worker_rows = db.session.execute(
+        db.select(workers_table).where(workers_table.c.last_check_in > datetime.utcnow() - timedelta(seconds=300)),
+    ).all()
+    # We keep the same order as get_active_workers()
+    worker_type_order = {"stable_worker": 0, "text_worker": 1, "interrogation_worker": 2}
+    worker_rows = sorted(
+        [w for w in worker_rows if w.worker_type in worker_type_order],
+        key=lambda w: worker_type_order[w.worker_type],
+    )
+    worker_ids = [w.id for w in worker_rows]
+    user_ids = {w.user_id for w in worker_rows}
+    team_ids = {w.team_id for w in worker_rows if w.team_id is not None}
+    users = {
+        u.id: u for u in db.session.query(User.id, User.username, User.contact, User.public_workers).filter(User.id.in_(user_ids)).all()
+    }
+    # Same as User.trusted and User.flagged, which look at the first matching role
+    user_roles = {}
+    for role in (
+        db.session.query(UserRole.user_id, UserRole.user_role, UserRole.value)
+        .filter(
+            UserRole.user_id.in_(user_ids),
+            UserRole.user_role.in_([UserRoleTypes.TRUSTED, UserRoleTypes.FLAGGED]),
+        )
+        .order_by(UserRole.id)
+        .all()
+    ):
+        user_roles.setdefault((role.user_id, role.user_role), role.value)
+    teams = {t.id: t.name for t in db.session.query(Team.id, Team.name).filter(Team.id.in_(team_ids)).all()}
+    kudos_details = {}
+    for stat in (
+        db.session.query(WorkerStats.worker_id, WorkerStats.action, WorkerStats.value).filter(WorkerStats.worker_id.in_(worker_ids)).all()
+    ):
+        kudos_details.setdefault(stat.worker_id, {})[stat.action] = stat.value
+    for worker_id, pending in get_pending_deltas_bulk("worker_stats", worker_ids).items():
+        worker_kudos_details = kudos_details.setdefault(worker_id, {})
+        for action, delta in pending.items():
+            worker_kudos_details[action] = round(worker_kudos_details.get(action, 0) + delta, 2)
+    suspicions = dict(
+        db.session.query(WorkerSuspicions.worker_id, func.count(WorkerSuspicions.id))
+        .filter(WorkerSuspicions.worker_id.in_(worker_ids))
+        .group_by(WorkerSuspicions.worker_id)
+        .all(),
+    )
+    messages = group_rows_by_worker(
+        (m.worker_id, m)
+        for m in db.session.query(WorkerMessage)
+        .filter(
+            WorkerMessage.worker_id.in_(worker_ids),
+            WorkerMessage.expiry > datetime.utcnow(),
+        )
+        .all()
+    )
+    models = group_rows_by_worker(
+        db.session.query(WorkerModel.worker_id, WorkerModel.model).filter(WorkerModel.worker_id.in_(worker_ids)).all(),
+    )
+    forms = group_rows_by_worker(
+        db.session.query(WorkerInterrogationForm.worker_id, WorkerInterrogationForm.form)
+        .filter(WorkerInterrogationForm.worker_id.in_(worker_ids))
+        .distinct()
+        .all(),
+    )
+    serialized_workers = []
+    serialized_workers_privileged = []
+    for w in worker_rows:
+        worker_class = WorkerTemplate.__mapper__.polymorphic_map[w.worker_type].class_
+        user = users[w.user_id]
+        related = {
+            "user": user,
+            "trusted": user_roles.get((w.user_id, UserRoleTypes.TRUSTED), False),
+            "flagged": user_roles.get((w.user_id, UserRoleTypes.FLAGGED), False),
+            "team_name": teams.get(w.team_id),
+            "kudos_details": kudos_details.get(w.id, {}),
+            "suspicious": suspicions.get(w.id, 0),
+            "messages": messages.get(w.id, []),
+        }
+        type_details = worker_class.format_type_details(w, (forms if worker_class.wtype == "interrogation" else models).get(w.id, []))
+        details = worker_class.format_details(w, 0, **related)
+        details.update(type_details)
+        privileged_details = worker_class.format_details(w, 2, **related)
+        privileged_details.update(type_details)
+        serialized_workers.append(json.dumps(details, default=datetime_json_converter))
+        serialized_workers_privileged.append(json.dumps(privileged_details, default=datetime_json_converter))
+    return f"[{', '.join(serialized_workers)}]", f"[{', '.join(serialized_workers_privileged)}]"
+
+
+def wp_needs_base64_source(wp):
+    """Returns True if any active worker which could pick up this img2img WP can't download its source images from R2
+    Only those bridges receive the source images as base64, so only then is it worth transcoding them in advance
+    """
+    models_list = wp.get_model_names()
+    bridge_agents = (
+        db.session.query(ImageWorker.bridge_agent)
+        .outerjoin(
+            WorkerModel,
+        )
+        .filter(
+            ImageWorker.last_check_in > datetime.utcnow() - timedelta(seconds=300),
+            ImageWorker.allow_img2img == True,  # noqa E712
+            or_(
+                len(models_list) == 0,
+                WorkerModel.model.in_(models_list),
+            ),
+        )
+        .distinct()
+        .all()
+    )
+    return any(
+        check_bridge_capability("img2img", bridge_agent) and not check_bridge_capability("r2_source", bridge_agent)
+        for (bridge_agent,) in bridge_agents
+    )
+
+
 def count_active_workers(worker_class="image"):
     worker_cache = hr.horde_r_get_json(f"count_active_workers_{worker_class}")
     if worker_cache:
@@ -275,6 +429,7 @@ def get_available_models(filter_model_name: str = None):
         # e.g., `aphrodite%2FNeverSleep%2FNoromaid-13b-v0.3` will become `aphrodite/NeverSleep/Noromaid-13b-v0.3`.
         filter_model_name = urllib.parse.unquote(filter_model_name)
 
+    model_avgs = stats.get_all_model_avgs()
     for model_type, worker_class, wp_class, procgen_class in [
         ("image", ImageWorker, ImageWaitingPrompt, ImageProcessingGeneration),
         ("text", TextWorker, TextWaitingPrompt, TextProcessingGeneration),
@@ -323,7 +478,7 @@ def get_available_models(filter_model_name: str = None):
             models_dict[model_name]["queued"] = 0
             models_dict[model_name]["jobs"] = 0
             models_dict[model_name]["eta"] = 0
-            models_dict[model_name]["performance"] = stats.get_model_avg(model_name)
+            models_dict[model_name]["performance"] = model_avgs.get(model_name, 0)
             models_dict[model_name]["workers"] = []
 
         known_models = [filter_model_name] if filter_model_name else list(model_reference.stable_diffusion_names)
@@ -351,7 +506,7 @@ def get_available_models(filter_model_name: str = None):
             models_dict[model_name]["jobs"] = 0
             models_dict[model_name]["type"] = model_type
             models_dict[model_name]["eta"] = 0
-            models_dict[model_name]["performance"] = stats.get_model_avg(model_name)
+            models_dict[model_name]["performance"] = model_avgs.get(model_name, 0)
             models_dict[model_name]["workers"] = []
         if filter_model_name:
             things_per_model, jobs_per_model = count_things_for_specific_model(
@@ -360,7 +515,7 @@ def get_available_models(filter_model_name: str = None):
                 filter_model_name,
             )
         else:
-            things_per_model, jobs_per_model = count_things_per_model(wp_class)
+            things_per_model, jobs_per_model = retrieve_things_per_model(model_type, wp_class)
         # If we request a lite_dict, we only want worker count per model and a dict format
         for model_name in things_per_model:
             # This shouldn't happen, but I'm checking anyway
@@ -368,7 +523,7 @@ def get_available_models(filter_model_name: str = None):
                 # logger.debug(f"Tried to match non-existent wp model {model_name} to worker models. Skipping.")
                 continue
             models_dict[model_name]["queued"] = things_per_model[model_name]
-            models_dict[model_name]["jobs"] = jobs_per_model[model_name]
+            models_dict[model_name]["jobs"] = jobs_per_model.get(model_name, 0)
             total_performance_on_model = models_dict[model_name]["count"] * models_dict[model_name]["performance"]
             # We don't want a division by zero when there's no workers for this model.
             if total_performance_on_model > 0:
@@ -732,6 +887,64 @@ def count_things_per_model(wp_class):
     return things_per_model, jobs_per_model
 
 
+def retrieve_things_per_model(wp_type, wp_class):
+    """Reads the queued things and jobs per model from the incrementally maintained counters
+    Falls back to counting them from the DB when they're not available
+    """
+    model_queue_stats = get_model_queue_stats(wp_type)
+    if model_queue_stats is None:
+        return count_things_per_model(wp_class)
+    return model_queue_stats
+
+
+def query_wp_queue_contributions(wp_class, procgen_class):
+    """Calculates what each queued WP contributes to the per-model queue stats, with a single query
+    Returns a dict of wp_id -> (models, jobs, things)
+    """
+    processing_gens = (
+        db.session.query(
+            procgen_class.wp_id,
+            func.count(procgen_class.id).label("processing"),
+        )
+        .filter(
+            procgen_class.fake.is_(False),
+            procgen_class.faulted.is_(False),
+            procgen_class.generation.is_(None),
+        )
+        .group_by(procgen_class.wp_id)
+        .subquery()
+    )
+    wp_rows = (
+        db.session.query(
+            wp_class.id,
+            wp_class.n,
+            wp_class.things,
+            WPModels.model,
+            func.coalesce(processing_gens.c.processing, 0).label("processing"),
+        )
+        .join(
+            WPModels,
+        )
+        .outerjoin(
+            processing_gens,
+            processing_gens.c.wp_id == wp_class.id,
+        )
+        .filter(
+            wp_class.active == True,  # noqa E712
+            wp_class.faulted == False,  # noqa E712
+            wp_class.n >= 1,
+        )
+        .all()
+    )
+    contributions = {}
+    for wp_row in wp_rows:
+        if wp_row.id not in contributions:
+            contributions[wp_row.id] = ([], wp_row.n + wp_row.processing, wp_row.things)
+        if "horde_special" not in wp_row.model:
+            contributions[wp_row.id][0].append(wp_row.model)
+    return contributions
+
+
 def count_things_for_specific_model(wp_class, procgen_class, model_name):
     things = {model_name: 0}
     jobs = {model_name: 0}
@@ -779,11 +992,56 @@ def count_things_for_specific_model(wp_class, procgen_class, model_name):
 
 
 @logger.catch(reraise=True)
-def get_sorted_wp_filtered_to_worker(worker, models_list=None, blacklist=None, priority_user_ids=None, page=0):
+def get_sorted_wp_filtered_to_worker(worker, models_list=None, blacklist=None, priority_user_ids=None, page=0, candidates=None):
     # This is just the top 3 - Adjusted method to send ImageWorker object. Filters to add.
     # TODO: Filter by ImageWorker not in WP.tricked_worker
     # TODO: If any word in the prompt is in the WP.blacklist rows, then exclude it (L293 in base.worker.ImageWorker.gan_generate())
     PER_PAGE = 3  # how many requests we're picking up to filter further
+    if models_list is None:
+        models_list = []
+    match_index = retrieve_image_wp_match_index()
+    if match_index is not None:
+        # The caller keeps the candidates between the pages of the same pop, along with how far down the list it got,
+        # so that every candidate is sent to the DB exactly once
+        if candidates is None:
+            candidates = {}
+        if "ids" not in candidates:
+            candidates["ids"] = match_index.get_candidate_ids(
+                worker,
+                ImageWPMatchIndex.get_worker_capabilities(worker),
+                models_list,
+                priority_user_ids=priority_user_ids,
+                require_matched_targeting=os.getenv("HORDE_REQUIRE_MATCHED_TARGETING", "0") == "1",
+            )
+            candidates["position"] = 0
+        candidate_ids = candidates["ids"]
+        # The index might be up to a couple of seconds old, so we only trust it to tell us where to look.
+        # The DB still has the final say on whether the WP can still be picked up, and locks it for us.
+        # The candidates are in priority order, so we only send the DB the next few of them,
+        # and only look at bigger windows when those were all picked up or locked by other pops.
+        window_size = PER_PAGE
+        while candidates["position"] < len(candidate_ids):
+            window = candidate_ids[candidates["position"] : candidates["position"] + window_size]
+            candidates["position"] += len(window)
+            wp_list = (
+                db.session.query(ImageWaitingPrompt)
+                .options(noload(ImageWaitingPrompt.processing_gens))
+                .filter(
+                    ImageWaitingPrompt.id.in_(window),
+                    ImageWaitingPrompt.n > 0,
+                    ImageWaitingPrompt.active == True,  # noqa E712
+                    ImageWaitingPrompt.faulted == False,  # noqa E712
+                    ImageWaitingPrompt.expiry > datetime.utcnow(),
+                )
+                .populate_existing()
+                .with_for_update(skip_locked=True, of=ImageWaitingPrompt)
+                .all()
+            )
+            if len(wp_list) > 0:
+                window_positions = {str(wp_id): position for position, wp_id in enumerate(window)}
+                return sorted(wp_list, key=lambda wp: window_positions[str(wp.id)])
+            window_size = min(window_size * 2, PER_PAGE * 10)
+        return []
     final_wp_list = (
         db.session.query(ImageWaitingPrompt)
         .options(noload(ImageWaitingPrompt.processing_gens))
@@ -939,110 +1197,42 @@ def get_sorted_wp_filtered_to_worker(worker, models_list=None, blacklist=None, p
 
 
 def count_skipped_image_wp(worker, models_list=None, blacklist=None, priority_user_ids=None):
-    ## FIXME: Massively costly approach, doing 1 new query per count. Not sure about it.
-    ret_dict = {}
-    open_wp_list = (
-        db.session.query(ImageWaitingPrompt)
-        .options(noload(ImageWaitingPrompt.processing_gens))
-        .outerjoin(WPModels, ImageWaitingPrompt.id == WPModels.wp_id)
-        .outerjoin(WPAllowedWorkers, ImageWaitingPrompt.id == WPAllowedWorkers.wp_id)
-        .filter(
-            ImageWaitingPrompt.n > 0,
-            ImageWaitingPrompt.active == True,  # noqa E712
-            ImageWaitingPrompt.faulted == False,  # noqa E712
-            ImageWaitingPrompt.expiry > datetime.utcnow(),
-        )
+    """Counts how many open WPs this worker skipped, per reason
+    All the reasons are counted together in a single aggregate query, with a COUNT FILTER per reason.
+    """
+    # Each count only gets added when it's relevant for this worker
+    # Then we run them all in a single pass over the queue
+    skip_counts = {}
+    skip_counts["models"] = and_(
+        WPModels.model.not_in(models_list),
+        WPModels.id != None,  # noqa E712
     )
-    skipped_models = open_wp_list.filter(
+    skip_counts["worker_id"] = or_(
+        WPAllowedWorkers.id != None,  # noqa E712
         and_(
-            WPModels.model.not_in(models_list),
-            WPModels.id != None,  # noqa E712
+            ImageWaitingPrompt.worker_blacklist.is_(False),
+            WPAllowedWorkers.worker_id != worker.id,
         ),
-    ).count()
-    if skipped_models > 0:
-        ret_dict["models"] = skipped_models
-    skipped_workers = open_wp_list.filter(
-        or_(
-            WPAllowedWorkers.id != None,  # noqa E712
-            and_(
-                ImageWaitingPrompt.worker_blacklist.is_(False),
-                WPAllowedWorkers.worker_id != worker.id,
-            ),
-            and_(
-                ImageWaitingPrompt.worker_blacklist.is_(True),
-                WPAllowedWorkers.worker_id == worker.id,
-            ),
+        and_(
+            ImageWaitingPrompt.worker_blacklist.is_(True),
+            WPAllowedWorkers.worker_id == worker.id,
         ),
-    ).count()
-    if skipped_workers > 0:
-        ret_dict["worker_id"] = skipped_workers
-    max_pixels = open_wp_list.filter(
-        ImageWaitingPrompt.width * ImageWaitingPrompt.height >= worker.max_pixels,
-    ).count()
-    # Count skipped max pixels
-    if max_pixels > 0:
-        ret_dict["max_pixels"] = max_pixels
-    # Count skipped img2img
+    )
+    skip_counts["max_pixels"] = ImageWaitingPrompt.width * ImageWaitingPrompt.height >= worker.max_pixels
     if worker.allow_img2img is False or not check_bridge_capability("img2img", worker.bridge_agent):
-        skipped_wps = open_wp_list.filter(
-            ImageWaitingPrompt.source_image != None,  # noqa E712
-        ).count()
-        if skipped_wps > 0:
-            if worker.allow_img2img is False:
-                ret_dict["img2img"] = skipped_wps
-            else:
-                ret_dict["bridge_version"] = ret_dict.get("bridge_version", 0) + skipped_wps
-    # Count skipped inpainting
+        skip_counts["img2img"] = ImageWaitingPrompt.source_image != None  # noqa E712
     if worker.allow_painting is False or not check_bridge_capability("inpainting", worker.bridge_agent):
-        skipped_wps = open_wp_list.filter(
-            ImageWaitingPrompt.source_processing.in_(["inpainting", "outpainting"]),
-        ).count()
-        if skipped_wps > 0:
-            if worker.allow_painting is False:
-                ret_dict["painting"] = skipped_wps
-            else:
-                ret_dict["bridge_version"] = ret_dict.get("bridge_version", 0) + skipped_wps
-    # Count skipped unsafe ips
+        skip_counts["painting"] = ImageWaitingPrompt.source_processing.in_(["inpainting", "outpainting"])
     if worker.allow_unsafe_ipaddr is False:
-        skipped_wps = open_wp_list.filter(
-            ImageWaitingPrompt.safe_ip == False,  # noqa E712
-        ).count()
-        if skipped_wps > 0:
-            ret_dict["unsafe_ip"] = skipped_wps
-    # Count skipped nsfw
+        skip_counts["unsafe_ip"] = ImageWaitingPrompt.safe_ip == False  # noqa E712
     if worker.nsfw is False:
-        skipped_wps = open_wp_list.filter(
-            ImageWaitingPrompt.nsfw == True,  # noqa E712
-        ).count()
-        if skipped_wps > 0:
-            ret_dict["nsfw"] = skipped_wps
-    # Count skipped lora
+        skip_counts["nsfw"] = ImageWaitingPrompt.nsfw == True  # noqa E712
     if worker.allow_lora is False or not check_bridge_capability("lora", worker.bridge_agent):
-        skipped_wps = open_wp_list.filter(
-            ImageWaitingPrompt.params.has_key("loras"),
-        ).count()
-        if skipped_wps > 0:
-            if worker.allow_lora is False:
-                ret_dict["lora"] = skipped_wps
-            else:
-                ret_dict["bridge_version"] = ret_dict.get("bridge_version", 0) + skipped_wps
-    # Count skipped TI
+        skip_counts["lora"] = ImageWaitingPrompt.params.has_key("loras")
     if not check_bridge_capability("textual_inversion", worker.bridge_agent):
-        skipped_wps = open_wp_list.filter(
-            ImageWaitingPrompt.params.has_key("tis"),
-        ).count()
-        if skipped_wps > 0:
-            ret_dict["bridge_version"] = ret_dict.get("bridge_version", 0) + skipped_wps
-    # Count skipped PP
+        skip_counts["tis"] = ImageWaitingPrompt.params.has_key("tis")
     if worker.allow_post_processing is False or not check_bridge_capability("post-processing", worker.bridge_agent):
-        skipped_wps = open_wp_list.filter(
-            ImageWaitingPrompt.params.has_key("post-processing"),
-        ).count()
-        if skipped_wps > 0:
-            if worker.allow_post_processing is False:
-                ret_dict["post-processing"] = skipped_wps
-            else:
-                ret_dict["bridge_version"] = ret_dict.get("bridge_version", 0) + skipped_wps
+        skip_counts["post-processing"] = ImageWaitingPrompt.params.has_key("post-processing")
     # TODO: Figure this out.
     # Can't figure out how to check to do something like any(pp not in available_pp for pp in params['post-processing'])
     # else:
@@ -1054,66 +1244,93 @@ def count_skipped_image_wp(worker, models_list=None, blacklist=None, priority_us
     #     if skipped_wps > 0:
     #         ret_dict["bridge_version"] = ret_dict.get("bridge_version",0) + skipped_wps
     if worker.allow_controlnet is False or not check_bridge_capability("controlnet", worker.bridge_agent):
-        skipped_wps = open_wp_list.filter(
-            ImageWaitingPrompt.params.has_key("control_type"),
-        ).count()
-        if worker.allow_controlnet is False:
-            ret_dict["controlnet"] = skipped_wps
-        else:
-            ret_dict["bridge_version"] = ret_dict.get("bridge_version", 0) + skipped_wps
+        skip_counts["controlnet"] = ImageWaitingPrompt.params.has_key("control_type")
     # Count skipped request for fast workers
     if worker.speed <= 500000:  # 0.5 MPS/s
-        skipped_wps = open_wp_list.filter(
-            ImageWaitingPrompt.slow_workers == False,  # noqa E712
-        ).count()
-        if skipped_wps > 0:
-            ret_dict["performance"] = skipped_wps
+        skip_counts["slow_workers"] = ImageWaitingPrompt.slow_workers == False  # noqa E712
     if worker.extra_slow_worker is True:
-        skipped_wps = open_wp_list.filter(
-            ImageWaitingPrompt.extra_slow_workers == False,  # noqa E712
-        ).count()
-        if skipped_wps > 0:
-            ret_dict["performance"] = ret_dict.get("performance", 0) + skipped_wps
+        skip_counts["extra_slow_workers"] = ImageWaitingPrompt.extra_slow_workers == False  # noqa E712
     # Count skipped WPs requiring trusted workers
     if worker.user.trusted is False:
-        skipped_wps = open_wp_list.filter(
-            ImageWaitingPrompt.trusted_workers == True,  # noqa E712
-        ).count()
-        if skipped_wps > 0:
-            ret_dict["untrusted"] = skipped_wps
+        skip_counts["untrusted"] = ImageWaitingPrompt.trusted_workers == True  # noqa E712
     available_samplers = get_supported_samplers(worker.bridge_agent, karras=False)
     available_karras_samplers = get_supported_samplers(worker.bridge_agent, karras=True)
     # TODO: Add the rest of the bridge_version checks.
-    skipped_bv = open_wp_list.filter(
-        or_(
-            and_(
-                ImageWaitingPrompt.params["sampler_name"].astext.not_in(available_samplers),
-                ImageWaitingPrompt.params["karras"].astext.cast(Boolean).is_(False),
-            ),
-            and_(
-                ImageWaitingPrompt.params["sampler_name"].astext.not_in(available_karras_samplers),
-                ImageWaitingPrompt.params["karras"].astext.cast(Boolean).is_(True),
-            ),
-            and_(
-                not check_bridge_capability("hires_fix", worker.bridge_agent),
-                ImageWaitingPrompt.params["hires_fix"].astext.cast(Boolean).is_(True),
-            ),
-            and_(
-                not check_bridge_capability("return_control_map", worker.bridge_agent),
-                ImageWaitingPrompt.params["return_control_map"].astext.cast(Boolean).is_(True),
-            ),
-            and_(
-                not check_bridge_capability("tiling", worker.bridge_agent),
-                ImageWaitingPrompt.params["tiling"].astext.cast(Boolean).is_(True),
-            ),
-            and_(
-                not check_bridge_capability("layer_diffuse", worker.bridge_agent),
-                ImageWaitingPrompt.params["transparent"].astext.cast(Boolean).is_(True),
-            ),
+    skip_counts["bridge_version"] = or_(
+        and_(
+            ImageWaitingPrompt.params["sampler_name"].astext.not_in(available_samplers),
+            ImageWaitingPrompt.params["karras"].astext.cast(Boolean).is_(False),
         ),
-    ).count()
-    if skipped_bv > 0:
-        ret_dict["bridge_version"] = ret_dict.get("bridge_version", 0) + skipped_bv
+        and_(
+            ImageWaitingPrompt.params["sampler_name"].astext.not_in(available_karras_samplers),
+            ImageWaitingPrompt.params["karras"].astext.cast(Boolean).is_(True),
+        ),
+        and_(
+            not check_bridge_capability("hires_fix", worker.bridge_agent),
+            ImageWaitingPrompt.params["hires_fix"].astext.cast(Boolean).is_(True),
+        ),
+        and_(
+            not check_bridge_capability("return_control_map", worker.bridge_agent),
+            ImageWaitingPrompt.params["return_control_map"].astext.cast(Boolean).is_(True),
+        ),
+        and_(
+            not check_bridge_capability("tiling", worker.bridge_agent),
+            ImageWaitingPrompt.params["tiling"].astext.cast(Boolean).is_(True),
+        ),
+        and_(
+            not check_bridge_capability("layer_diffuse", worker.bridge_agent),
+            ImageWaitingPrompt.params["transparent"].astext.cast(Boolean).is_(True),
+        ),
+    )
+    count_names = list(skip_counts)
+    counts_row = (
+        db.session.query(*[func.count().filter(skip_counts[count_name]).label(count_name) for count_name in count_names])
+        .select_from(ImageWaitingPrompt)
+        .outerjoin(WPModels, ImageWaitingPrompt.id == WPModels.wp_id)
+        .outerjoin(WPAllowedWorkers, ImageWaitingPrompt.id == WPAllowedWorkers.wp_id)
+        .filter(
+            ImageWaitingPrompt.n > 0,
+            ImageWaitingPrompt.active == True,  # noqa E712
+            ImageWaitingPrompt.faulted == False,  # noqa E712
+            ImageWaitingPrompt.expiry > datetime.utcnow(),
+        )
+        .one()
+    )
+    counts = dict(zip(count_names, counts_row))
+    ret_dict = {}
+    for key in ["models", "worker_id", "max_pixels"]:
+        if counts[key] > 0:
+            ret_dict[key] = counts[key]
+    # For the capabilities the worker disabled, we report them by name
+    # But if the worker allowed them and they were skipped, it's because its bridge doesn't support them yet
+    for key, worker_allowed in [
+        ("img2img", worker.allow_img2img),
+        ("painting", worker.allow_painting),
+        ("lora", worker.allow_lora),
+        ("post-processing", worker.allow_post_processing),
+    ]:
+        if counts.get(key, 0) > 0:
+            if worker_allowed is False:
+                ret_dict[key] = counts[key]
+            else:
+                ret_dict["bridge_version"] = ret_dict.get("bridge_version", 0) + counts[key]
+    for key in ["unsafe_ip", "nsfw"]:
+        if counts.get(key, 0) > 0:
+            ret_dict[key] = counts[key]
+    if counts.get("tis", 0) > 0:
+        ret_dict["bridge_version"] = ret_dict.get("bridge_version", 0) + counts["tis"]
+    if "controlnet" in counts:
+        if worker.allow_controlnet is False:
+            ret_dict["controlnet"] = counts["controlnet"]
+        else:
+            ret_dict["bridge_version"] = ret_dict.get("bridge_version", 0) + counts["controlnet"]
+    for key in ["slow_workers", "extra_slow_workers"]:
+        if counts.get(key, 0) > 0:
+            ret_dict["performance"] = ret_dict.get("performance", 0) + counts[key]
+    if counts.get("untrusted", 0) > 0:
+        ret_dict["untrusted"] = counts["untrusted"]
+    if counts["bridge_version"] > 0:
+        ret_dict["bridge_version"] = ret_dict.get("bridge_version", 0) + counts["bridge_version"]
     # TODO: Will need some sql function to be able to calculate this one demand
     # skipped_kudos = open_wp_list.filter(
     # ).count()
@@ -1189,26 +1406,14 @@ def get_sorted_forms_filtered_to_worker(worker, forms_list=None, priority_user_i
 def get_wp_queue_stats(wp):
     if not wp.needs_gen():
         return (-1, 0, 0)
-    things_ahead_in_queue = 0
-    n_ahead_in_queue = 0
-    priority_sorted_list = retrieve_prioritized_wp_queue(wp.wp_type)
+    wp_queue_index = retrieve_wp_queue_index(wp.wp_type)
     # In case the primary thread has borked, we fall back to the DB
-    if priority_sorted_list is None:
+    if wp_queue_index is None:
         logger.warning(
             "Cached WP priority query does not exist. Falling back to direct DB query. Please check thread on primary!",
         )
-        priority_sorted_list = query_prioritized_wps(wp.wp_type)
-    # logger.info(priority_sorted_list)
-    for riter in range(len(priority_sorted_list)):
-        iter_wp = priority_sorted_list[riter]
-        queued_things = round(iter_wp.things * iter_wp.n / hv.thing_divisors["image"], 2)
-        things_ahead_in_queue += queued_things
-        n_ahead_in_queue += iter_wp.n
-        if iter_wp.id == wp.id:
-            things_ahead_in_queue = round(things_ahead_in_queue, 2)
-            return (riter, things_ahead_in_queue, n_ahead_in_queue)
-    # -1 means the WP is done and not in the queue
-    return (-1, 0, 0)
+        wp_queue_index = WPQueueIndex(query_prioritized_wps(wp.wp_type), hv.thing_divisors["image"])
+    return wp_queue_index.get_queue_stats(wp.id)
 
 
 def get_wp_by_id(wp_id, lite=False):
@@ -1324,14 +1529,20 @@ def get_request_avg(request_type="image"):
 
 def wp_has_valid_workers(wp):
     # return True # FIXME: Still too heavy on the amount of data retrieved
+    if wp.faulted:
+        return False
+    if wp.expiry < datetime.utcnow():
+        return False
+    # The primary keeps a summary of the active workers, so we can usually answer this without the DB
+    capability_index = retrieve_worker_capability_index(wp.wp_type)
+    if capability_index is not None:
+        is_possible = capability_index.has_valid_worker(WorkerCapabilityIndex.get_wp_requirements(wp))
+        if is_possible is not None:
+            return is_possible
     cached_validity = hr.horde_r_get(f"wp_validity_{wp.id}")
     if cached_validity is not None:
         return bool(int(cached_validity))
     # tic = time.time()
-    if wp.faulted:
-        return []
-    if wp.expiry < datetime.utcnow():
-        return []
     worker_class = ImageWorker
     if wp.wp_type == "text":
         worker_class = TextWorker
@@ -1456,11 +1667,34 @@ def wp_has_valid_workers(wp):
     return worker_found
 
 
+@logger.catch(reraise=True)
+def retrieve_wp_queue_index(wp_type):
+    """Returns this node's decoded copy of the WP queue for this wp_type
+    We only decode it again when the cached value changes
+    """
+    cached_queue = hr.horde_r_get(f"{wp_type}_wp_cache")
+    if cached_queue is None:
+        return None
+    wp_queue_index = wp_queue_indexes.get(wp_type)
+    if wp_queue_index is not None and wp_queue_index[0] == cached_queue:
+        return wp_queue_index[1]
+    priority_sorted_list = deserialize_prioritized_wp_queue(cached_queue)
+    if priority_sorted_list is None:
+        return None
+    new_index = WPQueueIndex(priority_sorted_list, hv.thing_divisors["image"])
+    wp_queue_indexes[wp_type] = (cached_queue, new_index)
+    return new_index
+
+
 @logger.catch(reraise=True)
 def retrieve_prioritized_wp_queue(wp_type):
     cached_queue = hr.horde_r_get(f"{wp_type}_wp_cache")
     if cached_queue is None:
         return None
+    return deserialize_prioritized_wp_queue(cached_queue)
+
+
+def deserialize_prioritized_wp_queue(cached_queue):
     try:
         retrieved_json_list = json.loads(cached_queue)
     except (TypeError, OverflowError) as e:
@@ -1474,6 +1708,210 @@ def retrieve_prioritized_wp_queue(wp_type):
     return deserialized_wp_list
 
 
+def query_image_wp_match_rows():
+    """Retrieves all open image WPs in priority order, serialized for the ImageWPMatchIndex"""
+    open_wp_filters = [
+        ImageWaitingPrompt.n > 0,
+        ImageWaitingPrompt.active == True,  # noqa E712
+        ImageWaitingPrompt.faulted == False,  # noqa E712
+        ImageWaitingPrompt.expiry > datetime.utcnow(),
+    ]
+    # We avoid loading the full WP as the source images can be quite large
+    open_wps = (
+        db.session.query(
+            ImageWaitingPrompt.id,
+            ImageWaitingPrompt.width,
+            ImageWaitingPrompt.height,
+            ImageWaitingPrompt.params,
+            ImageWaitingPrompt.nsfw,
+            (ImageWaitingPrompt.source_image != None).label("has_source_image"),  # noqa E712
+            ImageWaitingPrompt.source_processing,
+            (ImageWaitingPrompt.extra_source_images != None).label("has_extra_source_images"),  # noqa E712
+            ImageWaitingPrompt.safe_ip,
+            ImageWaitingPrompt.r2,
+            ImageWaitingPrompt.slow_workers,
+            ImageWaitingPrompt.extra_slow_workers,
+            ImageWaitingPrompt.user_id,
+            ImageWaitingPrompt.worker_blacklist,
+        )
+        .filter(*open_wp_filters)
+        .order_by(ImageWaitingPrompt.extra_priority.desc(), ImageWaitingPrompt.created.asc())
+        .all()
+    )
+    wp_models = {}
+    for wp_id, model_name in db.session.query(WPModels.wp_id, WPModels.model).join(ImageWaitingPrompt).filter(*open_wp_filters).all():
+        wp_models.setdefault(wp_id, []).append(model_name)
+    wp_workers = {}
+    for wp_id, worker_id in (
+        db.session.query(WPAllowedWorkers.wp_id, WPAllowedWorkers.worker_id).join(ImageWaitingPrompt).filter(*open_wp_filters).all()
+    ):
+        wp_workers.setdefault(wp_id, []).append(str(worker_id))
+    serialized_rows = []
+    for wp in open_wps:
+        serialized_rows.append(
+            {
+                "id": str(wp.id),
+                "pixels": wp.width * wp.height,
+                "required": ImageWPMatchIndex.get_required_capabilities(wp),
+                "user_id": wp.user_id,
+                "worker_blacklist": wp.worker_blacklist,
+                "models": wp_models.get(wp.id, []),
+                "workers": wp_workers.get(wp.id, []),
+            },
+        )
+    return serialized_rows
+
+
+def query_worker_capability_rows(wp_type):
+    """Retrieves all active workers of this type, serialized for the WorkerCapabilityIndex
+    We only fetch the columns we need, instead of loading every worker through the ORM
+    """
+    worker_class = WORKER_CLASS_MAP[wp_type]
+    columns = [
+        worker_class.id,
+        worker_class.user_id,
+        worker_class.maintenance,
+        worker_class.paused,
+        worker_class.bridge_agent,
+        worker_class.nsfw,
+        worker_class.allow_unsafe_ipaddr,
+        worker_class.extra_slow_worker,
+        worker_class.require_upfront_kudos,
+        worker_class.speed.label("speed"),
+    ]
+    if wp_type == "image":
+        columns += [
+            worker_class.limit_max_steps,
+            worker_class.max_pixels,
+            worker_class.allow_img2img,
+            worker_class.allow_painting,
+            worker_class.allow_post_processing,
+            worker_class.allow_controlnet,
+            worker_class.allow_sdxl_controlnet,
+            worker_class.allow_lora,
+        ]
+    else:
+        columns += [
+            worker_class.max_length,
+            worker_class.max_context_length,
+        ]
+    worker_rows = db.session.query(*columns).filter(worker_class.last_check_in > datetime.utcnow() - timedelta(seconds=300)).all()
+    worker_ids = [w.id for w in worker_rows]
+    # Same as User.trusted, which looks at the first matching role
+    trusted_users = {}
+    for role in (
+        db.session.query(UserRole.user_id, UserRole.value)
+        .filter(
+            UserRole.user_id.in_({w.user_id for w in worker_rows}),
+            UserRole.user_role == UserRoleTypes.TRUSTED,
+        )
+        .order_by(UserRole.id)
+        .all()
+    ):
+        trusted_users.setdefault(role.user_id, role.value)
+    models = group_rows_by_worker(
+        db.session.query(WorkerModel.worker_id, WorkerModel.model).filter(WorkerModel.worker_id.in_(worker_ids)).all(),
+    )
+    softprompts = {}
+    if wp_type == "text":
+        softprompts = group_rows_by_worker(
+            db.session.query(TextWorkerSoftprompts.worker_id, TextWorkerSoftprompts.softprompt)
+            .filter(TextWorkerSoftprompts.worker_id.in_(worker_ids))
+            .all(),
+        )
+    blacklisting_workers = {
+        worker_id
+        for (worker_id,) in db.session.query(WorkerBlackList.worker_id).filter(WorkerBlackList.worker_id.in_(worker_ids)).distinct()
+    }
+    serialized_workers = []
+    for w in worker_rows:
+        serialized_workers.append(
+            {
+                "id": str(w.id),
+                "user_id": w.user_id,
+                "trusted": trusted_users.get(w.user_id, False),
+                "owner_only": w.maintenance or w.paused,
+                "capabilities": WorkerCapabilityIndex.get_worker_capabilities(wp_type, w),
+                "features": WorkerCapabilityIndex.get_worker_features(wp_type, w, models.get(w.id, [])),
+                "limits": WorkerCapabilityIndex.get_worker_limits(wp_type, w),
+                "models": models.get(w.id, []),
+                "bridge_agent": w.bridge_agent,
+                "softprompts": softprompts.get(w.id, []),
+                # Their blacklist, step limit and upfront kudos depend on the prompt and its user, so only the DB can tell
+                "needs_db_check": (w.id in blacklisting_workers or w.require_upfront_kudos or (wp_type == "image" and w.limit_max_steps)),
+            },
+        )
+    return serialized_workers
+
+
+def retrieve_worker_capability_index(wp_type):
+    """Returns this node's copy of the worker capability summary for this wp_type
+    Returns None if the primary hasn't stored one recently, in which case we should query the DB directly
+    """
+    if wp_type not in ["image", "text"]:
+        return None
+    index_version = hr.horde_r_get(f"{wp_type}_worker_capabilities_version")
+    if index_version is None:
+        return None
+    cached_index = worker_capability_indexes.get(wp_type)
+    if cached_index is not None and cached_index["version"] == index_version:
+        return cached_index["index"]
+    with worker_capability_index_lock:
+        # Another thread might have already rebuilt it while we were waiting
+        cached_index = worker_capability_indexes.get(wp_type)
+        if cached_index is not None and cached_index["version"] == index_version:
+            return cached_index["index"]
+        cached_summary = hr.horde_r_get(f"{wp_type}_worker_capabilities")
+        if cached_summary is None:
+            return None
+        try:
+            summary_json = json.loads(cached_summary)
+        except (TypeError, OverflowError) as err:
+            logger.error(f"Failed deserializing with error: {err}")
+            return None
+        worker_capability_indexes[wp_type] = {
+            "version": summary_json["version"],
+            "index": WorkerCapabilityIndex(summary_json["workers"]),
+        }
+        return worker_capability_indexes[wp_type]["index"]
+
+
+def worker_requirements_are_possible(wp_type, worker_requirements):
+    """Checks the requirements of a WP against the summary of the active workers
+    Returns None if we don't have a summary or it can't tell, in which case the WP needs to be checked against the DB
+    """
+    capability_index = retrieve_worker_capability_index(wp_type)
+    if capability_index is None:
+        return None
+    return capability_index.has_valid_worker(worker_requirements)
+
+
+def retrieve_image_wp_match_index():
+    """Returns this node's copy of the image WP match index
+    Returns None if the primary hasn't stored one recently, in which case we should query the DB directly
+    """
+    index_version = hr.horde_r_get("image_wp_match_index_version")
+    if index_version is None:
+        return None
+    if index_version == wp_match_index["version"]:
+        return wp_match_index["index"]
+    with wp_match_index_lock:
+        # Another thread might have already rebuilt it while we were waiting
+        if index_version == wp_match_index["version"]:
+            return wp_match_index["index"]
+        cached_index = hr.horde_r_get("image_wp_match_index")
+        if cached_index is None:
+            return None
+        try:
+            index_json = json.loads(cached_index)
+        except (TypeError, OverflowError) as err:
+            logger.error(f"Failed deserializing with error: {err}")
+            return None
+        wp_match_index["index"] = ImageWPMatchIndex(index_json["rows"])
+        wp_match_index["version"] = index_json["version"]
+        return wp_match_index["index"]
+
+
 def query_prioritized_wps(wp_type="image"):
     waiting_prompt_type = WP_CLASS_MAP[wp_type]
     return (
@@ -1507,6 +1945,82 @@ def prune_expired_stats():
     logger.debug("Pruned Expired Stats")
 
 
+def bulk_increment_values(table_class, key_columns, deltas):
+    """Adds each delta to the value of the row matching its key, with a single UPDATE ... FROM (VALUES ...)
+    deltas is a dict of key tuple -> delta, with the key values in the same order as key_columns
+    Returns the keys which did not match any row
+    """
+    if SQLITE_MODE:
+        missing_keys = []
+        for key, delta in deltas.items():
+            updated_rows = (
+                db.session.query(table_class)
+                .filter(*[getattr(table_class, c) == v for c, v in zip(key_columns, key)])
+                .update({"value": table_class.value + delta}, synchronize_session=False)
+            )
+            if updated_rows == 0:
+                missing_keys.append(key)
+        return missing_keys
+    deltas_table = values(
+        *[column(c, getattr(table_class, c).type) for c in key_columns],
+        column("delta", Float),
+        name="deltas",
+    ).data([(*key, delta) for key, delta in deltas.items()])
+    # The VALUES columns come through untyped, so we have to cast them for enums and UUIDs to compare
+    stmt = (
+        update(table_class)
+        .where(*[getattr(table_class, c) == cast(deltas_table.c[c], getattr(table_class, c).type) for c in key_columns])
+        .values(value=table_class.value + deltas_table.c.delta)
+        .returning(*[getattr(table_class, c) for c in key_columns])
+    )
+    matched_keys = {tuple(row) for row in db.session.execute(stmt)}
+    return [key for key in deltas if key not in matched_keys]
+
+
+def insert_missing_values(table_class, key_columns, deltas, missing_keys, owner_class):
+    """Creates the rows for the keys which bulk_increment_values() could not match
+    The first key column is always the owner's id. We skip owners which were deleted in the meantime.
+    """
+    if not missing_keys:
+        return
+    owner_ids = {key[0] for key in missing_keys}
+    existing_owner_ids = {row.id for row in db.session.query(owner_class.id).filter(owner_class.id.in_(owner_ids))}
+    for key in missing_keys:
+        if key[0] not in existing_owner_ids:
+            continue
+        db.session.add(table_class(**dict(zip(key_columns, key)), value=round(deltas[key], 2)))
+
+
+def apply_stats_ledger_deltas(pending_deltas):
+    """Writes the deltas popped from the stats ledger into the DB with one bulk update per table
+    The caller is responsible for committing
+    """
+    user_stats = {}
+    for user_id, action, delta in pending_deltas["user_stats"]:
+        key = (int(user_id), action)
+        user_stats[key] = user_stats.get(key, 0) + delta
+    user_records = {}
+    for user_id, field, delta in pending_deltas["user_records"]:
+        record_type_name, record = field.split("|", 1)
+        key = (int(user_id), UserRecordTypes[record_type_name], record)
+        user_records[key] = user_records.get(key, 0) + delta
+    worker_stats = {}
+    for worker_id, action, delta in pending_deltas["worker_stats"]:
+        # SQLITE_MODE stores the worker IDs as strings
+        key = (worker_id if SQLITE_MODE else uuid.UUID(worker_id), action)
+        worker_stats[key] = worker_stats.get(key, 0) + delta
+    for table_class, key_columns, deltas, owner_class in (
+        (UserStats, ("user_id", "action"), user_stats, User),
+        (UserRecords, ("user_id", "record_type", "record"), user_records, User),
+        (WorkerStats, ("worker_id", "action"), worker_stats, WorkerTemplate),
+    ):
+        if not deltas:
+            continue
+        missing_keys = bulk_increment_values(table_class, key_columns, deltas)
+        insert_missing_values(table_class, key_columns, deltas, missing_keys, owner_class)
+    logger.debug(f"Flushed {len(user_stats)} user stats, {len(user_records)} user records and {len(worker_stats)} worker stats")
+
+
 def compile_regex_filter(filter_type):
     all_filter_regex_query = db.session.query(Filter.regex).filter_by(filter_type=filter_type)
     all_filter_regex = [rfilter.regex for rfilter in all_filter_regex_query.all()]
@@ -2,14 +2,18 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import hashlib
 import json
 import os
+import time
 from datetime import datetime, timedelta
 
 import patreon
-from sqlalchemy import func, or_
+from sqlalchemy import func, or_, select
 
+from horde import vars as hv
 from horde.argparser import args
+from horde.change_events import notify_change
 from horde.classes.base.user import User
 from horde.classes.kobold.processing_generation import TextProcessingGeneration
 from horde.classes.kobold.waiting_prompt import TextWaitingPrompt
@@ -18,21 +22,31 @@ from horde.classes.stable.processing_generation import ImageProcessingGeneration
 
 # FIXME: Renamed for backwards compat. To fix later
 from horde.classes.stable.waiting_prompt import ImageWaitingPrompt
+from horde.database.classes import WPQueueIndex
 from horde.database.functions import (
+    apply_stats_ledger_deltas,
     compile_regex_filter,
+    count_active_workers,
     count_totals,
-    get_active_workers,
     get_available_models,
+    get_request_avg,
     prune_expired_stats,
+    query_image_wp_match_rows,
     query_prioritized_wps,
+    query_worker_capability_rows,
+    query_wp_queue_contributions,
     retrieve_regex_replacements,
+    serialize_active_workers,
 )
 from horde.enums import State
 from horde.flask import HORDE, SQLITE_MODE, db
 from horde.horde_redis import horde_redis as hr
 from horde.logger import logger
 from horde.patreon import patrons
+from horde.queue_stats import rebuild_queue_stats
 from horde.r2 import delete_source_image
+from horde.stats_ledger import LEDGER_FLUSH_TIME_BUDGET, pop_pending_deltas, restore_pending_deltas
+from horde.status_events import update_status_snapshots
 from horde.vars import horde_instance_id
 
 
@@ -95,30 +109,91 @@ def store_prioritized_wp_queue():
                 cached_queue = json.dumps(serialized_wp_list)
                 # We set the expiry in redis to 10 seconds, in case the primary thread dies
                 # However the primary thread is set to set the cache every 1 second
-                hr.horde_r_setex(f"{wp_type}_wp_cache", timedelta(seconds=5), cached_queue)
+                # This is refreshed constantly, so we don't need to wait for all redis servers to be written
+                hr.horde_r_setex_async(f"{wp_type}_wp_cache", timedelta(seconds=5), cached_queue)
             except (TypeError, OverflowError) as err:
                 logger.error(f"Failed serializing with error: {err}")
+            store_queue_status_snapshots(wp_type, wp_queue)
+
+
+def store_queue_status_snapshots(wp_type, wp_queue):
+    """Refreshes the queue position and queue wait in the status snapshots of the queued WPs
+    This is the same calculation that WaitingPrompt.get_status() does
+    """
+    wp_queue_index = WPQueueIndex(wp_queue, hv.thing_divisors["image"])
+    request_avg = get_request_avg(wp_type)
+    active_worker_thread_count = count_active_workers(wp_type)[1]
+    snapshot_updates = {}
+    for wp_id, (queue_pos, queued_things, queued_n) in wp_queue_index.positions.items():
+        avg_things_per_sec = (request_avg / hv.thing_divisors[wp_type]) * min(queued_n, active_worker_thread_count)
+        if avg_things_per_sec == 0:
+            avg_things_per_sec = 1
+        snapshot_updates[str(wp_id)] = {
+            "queue_position": queue_pos + 1,
+            "queue_wait": queued_things / avg_things_per_sec,
+        }
+    update_status_snapshots(snapshot_updates)
+
+
+@logger.catch(reraise=True)
+def store_image_wp_match_index():
+    """Stores the open image WPs along with their requirements, so that each node can match workers to them in-memory"""
+    with HORDE.app_context():
+        serialized_rows = query_image_wp_match_rows()
+        try:
+            serialized_rows_json = json.dumps(serialized_rows)
+        except (TypeError, OverflowError) as err:
+            logger.error(f"Failed serializing with error: {err}")
+            return
+        # The version only changes when the queue does, so that the nodes don't rebuild the index needlessly
+        index_version = hashlib.sha256(serialized_rows_json.encode()).hexdigest()
+        cached_index = json.dumps({"version": index_version, "rows": serialized_rows})
+        # Like the wp cache, this is refreshed every second. If the primary dies, the nodes fall back to the DB
+        hr.horde_r_mset_ex(
+            {
+                "image_wp_match_index": cached_index,
+                "image_wp_match_index_version": index_version,
+            },
+            timedelta(seconds=5),
+        )
+
+
+@logger.catch(reraise=True)
+def store_worker_capabilities():
+    """Stores a summary of what the active workers can do, so that each node can tell whether a WP is possible in-memory"""
+    with HORDE.app_context():
+        for wp_type in ["image", "text"]:
+            serialized_workers = query_worker_capability_rows(wp_type)
+            try:
+                serialized_workers_json = json.dumps(serialized_workers)
+            except (TypeError, OverflowError) as err:
+                logger.error(f"Failed serializing with error: {err}")
+                continue
+            # The version only changes when the workers do, so that the nodes don't rebuild the index needlessly
+            summary_version = hashlib.sha256(serialized_workers_json.encode()).hexdigest()
+            cached_summary = json.dumps({"version": summary_version, "workers": serialized_workers})
+            # This is refreshed every 5 seconds. If the primary dies, the nodes fall back to the DB
+            hr.horde_r_mset_ex(
+                {
+                    f"{wp_type}_worker_capabilities": cached_summary,
+                    f"{wp_type}_worker_capabilities_version": summary_version,
+                },
+                timedelta(seconds=30),
+            )
 
 
 @logger.catch(reraise=True)
 def store_worker_list():
     """Stores the retrieved worker details as json for 300 seconds horde-wide"""
     with HORDE.app_context():
-        serialized_workers = []
-        serialized_workers_privileged = []
-        # This is too slow. Needs heavy caching currently
-        # TODO: Figure out a way to get only the info I need from the DB query and format it into json by hand?
-        for worker in get_active_workers():
-            serialized_workers.append(worker.get_details())
-            serialized_workers_privileged.append(worker.get_details(2))
-        json_workers = json.dumps(serialized_workers)
-        json_workers_privileged = json.dumps(serialized_workers_privileged)
         try:
-            hr.horde_r_setex("worker_cache", timedelta(seconds=300), json_workers)
-            hr.horde_r_setex(
-                "worker_cache_privileged",
+            json_workers, json_workers_privileged = serialize_active_workers()
+            hr.horde_r_mset_ex(
+                {
+                    "worker_cache": json_workers,
+                    "worker_cache_privileged": json_workers_privileged,
+                },
                 timedelta(seconds=300),
-                json_workers_privileged,
             )
         except (TypeError, OverflowError) as err:
             logger.error(f"Failed serializing workers with error: {err}")
@@ -185,14 +260,15 @@ def check_waiting_prompts():
         #     delete_procgen_image(str(procgen.id))
         #     last_procgen = str(procgen.id)
         # logger.warning(f"Check Last procgen: {last_procgen}")
-        for wp_class, procgen_class in [
-            (ImageWaitingPrompt, ImageProcessingGeneration),
-            (TextWaitingPrompt, TextProcessingGeneration),
+        for wp_type, wp_class, procgen_class in [
+            ("image", ImageWaitingPrompt, ImageProcessingGeneration),
+            ("text", TextWaitingPrompt, TextProcessingGeneration),
         ]:
             expired_wps = db.session.query(wp_class).filter(wp_class.expiry < cutoff_time)
             logger.info(f"Pruned {expired_wps.count()} expired Waiting Prompts")
             expired_wps.delete()
             db.session.commit()
+            notify_change("wp")
             # Faults stale ProcGens
             all_proc_gen = (
                 db.session.query(
@@ -209,14 +285,16 @@ def check_waiting_prompts():
                 )
                 .all()
             )
-            modifed_procgens = 0
+            requeued_wps = {}
             for proc_gen in all_proc_gen:
                 if proc_gen.is_stale():
                     proc_gen.abort()
                     proc_gen.wp.n += 1
-                    modifed_procgens += 1
-            if modifed_procgens >= 1:
+                    requeued_wps[proc_gen.wp.id] = proc_gen.wp
+            if len(requeued_wps) >= 1:
                 db.session.commit()
+                for wp in requeued_wps.values():
+                    wp.refresh_status_snapshot()
             # Faults WP with 3 or more faulted Procgens
             wp_ids = (
                 db.session.query(
@@ -233,6 +311,9 @@ def check_waiting_prompts():
             db.session.commit()
             for wp in waiting_prompts.all():
                 wp.log_faulted_prompt()
+                wp.notify_status_change("fault")
+            # We've expired, requeued and faulted WPs in bulk, so we recalculate the per-model queue stats from scratch
+            rebuild_queue_stats(wp_type, query_wp_queue_contributions(wp_class, procgen_class))
 
 
 @logger.catch(reraise=True)
@@ -296,6 +377,27 @@ def prune_stats():
         prune_expired_stats()
 
 
+@logger.catch(reraise=True)
+def flush_stats_ledger():
+    """Writes the kudos details and user records accumulated in the stats ledger into the DB"""
+    with HORDE.app_context():
+        # We keep flushing batches until the ledger is drained, or we run out of time and leave the rest to the next run
+        deadline = time.monotonic() + LEDGER_FLUSH_TIME_BUDGET
+        more_pending = True
+        while more_pending and time.monotonic() < deadline:
+            pending_deltas, more_pending = pop_pending_deltas()
+            if not any(pending_deltas.values()):
+                continue
+            try:
+                apply_stats_ledger_deltas(pending_deltas)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                # We put them back so that they're not lost, and they'll be retried on the next run
+                restore_pending_deltas(pending_deltas)
+                raise
+
+
 @logger.catch(reraise=True)
 def store_patreon_members():
     api_client = patreon.API(os.getenv("PATREON_CREATOR_ACCESS_TOKEN"))
@@ -365,20 +467,27 @@ def increment_extra_priority():
     with HORDE.app_context():
         # cutoff_time = datetime.utcnow()
         for wp_class in [ImageWaitingPrompt, TextWaitingPrompt]:
-            wp_ids = db.session.query(wp_class.id).filter(
-                wp_class.n > 0,
-                wp_class.faulted == False,  # noqa E712
-                wp_class.active == True,  # noqa E712
-                # Commented to avoid running into a deadlock with the WP delete thread
-                # wp_class.expiry > cutoff_time,
-            )
-            # logger.debug(f"Found {wp_ids.count()} of class {wp_class} to increase priority")
-            for wp in wp_ids.all():
-                db.session.query(wp_class).filter_by(id=wp.id).update(
-                    {wp_class.extra_priority: wp_class.extra_priority + 50},
-                    synchronize_session=False,
+            # We lock the rows in a consistent order and skip those already locked
+            # to avoid running into a deadlock with the WP delete thread or waiting on pops.
+            # Any WP we skip will just get its priority increased on the next run.
+            wp_ids = (
+                select(wp_class.id)
+                .where(
+                    wp_class.n > 0,
+                    wp_class.faulted == False,  # noqa E712
+                    wp_class.active == True,  # noqa E712
+                    # Commented to avoid running into a deadlock with the WP delete thread
+                    # wp_class.expiry > cutoff_time,
                 )
-                db.session.commit()
+                .order_by(wp_class.id)
+                .with_for_update(skip_locked=True)
+            )
+            db.session.query(wp_class).filter(wp_class.id.in_(wp_ids)).update(
+                {wp_class.extra_priority: wp_class.extra_priority + 50},
+                synchronize_session=False,
+            )
+            db.session.commit()
+        notify_change("wp")
 
 
 @logger.catch(reraise=True)
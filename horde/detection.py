@@ -4,6 +4,7 @@
 
 import json
 from datetime import datetime
+from functools import lru_cache
 
 import dateutil.relativedelta
 import emoji
@@ -16,6 +17,7 @@ from horde.flask import HORDE, SQLITE_MODE  # Local Testing
 from horde.horde_redis import horde_redis as hr
 from horde.logger import logger
 from horde.model_reference import model_reference
+from horde.prompt_prefilter import PrefilteredRegex
 
 
 class PromptChecker:
@@ -73,6 +75,8 @@ class PromptChecker:
         self.whitespace_remover = re.compile(r"(\s(\w)){3,}\b")
         self.whitespace_converter = re.compile(r"([^\w\s]|_)")
         self.csam_triggers = re.compile(r"\b(0?[0-9]|1[0-9]|2[0-2])(?![0-9]) *years? *old")
+        # The same prompt is normalized by several of the checks during a single request
+        self.normalize_prompt = lru_cache(maxsize=128)(self.normalize_prompt)
 
     def refresh_regex(self):
         # We don't want to be pulling the regex from redis all the time. We pull them only once per min
@@ -103,7 +107,7 @@ class PromptChecker:
                 continue
             # Ensure we recompile the regex when they have actually changed.
             if self.regex[filter_id] != stored_filter:
-                self.compiled[filter_id] = re.compile(stored_filter, re.IGNORECASE)
+                self.compiled[filter_id] = PrefilteredRegex(stored_filter)
                 self.regex[filter_id] = stored_filter
                 # logger.debug(self.compiled[filter_id])
             self.replacements = [
@@ -132,10 +136,12 @@ class PromptChecker:
                     continue
                 # We only need 1 of the filters in the group to match to increase suspicion
                 # Suspicion does not increase further for more filters in the same group
-                existing_emojis = emoji.emoji_list(prompt)
-                if filter_id == "filter_10" and len(existing_emojis):
+                # Only filter_10 checks the emojis, so we only extract them for it
+                emj_list = set()
+                if filter_id == "filter_10":
+                    emj_list = {emj["emoji"] for emj in emoji.emoji_list(prompt)}
+                if len(emj_list):
                     found_sus = False
-                    emj_list = [emj["emoji"] for emj in existing_emojis]
                     for emj in [
                         "👧",
                         "👧🏻",
@@ -5,6 +5,8 @@
 import json
 import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
 from threading import Lock
 
@@ -17,6 +19,71 @@ from horde.redis_ctrl import (
     is_redis_up,
 )
 
+# The keys we also keep in-process for a very short time, along with the max seconds each can be stale.
+# These are read on almost every request and refreshed by the primary, so a second or so of staleness doesn't matter.
+L1_CACHE_MAX_STALENESS = {
+    "models_cache": 5,
+    "totals_cache": 5,
+    "image_wp_cache": 1,
+    "text_wp_cache": 1,
+    "image_wp_match_index_version": 1,
+    "worker_performances_avg_cache": 5,
+    "text_worker_performances_avg_cache": 5,
+    "filter_10": 5,
+    "filter_11": 5,
+    "filter_20": 5,
+    "cached_regex_replacements": 5,
+}
+L1_CACHE_MAX_SIZE = 256
+
+
+def datetime_json_converter(o):
+    """Dumps datetimes the same way the API models marshal them, so that cached json can be returned as is"""
+    if isinstance(o, datetime):
+        return o.strftime("%a, %d %b %Y %H:%M:%S +0000")
+    raise TypeError(f"Object of type {o.__class__.__name__} is not JSON serializable")
+
+
+class L1Cache:
+    """A small in-process LRU cache with a per-key expiry, which sits in front of redis"""
+
+    def __init__(self, max_size=L1_CACHE_MAX_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, seconds):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + seconds)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def get_stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.entries),
+        }
+
 
 class HordeRedis:
     locks = {}
@@ -24,8 +91,13 @@ class HordeRedis:
     all_horde_redis = []
     horde_local_r = None
     check_redis_thread = None
+    fanout_pool = None
+    l1_cache = None
 
     def __init__(self):
+        self.l1_cache = L1Cache()
+        # Writes to each redis server are sent in parallel through this pool
+        self.fanout_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="horde_redis_fanout")
         logger.init("Horde Redis", status="Connecting")
         if is_redis_up():
             self.horde_r = get_horde_db()
@@ -47,38 +119,68 @@ class HordeRedis:
             time.sleep(10)
             self.all_horde_redis = get_all_redis_db_servers()
 
+    def write_to_server(self, hr, commands):
+        """Sends all the commands to a single redis server in one round trip"""
+        try:
+            pipe = hr.pipeline(transaction=False)
+            for command, args in commands:
+                getattr(pipe, command)(*args)
+            pipe.execute()
+        except Exception as err:
+            logger.warning(f"Exception when writing in redis servers {hr}: {err}")
+
+    def fan_out(self, commands):
+        """Sends the commands to all redis servers in parallel
+        Returns the futures of the writes, so that the caller can decide whether to wait for them
+        """
+        return [self.fanout_pool.submit(self.write_to_server, hr, commands) for hr in self.all_horde_redis]
+
+    def write_to_local(self, commands):
+        if not self.horde_local_r:
+            return
+        self.write_to_server(self.horde_local_r, commands)
+
     def horde_r_set(self, key, value):
-        for hr in self.all_horde_redis:
-            try:
-                hr.set(key, value)
-            except Exception as err:
-                logger.warning(f"Exception when writing in redis servers {hr}: {err}")
-        if self.horde_local_r:
-            self.horde_local_r.setex(key, timedelta(10), value)
+        self.l1_cache.delete(key)
+        futures = self.fan_out([("set", (key, value))])
+        self.write_to_local([("setex", (key, timedelta(10), value))])
+        wait(futures)
 
     def horde_r_setex(self, key, expiry, value):
-        for hr in self.all_horde_redis:
-            try:
-                hr.setex(key, expiry, value)
-            except Exception as err:
-                logger.warning(f"Exception when writing in redis servers {hr}: {err}")
+        self.l1_cache.delete(key)
+        futures = self.fan_out([("setex", (key, expiry, value))])
         # We don't keep local cache for more than 5 seconds
         if expiry > timedelta(5):
             expiry = timedelta(5)
-        if self.horde_local_r:
-            self.horde_local_r.setex(key, expiry, value)
+        self.write_to_local([("setex", (key, expiry, value))])
+        wait(futures)
+
+    def horde_r_setex_async(self, key, expiry, value):
+        """Same as horde_r_setex() but doesn't wait for the remote redis servers to be written
+        Meant for background threads which don't need to read back what they just wrote.
+        """
+        self.l1_cache.delete(key)
+        futures = self.fan_out([("setex", (key, expiry, value))])
+        if expiry > timedelta(5):
+            expiry = timedelta(5)
+        self.write_to_local([("setex", (key, expiry, value))])
+        return futures
+
+    def horde_r_mset_ex(self, mapping, expiry):
+        """Sets all the keys in the mapping with the same expiry, in a single round trip per redis server"""
+        for key in mapping:
+            self.l1_cache.delete(key)
+        futures = self.fan_out([("setex", (key, expiry, value)) for key, value in mapping.items()])
+        if expiry > timedelta(5):
+            expiry = timedelta(5)
+        self.write_to_local([("setex", (key, expiry, value)) for key, value in mapping.items()])
+        wait(futures)
 
     def horde_r_setex_json(self, key, expiry, value):
         """Same as horde_r_setex()
         but also converts the python builtin value to json
         """
-
-        def default_converter(o):
-            if isinstance(o, datetime):
-                return o.strftime("%a, %d %b %Y %H:%M:%S +0000")
-            raise TypeError(f"Object of type {o.__class__.__name__} is not JSON serializable")
-
-        self.horde_r_setex(key, expiry, json.dumps(value, default=default_converter))
+        self.horde_r_setex(key, expiry, json.dumps(value, default=datetime_json_converter))
 
     def horde_r_local_set_to_json(self, key, value):
         if self.horde_local_r:
@@ -106,23 +208,36 @@ class HordeRedis:
         """Retrieves the value from local redis if it exists
         If it doesn't exist retrieves it from remote redis
         If it exists in remote redis, also stores it in local redis
+        The most frequently read keys are also kept in-process for a very short time
         """
+        max_staleness = L1_CACHE_MAX_STALENESS.get(key)
+        if max_staleness is not None:
+            value = self.l1_cache.get(key)
+            if value is not None:
+                return value
         value = None
+        l1_ttl = max_staleness
         if self.horde_local_r:
             # if key in ["worker_cache","worker_cache_privileged"]:
             #     logger.warning(f"Got {key} from Local")
             value = self.horde_local_r.get(key)
         if value is None and self.horde_r:
             value = self.horde_r.get(key)
-            if value is not None and self.horde_local_r is not None:
-                ttl = self.horde_r.ttl(key)
+            if value is not None and (self.horde_local_r is not None or max_staleness is not None):
+                remote_ttl = self.horde_r.ttl(key)
+                ttl = remote_ttl
                 if ttl > 5:
                     ttl = 5
                 if ttl <= 0:
                     ttl = 2
                 # The local redis cache is always very temporary
-                if value is not None:
+                if self.horde_local_r is not None:
                     self.horde_local_r.setex(key, timedelta(seconds=abs(ttl)), value)
+                # We never keep it in-process for longer than it has left in redis
+                if max_staleness is not None and remote_ttl > 0:
+                    l1_ttl = min(max_staleness, remote_ttl)
+        if value is not None and max_staleness is not None:
+            self.l1_cache.set(key, value, l1_ttl)
         return value
 
     def horde_r_get_json(self, key):
@@ -135,6 +250,7 @@ class HordeRedis:
         return json.loads(value)
 
     def horde_r_delete(self, key):
+        self.l1_cache.delete(key)
         for hr in self.all_horde_redis:
             try:
                 hr.delete(key)
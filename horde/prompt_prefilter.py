@@ -0,0 +1,240 @@
+# SPDX-FileCopyrightText: 2022 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Literal prefilter for the prompt filter regex.
+
+The stored filters are large alternations of individual regex, and almost every prompt matches none of them.
+Most of those alternatives can't match unless the prompt contains one of a few literal strings,
+so we extract those literals and search for all of them at once with a named list, which the regex module
+matches natively as a set of strings. Only when one of them is found do we need to run the full regex.
+The alternatives from which we can't extract any useful literal are kept in a smaller regex which always runs.
+
+The literals are extracted with the stdlib parser, but the filters are compiled with the regex module,
+which reads some syntax differently (POSIX classes, fuzzy matching, global flags like (?x) and so on).
+Any alternative using such syntax always runs in full, as the literals we'd get for it could be wrong.
+"""
+
+import regex as re
+
+from horde.logger import logger
+
+try:
+    import re._parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# Literals shorter than this would be found in nearly every prompt, so they're useless as a prefilter
+MIN_LITERAL_LENGTH = 3
+# The max amount of strings we expand character classes and groups into
+MAX_LITERAL_SET = 64
+MAX_CLASS_CHARS = 8
+# Inline flags which apply to the whole pattern, like (?x) or (?V1), change how every alternative is parsed.
+# (?i) alone is fine, as we're always case insensitive
+GLOBAL_FLAGS_REGEX = re.compile(r"\(\?[a-zA-Z01^-]*[a-hj-zA-Z01^-][a-zA-Z01^-]*\)")
+# Syntax which only the regex module understands. The stdlib parser either rejects it or reads it differently.
+# Any brace which isn't a plain {n,m} quantifier might be fuzzy matching, like {e<=1}
+REGEX_ONLY_SYNTAX_REGEX = re.compile(
+    r"\[\[|\[:|\{(?!\d*(?:,\d*)?\})|\\[pPmMLXGK]|\(\?(?:\||&|R|P>|[+-]?\d)",
+)
+
+
+def split_alternatives(regex_string):
+    """Splits the regex on its top-level |"""
+    alternatives = []
+    depth = 0
+    in_class = False
+    start = 0
+    iter = 0
+    while iter < len(regex_string):
+        char = regex_string[iter]
+        if char == "\\":
+            iter += 2
+            continue
+        if in_class:
+            if char == "]":
+                in_class = False
+        elif char == "[":
+            in_class = True
+            # A ] right after the opening bracket is a literal
+            if regex_string[iter + 1 : iter + 2] == "^":
+                iter += 1
+            if regex_string[iter + 1 : iter + 2] == "]":
+                iter += 1
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth == 0:
+            alternatives.append(regex_string[start:iter])
+            start = iter + 1
+        iter += 1
+    # If we lost track of the nesting, we can't trust the split
+    if depth != 0 or in_class:
+        return [regex_string]
+    alternatives.append(regex_string[start:])
+    return alternatives
+
+
+def pick_literals(current_best, candidate):
+    """Returns whichever of the two literal sets is more selective, ignoring the ones which are not selective at all"""
+    if not candidate or min(len(literal) for literal in candidate) < MIN_LITERAL_LENGTH:
+        return current_best
+    if current_best is None or min(len(literal) for literal in candidate) > min(len(literal) for literal in current_best):
+        return candidate
+    return current_best
+
+
+def get_literal_char(code):
+    """Returns None for the characters which lowercase to more than one character, as they don't match them case-insensitively"""
+    char = chr(code).lower()
+    if len(char) != 1:
+        return None
+    return char
+
+
+def get_class_chars(class_items):
+    chars = set()
+    for op, av in class_items:
+        if op == sre_parse.LITERAL and get_literal_char(av) is not None:
+            chars.add(get_literal_char(av))
+        elif op == sre_parse.RANGE and av[1] - av[0] < MAX_CLASS_CHARS:
+            range_chars = [get_literal_char(code) for code in range(av[0], av[1] + 1)]
+            if None in range_chars:
+                return None
+            chars.update(range_chars)
+        else:
+            return None
+    if len(chars) > MAX_CLASS_CHARS:
+        return None
+    return chars
+
+
+def analyze_branch(branches):
+    exact = set()
+    required = set()
+    for branch in branches:
+        branch_exact, branch_required = analyze_sequence(branch)
+        if exact is not None and branch_exact is not None:
+            exact |= branch_exact
+        else:
+            exact = None
+        branch_required = pick_literals(branch_required, branch_exact)
+        if required is not None and branch_required is not None:
+            required |= branch_required
+        else:
+            required = None
+    return exact, required
+
+
+def analyze_sequence(sequence):
+    """Returns a tuple of
+    * The set of strings this sequence matches, if it only ever matches a few literal strings, else None
+    * A set of literals, one of which appears in every match of the sequence, or None if we couldn't find a useful one
+    """
+    current = {""}
+    is_exact = True
+    best = None
+    for op, av in sequence:
+        # Zero-width assertions don't consume anything, so the literals before and after them are still adjacent
+        if op == sre_parse.AT:
+            continue
+        sub_exact = None
+        sub_required = None
+        if op == sre_parse.LITERAL:
+            literal_char = get_literal_char(av)
+            if literal_char is not None:
+                sub_exact = {literal_char}
+        elif op == sre_parse.IN:
+            sub_exact = get_class_chars(av)
+        elif op == sre_parse.SUBPATTERN:
+            sub_exact, sub_required = analyze_sequence(av[-1])
+        elif op == sre_parse.BRANCH:
+            sub_exact, sub_required = analyze_branch(av[1])
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            min_repeat, max_repeat, repeated = av
+            if min_repeat == max_repeat == 1:
+                sub_exact, sub_required = analyze_sequence(repeated)
+            elif min_repeat >= 1:
+                repeated_exact, repeated_required = analyze_sequence(repeated)
+                sub_required = pick_literals(repeated_required, repeated_exact)
+                # The first repetition still continues the run of literals before it
+                # and the last one starts the run of literals after it
+                if repeated_exact is not None and len(current) * len(repeated_exact) <= MAX_LITERAL_SET:
+                    best = pick_literals(best, {prefix + suffix for prefix in current for suffix in repeated_exact})
+                    is_exact = False
+                    current = repeated_exact
+                    continue
+        if sub_exact is not None and len(current) * len(sub_exact) <= MAX_LITERAL_SET:
+            current = {prefix + suffix for prefix in current for suffix in sub_exact}
+            continue
+        # The run of literals ends here
+        best = pick_literals(best, current)
+        best = pick_literals(best, sub_required)
+        is_exact = False
+        current = sub_exact if sub_exact is not None else {""}
+    best = pick_literals(best, current)
+    if is_exact:
+        return current, best
+    return None, best
+
+
+def extract_required_literals(alternative):
+    """Returns a set of lowercase literals, one of which appears in every match of the regex
+    Returns None if the regex doesn't have any useful literals, or if we couldn't parse it the way the regex module does
+    """
+    if REGEX_ONLY_SYNTAX_REGEX.search(alternative):
+        return None
+    try:
+        parsed = sre_parse.parse(alternative)
+    except Exception:
+        return None
+    exact, required = analyze_sequence(parsed)
+    return pick_literals(required, exact)
+
+
+class PrefilteredRegex:
+    """Wraps a filter regex so that the alternatives behind literals only run when one of those literals is in the text
+    search() returns the same result as searching with the full regex
+    """
+
+    def __init__(self, regex_string):
+        self.compiled = re.compile(regex_string, re.IGNORECASE)
+        self.literals = None
+        self.residual = None
+        gated_literals = set()
+        residual_alternatives = []
+        # Comments can hold unbalanced brackets, so we couldn't split the regex on them
+        if GLOBAL_FLAGS_REGEX.search(regex_string) or "(?#" in regex_string:
+            return
+        alternatives = split_alternatives(regex_string)
+        try:
+            # An alternative which doesn't compile by itself means we split the regex in the wrong places
+            for alternative in alternatives:
+                re.compile(alternative)
+        except Exception:
+            return
+        for alternative in alternatives:
+            required_literals = extract_required_literals(alternative)
+            if required_literals is None:
+                residual_alternatives.append(alternative)
+            else:
+                gated_literals |= required_literals
+        if len(gated_literals) == 0:
+            return
+        try:
+            if len(residual_alternatives) > 0:
+                self.residual = re.compile("|".join(residual_alternatives), re.IGNORECASE)
+            self.literals = re.compile(r"\L<literals>", re.IGNORECASE, literals=sorted(gated_literals))
+        except Exception as err:
+            logger.warning(f"Could not compile the prefilter of a filter regex. Will always run it in full: {err}")
+            self.literals = None
+            self.residual = None
+
+    def search(self, text):
+        if self.literals is None or self.literals.search(text):
+            return self.compiled.search(text)
+        if self.residual is None:
+            return None
+        # None of the literal alternatives can match, so only the rest can give us a match
+        return self.residual.search(text)
@@ -0,0 +1,105 @@
+# SPDX-FileCopyrightText: 2022 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Per-model queue counters for the models status, maintained incrementally as WPs change.
+
+Each WP keeps its last known contribution (models, jobs, things) in redis. Whenever a WP changes, it sends
+its new contribution and the script swaps it with the old one, applying the difference to the per-model counters.
+This makes each update idempotent, so a WP can sync itself as often as it likes without counting twice.
+The WP cleaner rebuilds everything from the DB periodically, which fixes any drift from changes we didn't catch.
+"""
+
+import json
+
+from horde.horde_redis import horde_redis as hr
+from horde.logger import logger
+
+SYNC_CONTRIBUTION_SCRIPT = """
+local function apply(contribution, sign)
+    for _, model in ipairs(contribution["models"]) do
+        redis.call("HINCRBYFLOAT", KEYS[2], "jobs:" .. model, sign * contribution["jobs"])
+        redis.call("HINCRBYFLOAT", KEYS[2], "things:" .. model, sign * contribution["things"])
+    end
+end
+local old_contribution = redis.call("HGET", KEYS[1], ARGV[1])
+if old_contribution then
+    apply(cjson.decode(old_contribution), -1)
+end
+if ARGV[2] == "" then
+    redis.call("HDEL", KEYS[1], ARGV[1])
+else
+    apply(cjson.decode(ARGV[2]), 1)
+    redis.call("HSET", KEYS[1], ARGV[1], ARGV[2])
+end
+"""
+sync_contribution_script = None
+
+
+def get_contributions_key(wp_type):
+    return f"model_queue_contributions:{wp_type}"
+
+
+def get_stats_key(wp_type):
+    return f"model_queue_stats:{wp_type}"
+
+
+def sync_wp_contribution(wp_type, wp_id, models, jobs, things):
+    """Replaces the WP's contribution to the per-model counters. A WP with no jobs is removed from them."""
+    global sync_contribution_script
+    if hr.horde_r is None:
+        return
+    new_contribution = ""
+    if jobs > 0 and len(models) > 0:
+        new_contribution = json.dumps({"models": models, "jobs": jobs, "things": things})
+    try:
+        if sync_contribution_script is None:
+            sync_contribution_script = hr.horde_r.register_script(SYNC_CONTRIBUTION_SCRIPT)
+        sync_contribution_script(
+            keys=[get_contributions_key(wp_type), get_stats_key(wp_type)],
+            args=[str(wp_id), new_contribution],
+        )
+    except Exception as err:
+        logger.warning(f"Could not sync the queue stats of WP {wp_id}: {err}")
+
+
+def rebuild_queue_stats(wp_type, contributions):
+    """Replaces all the counters with the ones calculated from the given contributions
+    contributions is a dict of wp_id -> (models, jobs, things)
+    """
+    if hr.horde_r is None:
+        return
+    stored_contributions = {}
+    stats = {}
+    for wp_id, (models, jobs, things) in contributions.items():
+        stored_contributions[str(wp_id)] = json.dumps({"models": models, "jobs": jobs, "things": things})
+        for model in models:
+            stats[f"jobs:{model}"] = stats.get(f"jobs:{model}", 0) + jobs
+            stats[f"things:{model}"] = stats.get(f"things:{model}", 0) + things
+    pipe = hr.horde_r.pipeline(transaction=True)
+    pipe.delete(get_contributions_key(wp_type), get_stats_key(wp_type))
+    if len(stored_contributions) > 0:
+        pipe.hset(get_contributions_key(wp_type), mapping=stored_contributions)
+        pipe.hset(get_stats_key(wp_type), mapping=stats)
+    pipe.execute()
+
+
+def get_model_queue_stats(wp_type):
+    """Returns the queued things and jobs per model, or None if the counters are not available"""
+    if hr.horde_r is None:
+        return None
+    try:
+        stats = hr.horde_r.hgetall(get_stats_key(wp_type))
+    except Exception as err:
+        logger.warning(f"Could not read the {wp_type} model queue stats: {err}")
+        return None
+    things_per_model = {}
+    jobs_per_model = {}
+    for field, value in stats.items():
+        counter, model = field.split(":", 1)
+        # Models which left the queue stay in the hash with a zero counter
+        if counter == "jobs" and round(float(value)) > 0:
+            jobs_per_model[model] = round(float(value))
+        elif counter == "things" and round(float(value), 2) > 0:
+            things_per_model[model] = round(float(value), 2)
+    return things_per_model, jobs_per_model
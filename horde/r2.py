@@ -2,12 +2,20 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import hashlib
+import hmac
 import json
 import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
 from io import BytesIO
+from threading import Lock
+from urllib.parse import quote, urlsplit
 from uuid import uuid4
 
 import boto3
+from botocore.credentials import ReadOnlyCredentials
 from botocore.exceptions import ClientError
 from PIL import Image
 
@@ -39,6 +47,116 @@ old_r2 = boto3.client(
     aws_secret_access_key=os.getenv("OLD_AWS_SECRET_ACCESS_KEY"),
 )
 
+
+class R2Presigner:
+    """Presigns S3 URLs with SigV4 query authentication directly, instead of going through the botocore request machinery
+    The signing key only changes once per day, so we derive it once and reuse it for every URL we sign
+    """
+
+    def __init__(self, client, access_key=None, secret_key=None):
+        self.client = client
+        if access_key is not None and secret_key is not None:
+            self.credentials = ReadOnlyCredentials(access_key, secret_key, None)
+        else:
+            # Without explicit keys, the client uses the default credential chain, so we resolve them the same way.
+            # Those can be temporary and get refreshed, so we keep them as they are and freeze them on every presign
+            self.credentials = boto3.session.Session().get_credentials()
+        self.region = client.meta.region_name or "us-east-1"
+        endpoint = urlsplit(client.meta.endpoint_url)
+        self.scheme = endpoint.scheme
+        self.host = endpoint.netloc
+        self.signing_key = None
+        self.signing_date = None
+        self.signing_secret = None
+        self.lock = Lock()
+
+    def get_frozen_credentials(self):
+        """Returns the current access key, secret key and session token, or None if we have no credentials"""
+        if self.credentials is None:
+            return None
+        if isinstance(self.credentials, ReadOnlyCredentials):
+            return self.credentials
+        return self.credentials.get_frozen_credentials()
+
+    def get_signing_key(self, datestamp, secret_key):
+        with self.lock:
+            if self.signing_date != datestamp or self.signing_secret != secret_key:
+                signing_key = hmac.new(f"AWS4{secret_key}".encode(), datestamp.encode(), hashlib.sha256).digest()
+                for scope_part in [self.region, "s3", "aws4_request"]:
+                    signing_key = hmac.new(signing_key, scope_part.encode(), hashlib.sha256).digest()
+                self.signing_key = signing_key
+                self.signing_date = datestamp
+                self.signing_secret = secret_key
+            return self.signing_key
+
+    def presign(self, http_method, bucket, keys, expires_in=1800):
+        """Returns a presigned URL for each of the keys in the bucket, all signed at the same time"""
+        credentials = self.get_frozen_credentials()
+        if credentials is None or credentials.access_key is None or credentials.secret_key is None:
+            client_method = "put_object" if http_method == "PUT" else "get_object"
+            return [generate_presigned_url(self.client, client_method, {"Bucket": bucket, "Key": key}, expires_in) for key in keys]
+        now = datetime.now(timezone.utc)
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        datestamp = now.strftime("%Y%m%d")
+        credential_scope = f"{datestamp}/{self.region}/s3/aws4_request"
+        query_params = {
+            "X-Amz-Algorithm": "AWS4-HMAC-SHA256",
+            "X-Amz-Credential": f"{credentials.access_key}/{credential_scope}",
+            "X-Amz-Date": amz_date,
+            "X-Amz-Expires": str(expires_in),
+            "X-Amz-SignedHeaders": "host",
+        }
+        if credentials.token:
+            query_params["X-Amz-Security-Token"] = credentials.token
+        canonical_query = "&".join(f"{quote(k, safe='-_.~')}={quote(v, safe='-_.~')}" for k, v in sorted(query_params.items()))
+        signing_key = self.get_signing_key(datestamp, credentials.secret_key)
+        urls = []
+        for key in keys:
+            canonical_uri = quote(f"/{bucket}/{key}", safe="/-_.~")
+            canonical_request = f"{http_method}\n{canonical_uri}\n{canonical_query}\nhost:{self.host}\n\nhost\nUNSIGNED-PAYLOAD"
+            string_to_sign = f"AWS4-HMAC-SHA256\n{amz_date}\n{credential_scope}\n{hashlib.sha256(canonical_request.encode()).hexdigest()}"
+            signature = hmac.new(signing_key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+            urls.append(f"{self.scheme}://{self.host}{canonical_uri}?{canonical_query}&X-Amz-Signature={signature}")
+        return urls
+
+
+class DownloadURLCache:
+    """Keeps the presigned download URLs we've handed out, so that polling the same generations doesn't sign them again
+    We only reuse them for part of their validity, so that the client always has some time left to download
+    """
+
+    def __init__(self, reuse_for=1500, max_size=50000):
+        self.reuse_for = reuse_for
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self.entries[key]
+                return None
+            return entry[0]
+
+    def set(self, key, url):
+        with self.lock:
+            self.entries[key] = (url, time.monotonic() + self.reuse_for)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+presigner_transient = R2Presigner(s3_client)
+presigner_shared = R2Presigner(
+    s3_client_shared,
+    access_key=os.getenv("SHARED_AWS_ACCESS_ID"),
+    secret_key=os.getenv("SHARED_AWS_ACCESS_KEY"),
+)
+download_url_cache = DownloadURLCache()
+
 # Lists shared bucket contents
 # for key in s3_client_shared.list_objects(Bucket=r2_transient_bucket)['Contents']:
 #     logger.debug(key['Key'])
@@ -67,29 +185,24 @@ def generate_presigned_url(client, client_method, method_parameters, expires_in=
 
 
 def generate_procgen_upload_url(procgen_id, shared=False):
-    client = s3_client
-    if shared:
-        client = s3_client_shared
-    return generate_presigned_url(
-        client=client,
-        client_method="put_object",
-        method_parameters={"Bucket": r2_transient_bucket, "Key": f"{procgen_id}.webp"},
-        expires_in=1800,
-    )
+    return generate_procgen_upload_urls([procgen_id], shared)[0]
+
+
+def generate_procgen_upload_urls(procgen_ids, shared=False):
+    presigner = presigner_shared if shared else presigner_transient
+    return presigner.presign("PUT", r2_transient_bucket, [f"{procgen_id}.webp" for procgen_id in procgen_ids], expires_in=1800)
 
 
 def generate_procgen_download_url(procgen_id, shared=False):
-    client = s3_client
-    if shared:
-        client = s3_client_shared
     # if not file_exists(client,  f"{procgen_id}.webp"):
     #     client = old_r2
-    return generate_presigned_url(
-        client=client,
-        client_method="get_object",
-        method_parameters={"Bucket": r2_transient_bucket, "Key": f"{procgen_id}.webp"},
-        expires_in=1800,
-    )
+    cache_key = (shared, procgen_id)
+    download_url = download_url_cache.get(cache_key)
+    if download_url is None:
+        presigner = presigner_shared if shared else presigner_transient
+        download_url = presigner.presign("GET", r2_transient_bucket, [f"{procgen_id}.webp"], expires_in=1800)[0]
+        download_url_cache.set(cache_key, download_url)
+    return download_url
 
 
 def delete_procgen_image(procgen_id):
@@ -186,11 +299,11 @@ def upload_prompt(prompt_dict):
 
 
 def generate_img_download_url(filename, bucket=r2_transient_bucket):
-    return generate_presigned_url(s3_client, "get_object", {"Bucket": bucket, "Key": filename}, 1800)
+    return presigner_transient.presign("GET", bucket, [filename], 1800)[0]
 
 
 def generate_img_upload_url(filename, bucket=r2_transient_bucket):
-    return generate_presigned_url(s3_client, "put_object", {"Bucket": bucket, "Key": filename}, 1800)
+    return presigner_transient.presign("PUT", bucket, [filename], 1800)[0]
 
 
 def generate_uuid_img_upload_url(img_uuid, imgtype):
@@ -0,0 +1,121 @@
+# SPDX-FileCopyrightText: 2022 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""In-process cache of the base64 source images and masks we send to bridges which can't download them from R2.
+
+Without it, every pop by such a bridge downloaded the source from R2 and re-encoded it, even on re-pops of the same WP.
+Now each one is transcoded once and kept in an LRU bounded by both the amount of entries and their total size.
+If an active worker without R2 support could pick up the WP, it is transcoded in the background as soon as the WP is created.
+"""
+
+import os
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+
+from horde.image import convert_pil_to_b64
+from horde.logger import logger
+from horde.r2 import download_source_image, download_source_mask
+
+SOURCE_IMAGE_CACHE_MAX_ENTRIES = int(os.getenv("SOURCE_IMAGE_CACHE_MAX_ENTRIES", 1000))
+SOURCE_IMAGE_CACHE_MAX_BYTES = int(os.getenv("SOURCE_IMAGE_CACHE_MAX_MB", 256)) * 1024 * 1024
+SOURCE_DOWNLOADERS = {
+    "src": download_source_image,
+    "msk": download_source_mask,
+}
+
+
+class SourceImageCache:
+    def __init__(self, max_entries=SOURCE_IMAGE_CACHE_MAX_ENTRIES, max_bytes=SOURCE_IMAGE_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        # The transcodes currently running, so that a pop waits for them instead of starting its own
+        self.in_flight = {}
+        self.lock = Lock()
+        self.transcode_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="source_image_transcode")
+
+    def get(self, wp_id, kind):
+        key = (str(wp_id), kind)
+        with self.lock:
+            encoded = self.entries.get(key)
+            if encoded is not None:
+                self.entries.move_to_end(key)
+                return encoded
+            future = self.in_flight.get(key)
+        return future.result() if future is not None else None
+
+    def store(self, wp_id, kind, encoded):
+        key = (str(wp_id), kind)
+        size = len(encoded)
+        # A single image which doesn't fit in the budget would just evict everything else
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= len(self.entries.pop(key))
+            self.entries[key] = encoded
+            self.total_bytes += size
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= len(evicted)
+
+    def transcode(self, wp_id, kind, image=None):
+        """Encodes the source image to base64 and caches it
+        If the image is not provided, it is downloaded from R2
+        """
+        try:
+            if image is None:
+                image = SOURCE_DOWNLOADERS[kind](wp_id)
+            if image is None:
+                return None
+            encoded = convert_pil_to_b64(image, 50)
+            self.store(wp_id, kind, encoded)
+            return encoded
+        except Exception as err:
+            logger.error(f"Failed to transcode the {kind} image of WP {wp_id}: {err}")
+            return None
+
+    def transcode_in_flight(self, future, wp_id, kind, image=None):
+        try:
+            future.set_result(self.transcode(wp_id, kind, image))
+        except BaseException as err:
+            future.set_exception(err)
+            raise
+        finally:
+            key = (str(wp_id), kind)
+            with self.lock:
+                # Only forget the transcode this call registered
+                if self.in_flight.get(key) is future:
+                    del self.in_flight[key]
+
+    def warm(self, wp_id, kind, image=None):
+        """Starts transcoding the source image in the background, so that the first pop doesn't have to wait for it"""
+        key = (str(wp_id), kind)
+        with self.lock:
+            if key in self.entries or key in self.in_flight:
+                return
+            future = Future()
+            self.in_flight[key] = future
+        self.transcode_pool.submit(self.transcode_in_flight, future, wp_id, kind, image)
+
+    def get_encoded(self, wp_id, kind):
+        """Returns the base64 source image of the WP, transcoding it if this is the first time we need it
+        Returns None if the image could not be retrieved
+        """
+        encoded = self.get(wp_id, kind)
+        if encoded is not None:
+            return encoded
+        return self.transcode(wp_id, kind)
+
+    def discard(self, wp_id):
+        with self.lock:
+            for kind in SOURCE_DOWNLOADERS:
+                encoded = self.entries.pop((str(wp_id), kind), None)
+                if encoded is not None:
+                    self.total_bytes -= len(encoded)
+
+
+source_image_cache = SourceImageCache()
@@ -0,0 +1,108 @@
+# SPDX-FileCopyrightText: 2022 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Write-behind ledger for the per-action kudos details and the user records.
+
+Every job used to SELECT and COMMIT each of these rows on its own. Instead we accumulate the deltas in redis
+and the primary flushes them to the DB in bulk every few seconds.
+The kudos balances themselves (user.kudos, worker.kudos) are never kept here. They're still written to the DB
+immediately, so anything which checks a balance reads the committed value.
+Reads of the details should go through get_pending_deltas() so that they include what hasn't been flushed yet.
+"""
+
+from horde.horde_redis import horde_redis as hr
+from horde.logger import logger
+
+LEDGER_TYPES = {"user_stats", "user_records", "worker_stats"}
+# The set of ledger keys which have deltas waiting to be flushed
+LEDGER_DIRTY_KEY = "stats_ledger_dirty"
+LEDGER_FLUSH_BATCH = 1000
+# How long a single flush keeps popping batches, so that it finishes before the next one is due
+LEDGER_FLUSH_TIME_BUDGET = 4
+
+
+def get_ledger_key(ledger_type, entity_id):
+    return f"stats_ledger:{ledger_type}:{entity_id}"
+
+
+def record_delta(ledger_type, entity_id, field, delta):
+    """Adds the delta to the ledger
+    Returns False if the ledger is not available, in which case the caller has to write to the DB directly
+    """
+    if hr.horde_r is None:
+        return False
+    key = get_ledger_key(ledger_type, entity_id)
+    try:
+        pipe = hr.horde_r.pipeline(transaction=True)
+        pipe.hincrbyfloat(key, field, delta)
+        pipe.sadd(LEDGER_DIRTY_KEY, key)
+        pipe.execute()
+    except Exception as err:
+        logger.warning(f"Could not record {ledger_type} delta in the stats ledger: {err}")
+        return False
+    return True
+
+
+def get_pending_deltas(ledger_type, entity_id):
+    """Returns the deltas of this entity which have not been flushed to the DB yet, as a dict of field -> delta"""
+    if hr.horde_r is None:
+        return {}
+    try:
+        pending = hr.horde_r.hgetall(get_ledger_key(ledger_type, entity_id))
+    except Exception as err:
+        logger.warning(f"Could not read the pending {ledger_type} deltas from the stats ledger: {err}")
+        return {}
+    return {field: float(delta) for field, delta in pending.items()}
+
+
+def get_pending_deltas_bulk(ledger_type, entity_ids):
+    """Same as get_pending_deltas() but for many entities in one round trip
+    Returns a dict of entity_id -> dict of field -> delta
+    """
+    if hr.horde_r is None or len(entity_ids) == 0:
+        return {}
+    try:
+        pipe = hr.horde_r.pipeline(transaction=False)
+        for entity_id in entity_ids:
+            pipe.hgetall(get_ledger_key(ledger_type, entity_id))
+        results = pipe.execute()
+    except Exception as err:
+        logger.warning(f"Could not read the pending {ledger_type} deltas from the stats ledger: {err}")
+        return {}
+    return {
+        entity_id: {field: float(delta) for field, delta in pending.items()}
+        for entity_id, pending in zip(entity_ids, results)
+        if len(pending) > 0
+    }
+
+
+def pop_pending_deltas():
+    """Takes the accumulated deltas out of the ledger
+    Each hash is read and deleted in the same transaction, so no increment can fall between the two.
+    Returns a dict of ledger_type -> list of (entity_id, field, delta)
+    and whether there might be more deltas waiting after this batch
+    """
+    ret_dict = {ledger_type: [] for ledger_type in LEDGER_TYPES}
+    if hr.horde_r is None:
+        return ret_dict, False
+    keys = hr.horde_r.spop(LEDGER_DIRTY_KEY, LEDGER_FLUSH_BATCH)
+    if not keys:
+        return ret_dict, False
+    pipe = hr.horde_r.pipeline(transaction=True)
+    for key in keys:
+        pipe.hgetall(key)
+        pipe.delete(key)
+    results = pipe.execute()
+    for key, pending in zip(keys, results[::2]):
+        _, ledger_type, entity_id = key.split(":", 2)
+        for field, delta in pending.items():
+            ret_dict[ledger_type].append((entity_id, field, float(delta)))
+    return ret_dict, len(keys) >= LEDGER_FLUSH_BATCH
+
+
+def restore_pending_deltas(pending_deltas):
+    """Puts back deltas which we failed to flush, so that they're retried on the next flush"""
+    for ledger_type, deltas in pending_deltas.items():
+        for entity_id, field, delta in deltas:
+            record_delta(ledger_type, entity_id, field, delta)
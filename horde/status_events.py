@@ -0,0 +1,264 @@
+# SPDX-FileCopyrightText: 2022 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Snapshots of the status of each waiting prompt, and notifications of their changes.
+
+Every pop, submit, fault and cancellation stores the new state of the WP in a redis hash and publishes on the redis
+channel of the WP. The primary refreshes the queue position and the queue wait in the same hashes every second,
+so that checking the status of a request only needs redis. The snapshot also keeps what a worker needs to serve the WP,
+so that whether it's possible can be checked against the summary of the active workers.
+
+Each node runs a single listener on all those channels, which wakes up the requests waiting on that WP,
+for the clients which wait for changes instead of polling.
+As our WSGI server only has a fixed amount of threads, each node only lets a few requests wait at the same time.
+"""
+
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+from horde.horde_redis import horde_redis as hr
+from horde.logger import logger
+
+STATUS_CHANNEL_PREFIX = "wp_status:"
+# How many requests can be waiting for status changes on this node at the same time
+STATUS_WAITERS_LIMIT = int(os.getenv("STATUS_WAITERS_LIMIT", 10))
+# Status streams are closed after this long, so that a client can't hold on to a thread forever
+STATUS_STREAM_MAX_SECONDS = 300
+# How often a status stream sends the status even when it hasn't changed, so that the ETA stays up to date
+STATUS_REFRESH_SECONDS = 15
+# We can only answer from the snapshot once all of these have been stored
+STATUS_SNAPSHOT_FIELDS = [
+    "finished",
+    "processing",
+    "restarted",
+    "waiting",
+    "done",
+    "faulted",
+    "kudos",
+    "processing_until",
+    "queue_position",
+    "queue_wait",
+    "worker_requirements",
+    "wp_type",
+]
+# Nodes store the snapshot after their own commit, without any ordering between them,
+# so an older state is only written if the snapshot doesn't already hold a newer version
+STORE_SNAPSHOT_SCRIPT = """
+local current_version = redis.call("HGET", KEYS[1], "version")
+if current_version and tonumber(current_version) > tonumber(ARGV[1]) then
+    return 0
+end
+redis.call("HSET", KEYS[1], unpack(cjson.decode(ARGV[2])))
+redis.call("EXPIRE", KEYS[1], ARGV[3])
+return 1
+"""
+store_snapshot_script = None
+UPDATE_SNAPSHOTS_SCRIPT = """
+for iter, key in ipairs(KEYS) do
+    if redis.call("EXISTS", key) == 1 then
+        redis.call("HSET", key, unpack(cjson.decode(ARGV[iter])))
+    end
+end
+"""
+update_snapshots_script = None
+
+
+def publish_status_change(wp_id, event):
+    if hr.horde_r is None:
+        return
+    try:
+        hr.horde_r.publish(f"{STATUS_CHANNEL_PREFIX}{wp_id}", event)
+    except Exception as err:
+        logger.warning(f"Could not publish the {event} status change of WP {wp_id}: {err}")
+
+
+def get_snapshot_key(wp_id):
+    return f"wp_status_snapshot:{wp_id}"
+
+
+def serialize_snapshot_fields(fields):
+    return {field: int(value) if isinstance(value, bool) else value for field, value in fields.items()}
+
+
+def store_status_snapshot(wp_id, fields, expiry):
+    """Stores the state of the WP in its snapshot, which lives until the WP expires
+    If the fields have a version, they are only stored if the snapshot doesn't already have a newer one
+    """
+    global store_snapshot_script
+    if hr.horde_r is None:
+        return
+    expiry_seconds = max(int((expiry - datetime.utcnow()).total_seconds()), 60)
+    serialized_fields = serialize_snapshot_fields(fields)
+    try:
+        if "version" in serialized_fields:
+            if store_snapshot_script is None:
+                store_snapshot_script = hr.horde_r.register_script(STORE_SNAPSHOT_SCRIPT)
+            store_snapshot_script(
+                keys=[get_snapshot_key(wp_id)],
+                args=[
+                    serialized_fields["version"],
+                    json.dumps([item for field_value in serialized_fields.items() for item in field_value]),
+                    expiry_seconds,
+                ],
+            )
+            return
+        pipe = hr.horde_r.pipeline(transaction=True)
+        pipe.hset(get_snapshot_key(wp_id), mapping=serialized_fields)
+        pipe.expire(get_snapshot_key(wp_id), expiry_seconds)
+        pipe.execute()
+    except Exception as err:
+        logger.warning(f"Could not store the status snapshot of WP {wp_id}: {err}")
+
+
+def update_status_snapshots(snapshot_updates):
+    """Updates fields in the snapshots of many WPs at once
+    snapshot_updates is a dict of wp_id -> dict of fields
+    Snapshots which don't exist are not created, as they would be missing their state
+    """
+    global update_snapshots_script
+    if hr.horde_r is None or len(snapshot_updates) == 0:
+        return
+    keys = []
+    args = []
+    for wp_id, fields in snapshot_updates.items():
+        keys.append(get_snapshot_key(wp_id))
+        args.append(json.dumps([item for field_value in serialize_snapshot_fields(fields).items() for item in field_value]))
+    try:
+        if update_snapshots_script is None:
+            update_snapshots_script = hr.horde_r.register_script(UPDATE_SNAPSHOTS_SCRIPT)
+        for iter in range(0, len(keys), 1000):
+            update_snapshots_script(keys=keys[iter : iter + 1000], args=args[iter : iter + 1000])
+    except Exception as err:
+        logger.warning(f"Could not update the status snapshots: {err}")
+
+
+def delete_status_snapshot(wp_id):
+    if hr.horde_r is None:
+        return
+    try:
+        hr.horde_r.delete(get_snapshot_key(wp_id))
+    except Exception as err:
+        logger.warning(f"Could not delete the status snapshot of WP {wp_id}: {err}")
+
+
+def get_status_snapshot(wp_id, wp_type):
+    """Returns the lite status of the WP from its snapshot
+    The caller needs to replace the worker_requirements with is_possible
+    Returns None if the snapshot doesn't exist, isn't complete yet or belongs to a WP of another type,
+    in which case it needs to be calculated from the DB
+    """
+    if hr.horde_r is None:
+        return None
+    try:
+        snapshot = hr.horde_r.hgetall(get_snapshot_key(wp_id))
+    except Exception as err:
+        logger.warning(f"Could not read the status snapshot of WP {wp_id}: {err}")
+        return None
+    if any(field not in snapshot for field in STATUS_SNAPSHOT_FIELDS):
+        return None
+    if snapshot["wp_type"] != wp_type:
+        return None
+    # The processing gens keep counting down after the snapshot was stored
+    processing_time_left = max(float(snapshot["processing_until"]) - time.time(), 0)
+    return {
+        "finished": int(snapshot["finished"]),
+        "processing": int(snapshot["processing"]),
+        "restarted": int(snapshot["restarted"]),
+        "waiting": int(snapshot["waiting"]),
+        "done": bool(int(snapshot["done"])),
+        "faulted": bool(int(snapshot["faulted"])),
+        "wait_time": round(float(snapshot["queue_wait"]) + processing_time_left),
+        "queue_position": int(snapshot["queue_position"]),
+        "kudos": int(snapshot["kudos"]),
+        "worker_requirements": json.loads(snapshot["worker_requirements"]),
+    }
+
+
+class StatusSubscription:
+    def __init__(self, listener, wp_id):
+        self.listener = listener
+        self.wp_id = str(wp_id)
+        self.changed = threading.Event()
+
+    def wait(self, timeout):
+        """Returns True if the status changed since the last wait, or False if we timed out"""
+        changed = self.changed.wait(timeout)
+        self.changed.clear()
+        return changed
+
+    def __enter__(self):
+        self.listener.add_subscription(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.listener.remove_subscription(self)
+
+
+class StatusChangeListener:
+    def __init__(self):
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.waiter_slots = threading.BoundedSemaphore(STATUS_WAITERS_LIMIT)
+
+    def acquire_waiter_slot(self):
+        """Returns False if this node already has as many waiting requests as it can afford"""
+        if hr.horde_r is None:
+            return False
+        return self.waiter_slots.acquire(blocking=False)
+
+    def release_waiter_slot(self):
+        self.waiter_slots.release()
+
+    def subscribe(self, wp_id):
+        """Use as a context manager. Subscribe before reading the status, so that no change can be missed in-between"""
+        return StatusSubscription(self, wp_id)
+
+    def add_subscription(self, subscription):
+        with self.lock:
+            # We start the thread on first use, so that just importing the API doesn't start it
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.listen, daemon=True)
+                self.thread.start()
+            self.subscriptions.setdefault(subscription.wp_id, set()).add(subscription)
+
+    def remove_subscription(self, subscription):
+        with self.lock:
+            wp_subscriptions = self.subscriptions.get(subscription.wp_id)
+            if wp_subscriptions is None:
+                return
+            wp_subscriptions.discard(subscription)
+            if len(wp_subscriptions) == 0:
+                del self.subscriptions[subscription.wp_id]
+
+    def notify(self, wp_id=None):
+        """Wakes up the subscriptions of the WP, or all of them if no WP is given"""
+        with self.lock:
+            if wp_id is None:
+                subscriptions = [s for wp_subscriptions in self.subscriptions.values() for s in wp_subscriptions]
+            else:
+                subscriptions = list(self.subscriptions.get(wp_id, []))
+        for subscription in subscriptions:
+            subscription.changed.set()
+
+    def listen(self):
+        while True:
+            try:
+                pubsub = hr.horde_r.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(f"{STATUS_CHANNEL_PREFIX}*")
+                # We might have missed changes while we were disconnected, so everyone should check again
+                self.notify()
+                for message in pubsub.listen():
+                    if message["type"] != "pmessage":
+                        continue
+                    self.notify(message["channel"][len(STATUS_CHANNEL_PREFIX) :])
+            except Exception as err:
+                logger.warning(f"Lost the WP status change subscription. Reconnecting: {err}")
+                time.sleep(1)
+
+
+status_change_listener = StatusChangeListener()
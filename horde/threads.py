@@ -2,61 +2,302 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import heapq
+import itertools
+import os
+import random
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
+from horde.change_events import change_listener
 from horde.logger import logger
 from horde.vars import horde_instance_id
 
+# How many timed functions can run at the same time on this node
+SCHEDULER_THREADS = int(os.getenv("SCHEDULER_THREADS", 8))
+# Each run is delayed randomly by up to this fraction of the interval, so that functions with the same interval
+# don't all hit the DB at the same moment
+SCHEDULER_JITTER = 0.1
+SCHEDULER_MAX_JITTER = 2
+# When a run takes longer than the interval, the interval is stretched to this multiple of the run duration
+INTERVAL_STRETCH_FACTOR = 1.5
+# But never beyond this multiple of the configured interval
+MAX_INTERVAL_STRETCH = 10
+# A function running longer than this is reported as stuck
+STUCK_SECONDS = 60
+# The upper bounds in seconds of the buckets of the lateness histogram
+LATENESS_BUCKETS = [0.01, 0.1, 0.5, 1, 5, 30]
+METRICS_LOG_SECONDS = 300
+
+
+class TaskScheduler:
+    """Runs all the timed functions of this node from a single scheduling thread and a shared thread pool
+    so that a slow function only delays itself and not the rest.
+    The due times are kept in a heap against the monotonic clock. A function is never run concurrently with itself,
+    as its next run is only scheduled once the current one finishes.
+    """
+
+    def __init__(self, max_workers=SCHEDULER_THREADS):
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="primary_timed_function")
+        self.tasks = []
+        self.thread = None
+
+    def add(self, task):
+        with self.condition:
+            self.tasks.append(task)
+            # We start the thread on first use, so that just importing this doesn't start it
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.schedule(task, time.monotonic())
+
+    def schedule(self, task, due):
+        with self.condition:
+            task.due = due
+            heapq.heappush(self.heap, (due, next(self.counter), task))
+            self.condition.notify()
+
+    def reschedule_earlier(self, task, due):
+        """Moves the next run of the task earlier, unless it's already due earlier or currently running"""
+        with self.condition:
+            if task.due is None or task.due <= due:
+                return
+            self.schedule(task, due)
+
+    def run(self):
+        last_stuck_check = time.monotonic()
+        while True:
+            with self.condition:
+                now = time.monotonic()
+                if len(self.heap) == 0 or self.heap[0][0] > now:
+                    timeout = 10 if len(self.heap) == 0 else min(self.heap[0][0] - now, 10)
+                    self.condition.wait(timeout)
+                    task = None
+                else:
+                    due, _, task = heapq.heappop(self.heap)
+                    # Entries which were rescheduled or cancelled are left in the heap and skipped here
+                    if task.due != due or task.cancel:
+                        task = None
+                    else:
+                        task.due = None
+            if task is not None:
+                self.pool.submit(task.execute, due)
+            if time.monotonic() - last_stuck_check >= 10:
+                self.check_stuck_tasks()
+                last_stuck_check = time.monotonic()
+
+    def check_stuck_tasks(self):
+        now = time.monotonic()
+        for task in self.tasks:
+            running_since = task.running_since
+            if running_since is not None and now - running_since > STUCK_SECONDS:
+                logger.critical(f"Thead {task.name}() stuck in processing for {round(now - running_since)} seconds!")
+
+
+scheduler = TaskScheduler()
+
 
 class PrimaryTimedFunction:
+    """Runs the function every interval seconds, at a fixed rate
+    When a quorum is provided, it only runs on the primary node
+    """
+
     def __init__(self, interval, function, args=None, kwargs=None, quorum=None):
         self.interval = interval
+        self.current_interval = interval
         self.function = function
-        self.processing = False
-        self.processing_skips = 0
         self.cancel = False
         self.args = args if args is not None else []
         self.kwargs = kwargs if kwargs is not None else {}
         self.quorum_thread = quorum
-        self.thread = threading.Thread(target=self.run, args=())
-        self.thread.daemon = True
-        self.thread.start()
+        self.due = None
+        self.next_tick = None
+        self.running_since = None
+        self.metrics = {
+            "runs": 0,
+            "overruns": 0,
+            "skipped_ticks": 0,
+            "duration_total": 0,
+            "duration_max": 0,
+            "lateness": [0] * (len(LATENESS_BUCKETS) + 1),
+        }
+        self.last_metrics_log = time.monotonic()
+        scheduler.add(self)
         if self.function:
-            logger.init_ok(f"PrimaryTimedFunction for {self.function.__name__}()", status="Started")
+            logger.init_ok(f"PrimaryTimedFunction for {self.name}()", status="Started")
 
-    def run(self):
-        while True:
-            try:
-                # Everything starts the thread, but only the primary does something with it.
-                # This allows me to change the primary node on-the-fly
-                if self.cancel:
-                    break
-                if self.quorum_thread and self.quorum_thread.quorum != horde_instance_id:
-                    time.sleep(self.interval)
-                    continue
-                if self.processing:
-                    self.processing_skips += 1
-                    if self.processing_skips > 5:
-                        logger.critical(
-                            f"Thead {self.function.__name__}() " f"stuck in processing for {self.processing_skips * 10} seconds!",
-                        )
-                    time.sleep(10)
-                    continue
-                self.processing_skips = 0
-                self.processing = True
+    @property
+    def name(self):
+        if self.function:
+            return self.function.__name__
+        return type(self).__name__
+
+    def execute(self, due):
+        started = time.monotonic()
+        self.running_since = started
+        if self.next_tick is None:
+            self.next_tick = started
+        ran = False
+        try:
+            self.prepare_run(started)
+            # Everything schedules the function, but only the primary does something with it.
+            # This allows me to change the primary node on-the-fly
+            if not self.quorum_thread or self.quorum_thread.quorum == horde_instance_id:
+                ran = True
                 self.call_function()
-                self.processing = False
-                time.sleep(self.interval)
-            except Exception as e:
-                logger.error(f"Exception caught in PrimaryTimer for method {self.function.__name__}(). Avoiding! {e}")
-                self.processing = False
-                time.sleep(10)
+        except Exception as e:
+            logger.error(f"Exception caught in PrimaryTimer for method {self.name}(). Avoiding! {e}")
+        finally:
+            duration = time.monotonic() - started
+            if ran:
+                self.record_run(started - due, duration)
+            # Under the scheduler's lock, so that a change notified in-between isn't missed by the next run
+            with scheduler.condition:
+                self.running_since = None
+                if not self.cancel:
+                    scheduler.schedule(self, self.get_next_due(started, duration))
 
     # Putting this in its own method, so I can extend it
     def call_function(self):
         self.function(*self.args, **self.kwargs)
 
+    # To override
+    def prepare_run(self, started):
+        pass
+
+    def get_next_due(self, started, duration):
+        self.stretch_interval(duration)
+        # We keep to a fixed grid of ticks, so that the time each run takes doesn't make the interval drift
+        next_tick = self.next_tick + self.current_interval
+        now = time.monotonic()
+        if next_tick <= now:
+            # We overran into the next ticks. We skip them instead of running back-to-back to catch up
+            skipped_ticks = int((now - next_tick) // self.current_interval) + 1
+            self.metrics["skipped_ticks"] += skipped_ticks
+            next_tick += skipped_ticks * self.current_interval
+        self.next_tick = next_tick
+        return next_tick + self.get_jitter()
+
+    def get_jitter(self):
+        return random.uniform(0, min(self.current_interval * SCHEDULER_JITTER, SCHEDULER_MAX_JITTER))
+
+    def stretch_interval(self, duration):
+        """When a run takes longer than the interval, we run the function less often,
+        and go back to the normal interval once it's fast enough again
+        """
+        if duration > self.current_interval:
+            self.metrics["overruns"] += 1
+            self.current_interval = min(duration * INTERVAL_STRETCH_FACTOR, self.interval * MAX_INTERVAL_STRETCH)
+            logger.warning(
+                f"{self.name}() took {round(duration, 2)} seconds, longer than its interval. "
+                f"Stretching its interval to {round(self.current_interval, 2)} seconds.",
+            )
+        elif self.current_interval > self.interval and duration < self.interval:
+            self.current_interval = self.interval
+            logger.info(f"{self.name}() is running fast enough again. Restored its interval to {self.interval} seconds.")
+
+    def record_run(self, lateness, duration):
+        self.metrics["runs"] += 1
+        self.metrics["duration_total"] += duration
+        self.metrics["duration_max"] = max(self.metrics["duration_max"], duration)
+        bucket = 0
+        while bucket < len(LATENESS_BUCKETS) and lateness > LATENESS_BUCKETS[bucket]:
+            bucket += 1
+        self.metrics["lateness"][bucket] += 1
+        if time.monotonic() - self.last_metrics_log >= METRICS_LOG_SECONDS:
+            logger.debug(f"PrimaryTimedFunction metrics for {self.name}(): {self.get_metrics()}")
+            self.last_metrics_log = time.monotonic()
+
+    def get_metrics(self):
+        lateness_labels = [f"<={bucket}s" for bucket in LATENESS_BUCKETS] + [f">{LATENESS_BUCKETS[-1]}s"]
+        return {
+            "runs": self.metrics["runs"],
+            "overruns": self.metrics["overruns"],
+            "skipped_ticks": self.metrics["skipped_ticks"],
+            "interval": round(self.current_interval, 2),
+            "avg_duration": round(self.metrics["duration_total"] / max(self.metrics["runs"], 1), 3),
+            "max_duration": round(self.metrics["duration_max"], 3),
+            "lateness": dict(zip(lateness_labels, self.metrics["lateness"])),
+        }
+
     def stop(self):
         self.cancel = True
-        logger.init_ok(f"PrimaryTimedFunction for {self.function.__name__}()", status="Stopped")
+        logger.init_ok(f"PrimaryTimedFunction for {self.name}()", status="Stopped")
+
+
+class PrimaryEventFunction(PrimaryTimedFunction):
+    """Runs the function when the data it depends on changes, instead of on every interval
+    The interval becomes the longest we go without running it, in case a change notification got lost
+    or something changed which doesn't send one.
+    A change is only acted upon after the debounce delay, so that a burst of changes causes a single run,
+    and the function never runs more often than min_interval.
+    """
+
+    def __init__(self, interval, function, topics, min_interval=1, debounce=0.25, args=None, kwargs=None, quorum=None):
+        self.topics = topics
+        self.min_interval = min_interval
+        self.debounce = debounce
+        self.first_change = None
+        self.run_change = None
+        self.last_run = 0
+        self.event_metrics = {
+            "notifications": 0,
+            "change_runs": 0,
+            "interval_runs": 0,
+            "latency_total": 0,
+            "latency_max": 0,
+        }
+        super().__init__(interval, function, args=args, kwargs=kwargs, quorum=quorum)
+        change_listener.register(self, topics)
+
+    def notify_change(self):
+        with scheduler.condition:
+            self.event_metrics["notifications"] += 1
+            if self.first_change is not None:
+                return
+            self.first_change = time.monotonic()
+            # When it's running, the next run is scheduled once it finishes
+            if self.running_since is not None:
+                return
+            due = max(self.first_change + self.debounce, self.last_run + self.min_interval)
+            scheduler.reschedule_earlier(self, due)
+
+    def prepare_run(self, started):
+        # Any change from now on needs another run, as we might not see it in this one.
+        # The non-primary nodes discard their changes here as well
+        with scheduler.condition:
+            self.run_change = self.first_change
+            self.first_change = None
+        self.last_run = started
+
+    def record_run(self, lateness, duration):
+        if self.run_change is None:
+            self.event_metrics["interval_runs"] += 1
+        else:
+            # How long the cache stayed stale after the change
+            latency = self.last_run + duration - self.run_change
+            self.event_metrics["change_runs"] += 1
+            self.event_metrics["latency_total"] += latency
+            self.event_metrics["latency_max"] = max(self.event_metrics["latency_max"], latency)
+        super().record_run(lateness, duration)
+
+    def get_next_due(self, started, duration):
+        self.stretch_interval(duration)
+        if self.first_change is not None:
+            # A slow function shouldn't end up running back-to-back just because things keep changing
+            min_interval = max(self.min_interval, duration * INTERVAL_STRETCH_FACTOR)
+            return max(self.first_change + self.debounce, started + min_interval)
+        return time.monotonic() + self.current_interval + self.get_jitter()
+
+    def get_metrics(self):
+        metrics = super().get_metrics()
+        metrics["notifications"] = self.event_metrics["notifications"]
+        metrics["change_runs"] = self.event_metrics["change_runs"]
+        metrics["interval_runs"] = self.event_metrics["interval_runs"]
+        metrics["avg_latency"] = round(self.event_metrics["latency_total"] / max(self.event_metrics["change_runs"], 1), 3)
+        metrics["max_latency"] = round(self.event_metrics["latency_max"], 3)
+        return metrics
@@ -0,0 +1,180 @@
+# SPDX-FileCopyrightText: 2022 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+"""Delivers the webhooks of finished generations and interrogations in the background.
+
+Webhooks used to be sent inside the worker's submit request, with up to three blocking attempts, so a dead client
+endpoint would slow down the worker. Now the request only queues the payload and returns.
+Failed deliveries are retried with exponential backoff. The retries are kept in a redis sorted set scored by when
+they're due, so they survive restarts and any node can pick them up.
+"""
+
+import json
+import os
+import queue
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from horde.horde_redis import horde_redis as hr
+from horde.logger import logger
+
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 10000))
+WEBHOOK_THREADS = int(os.getenv("WEBHOOK_THREADS", 8))
+WEBHOOK_HOST_CONCURRENCY = int(os.getenv("WEBHOOK_HOST_CONCURRENCY", 4))
+WEBHOOK_MAX_ATTEMPTS = 5
+WEBHOOK_TIMEOUT = 3
+WEBHOOK_RETRY_KEY = "webhook_retries"
+
+
+class WebhookDispatcher:
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=100, pool_maxsize=WEBHOOK_THREADS)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.host_slots = {}
+        self.threads = []
+        self.thread_lock = threading.Lock()
+        self.metrics = {
+            "queued": 0,
+            "delivered": 0,
+            "failed_attempts": 0,
+            "retries_scheduled": 0,
+            "abandoned": 0,
+            "dropped": 0,
+        }
+        self.metrics_lock = threading.Lock()
+
+    def count(self, metric):
+        with self.metrics_lock:
+            self.metrics[metric] += 1
+
+    def get_metrics(self):
+        with self.metrics_lock:
+            metrics = self.metrics.copy()
+        metrics["queue_size"] = self.queue.qsize()
+        return metrics
+
+    def start(self):
+        # We start the threads on first use, so that just importing the models doesn't start them
+        with self.thread_lock:
+            if len(self.threads) > 0:
+                return
+            for _ in range(WEBHOOK_THREADS):
+                self.threads.append(threading.Thread(target=self.run, daemon=True))
+            self.threads.append(threading.Thread(target=self.poll_retries, daemon=True))
+            for thread in self.threads:
+                thread.start()
+
+    def send(self, webhook_url, data, webhook_type, attempt=0):
+        """Queues the webhook for delivery. This never blocks.
+        data needs to be JSON serializable
+        """
+        if len(self.threads) == 0:
+            self.start()
+        try:
+            self.queue.put_nowait(
+                {
+                    "url": webhook_url,
+                    "data": data,
+                    "type": webhook_type,
+                    "attempt": attempt,
+                },
+            )
+            self.count("queued")
+        except queue.Full:
+            self.count("dropped")
+            logger.warning(f"Webhook queue is full. Dropping {webhook_type} webhook to {webhook_url}")
+
+    def get_host_slot(self, webhook_url):
+        host = urlsplit(webhook_url).netloc
+        with self.thread_lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(WEBHOOK_HOST_CONCURRENCY)
+            return self.host_slots[host]
+
+    def run(self):
+        while True:
+            webhook = self.queue.get()
+            host_slot = self.get_host_slot(webhook["url"])
+            # A slow host shouldn't be able to take up all our threads, so if it already has all its slots busy
+            # we put the webhook aside for a bit and move on
+            if not host_slot.acquire(blocking=False):
+                if self.schedule_retry(webhook, delay=1, failed=False):
+                    continue
+                host_slot.acquire()
+            try:
+                self.deliver(webhook)
+            finally:
+                host_slot.release()
+
+    def deliver(self, webhook):
+        try:
+            req = self.session.post(webhook["url"], json=webhook["data"], timeout=WEBHOOK_TIMEOUT)
+            if req.ok:
+                self.count("delivered")
+                return
+            logger.debug(f"Something went wrong when sending {webhook['type']} webhook: {req.status_code} - {req.text}.")
+        except Exception as err:
+            logger.debug(f"Exception when sending {webhook['type']} webhook: {err}.")
+        self.count("failed_attempts")
+        self.schedule_retry(webhook)
+
+    def schedule_retry(self, webhook, delay=None, failed=True):
+        """Puts the webhook in the retry set, to be sent again after the delay
+        Returns False if it could not be scheduled
+        """
+        if failed:
+            webhook = webhook.copy()
+            webhook["attempt"] += 1
+            if webhook["attempt"] >= WEBHOOK_MAX_ATTEMPTS:
+                self.count("abandoned")
+                logger.debug(f"Giving up on {webhook['type']} webhook to {webhook['url']} after {webhook['attempt']} attempts")
+                return False
+        if delay is None:
+            # 2, 4, 8, 16 seconds, with some jitter so that the retries to the same host don't all arrive together
+            delay = 2 ** webhook["attempt"] * random.uniform(0.8, 1.2)
+        if hr.horde_r is None:
+            if failed:
+                self.count("abandoned")
+            return False
+        try:
+            hr.horde_r.zadd(WEBHOOK_RETRY_KEY, {json.dumps(webhook): time.time() + delay})
+        except Exception as err:
+            if failed:
+                self.count("abandoned")
+            logger.warning(f"Could not schedule {webhook['type']} webhook retry: {err}")
+            return False
+        if failed:
+            self.count("retries_scheduled")
+        return True
+
+    def poll_retries(self):
+        last_metrics_log = time.monotonic()
+        while True:
+            time.sleep(1)
+            if time.monotonic() - last_metrics_log >= 60:
+                logger.debug(f"Webhook metrics: {self.get_metrics()}")
+                last_metrics_log = time.monotonic()
+            if hr.horde_r is None:
+                continue
+            try:
+                due_webhooks = hr.horde_r.zrangebyscore(WEBHOOK_RETRY_KEY, 0, time.time(), start=0, num=100)
+                for due_webhook in due_webhooks:
+                    # Every node polls the same set, so only the one which manages to remove it gets to send it
+                    if hr.horde_r.zrem(WEBHOOK_RETRY_KEY, due_webhook) == 0:
+                        continue
+                    webhook = json.loads(due_webhook)
+                    self.send(webhook["url"], webhook["data"], webhook["type"], webhook["attempt"])
+            except Exception as err:
+                logger.warning(f"Failed to poll webhook retries: {err}")
+
+
+webhook_dispatcher = WebhookDispatcher()
@@ -0,0 +1,17 @@
+# SPDX-FileCopyrightText: 2022 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import sys
+
+import pytest
+
+# Importing the horde package parses the arguments of the server, so we give it the ones the test server uses
+if "--horde" not in sys.argv:
+    sys.argv = [sys.argv[0], "--horde", "stable"]
+
+
+@pytest.fixture(autouse=True, scope="session")
+def increase_kudos() -> None:
+    """The unit tests don't talk to a horde, so there's nobody to give kudos to"""
+    return None
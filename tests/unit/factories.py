@@ -0,0 +1,18 @@
+# SPDX-FileCopyrightText: 2022 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import copy
+from types import SimpleNamespace
+
+
+def build_dict(defaults: dict, **kwargs) -> dict:
+    """Returns a copy of the defaults with the given fields overridden"""
+    built = copy.deepcopy(defaults)
+    built.update(kwargs)
+    return built
+
+
+def build_namespace(defaults: dict, **kwargs) -> SimpleNamespace:
+    """Same as build_dict(), for the code which reads the fields as attributes, like it does on the DB objects"""
+    return SimpleNamespace(**build_dict(defaults, **kwargs))
@@ -0,0 +1,97 @@
+# SPDX-FileCopyrightText: 2022 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+from horde.database.classes import ImageWPMatchIndex
+from tests.unit.factories import build_dict, build_namespace
+
+WORKER_ID = uuid.UUID("11111111-1111-1111-1111-111111111111")
+OTHER_WORKER_ID = uuid.UUID("22222222-2222-2222-2222-222222222222")
+WP_ROW = {
+    "pixels": 512 * 512,
+    "required": 0,
+    "user_id": 2,
+    "worker_blacklist": False,
+    "models": ["sd_model"],
+    "workers": [],
+}
+IMAGE_WORKER = {
+    "id": WORKER_ID,
+    "user_id": 1,
+    "max_pixels": 1024 * 1024,
+    "maintenance": False,
+}
+
+
+def wp_row(wp_number: int, **kwargs) -> dict:
+    return build_dict(WP_ROW, id=str(uuid.UUID(int=wp_number)), **kwargs)
+
+
+def image_worker(**kwargs) -> SimpleNamespace:
+    return build_namespace(IMAGE_WORKER, **kwargs)
+
+
+def candidate_numbers(index: ImageWPMatchIndex, worker: SimpleNamespace, capabilities: int = 0, models_list=None, **kwargs) -> list[int]:
+    if models_list is None:
+        models_list = ["sd_model"]
+    return [wp_id.int for wp_id in index.get_candidate_ids(worker, capabilities, models_list, **kwargs)]
+
+
+def test_candidates_keep_the_priority_order() -> None:
+    index = ImageWPMatchIndex(
+        [
+            wp_row(1, models=["other_model"]),
+            wp_row(2, models=[]),
+            wp_row(3),
+            wp_row(4, models=["sd_model", "other_model"]),
+        ],
+    )
+    assert candidate_numbers(index, image_worker()) == [2, 3, 4]
+    assert candidate_numbers(index, image_worker(), models_list=["other_model", "sd_model"]) == [1, 2, 3, 4]
+
+
+@pytest.mark.parametrize("models_list", [["horde_special::test"], ["SDXL_beta::stability.ai#6901"]])
+def test_special_models_skip_modelless_wps(models_list: list[str]) -> None:
+    index = ImageWPMatchIndex([wp_row(1, models=[]), wp_row(2, models=models_list)])
+    assert candidate_numbers(index, image_worker(), models_list=models_list) == [2]
+
+
+def test_pixels_and_capabilities_are_required() -> None:
+    index = ImageWPMatchIndex(
+        [
+            wp_row(1, pixels=2048 * 2048),
+            wp_row(2, required=ImageWPMatchIndex.NSFW | ImageWPMatchIndex.LORA),
+            wp_row(3, required=ImageWPMatchIndex.NSFW),
+        ],
+    )
+    assert candidate_numbers(index, image_worker()) == []
+    assert candidate_numbers(index, image_worker(), ImageWPMatchIndex.NSFW) == [3]
+    assert candidate_numbers(index, image_worker(), ImageWPMatchIndex.NSFW | ImageWPMatchIndex.LORA) == [2, 3]
+    assert candidate_numbers(index, image_worker(max_pixels=4096 * 4096), ImageWPMatchIndex.NSFW) == [1, 3]
+
+
+def test_maintenance_and_priority_users() -> None:
+    index = ImageWPMatchIndex([wp_row(1, user_id=1), wp_row(2), wp_row(3, user_id=3)])
+    assert candidate_numbers(index, image_worker(maintenance=True)) == [1]
+    assert candidate_numbers(index, image_worker(), priority_user_ids=[2, 3]) == [2, 3]
+    assert candidate_numbers(index, image_worker(maintenance=True), priority_user_ids=[3]) == [3]
+
+
+def test_worker_targeting() -> None:
+    index = ImageWPMatchIndex(
+        [
+            wp_row(1, workers=[str(WORKER_ID)]),
+            wp_row(2, workers=[str(OTHER_WORKER_ID)]),
+            wp_row(3, workers=[str(WORKER_ID)], worker_blacklist=True),
+            wp_row(4, workers=[str(OTHER_WORKER_ID)], worker_blacklist=True),
+            wp_row(5),
+        ],
+    )
+    assert candidate_numbers(index, image_worker()) == [1, 4, 5]
+    assert candidate_numbers(index, image_worker(), require_matched_targeting=True) == [4, 5]
+    assert candidate_numbers(index, image_worker(), priority_user_ids=[2], require_matched_targeting=True) == [1, 4, 5]
@@ -0,0 +1,68 @@
+# SPDX-FileCopyrightText: 2022 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import pytest
+import regex as re
+
+from horde.prompt_prefilter import PrefilteredRegex, extract_required_literals, split_alternatives
+
+# Each pattern with prompts it should and shouldn't match
+PATTERNS = [
+    ("kitten|puppy", ["a cute kitten", "PUPPY", "a cat"]),
+    (r"\bloli\b|child(?:ren)?\s*nud", ["loli girl", "children nude", "a lolita", "child"]),
+    ("(?:young|small) (?:girl|boy)s?|teen", ["small girls", "Teen", "young woman"]),
+    ("foo[[:alpha:]]bar", ["fooxbar", "foo1bar"]),
+    ("(?:kitten){e<=1}", ["kittan", "kitten", "dog"]),
+    ("abc[[:digit:]]{2}def", ["abc12def", "abcxxdef"]),
+    ("(?x) foo bar | baz qux ", ["bazqux", "foobar", "baz qux"]),
+    (r"(?i)nude|\p{Han}+", ["NUDE", "漢字", "clothed"]),
+    ("(?#(a|b)cat|dog", ["cat", "bcat", "dog", "a"]),
+    ("x(?|(a)|(b))yz|hello", ["xbyz", "hello", "xyz"]),
+    (r"\mword\M|other", ["a word here", "swordfish", "other"]),
+    ("İstanbul|ankara", ["istanbul", "İSTANBUL", "ankara"]),
+    ("[a[:digit:]]{3}x|zzz", ["a1ax", "123x", "zzz"]),
+]
+
+
+@pytest.mark.parametrize(("pattern", "prompts"), PATTERNS)
+def test_prefiltered_search_matches_full_regex(pattern: str, prompts: list[str]) -> None:
+    full_regex = re.compile(pattern, re.IGNORECASE)
+    prefiltered = PrefilteredRegex(pattern)
+    for prompt in prompts:
+        expected = full_regex.search(prompt)
+        result = prefiltered.search(prompt)
+        assert (result is None) == (expected is None), f"{pattern!r} on {prompt!r}"
+        if expected is not None:
+            assert result.span() == expected.span(), f"{pattern!r} on {prompt!r}"
+
+
+def test_literal_alternatives_are_gated() -> None:
+    prefiltered = PrefilteredRegex(r"kitten|puppies?|\d+")
+    assert prefiltered.literals is not None
+    assert prefiltered.residual.pattern == r"\d+"
+
+
+@pytest.mark.parametrize(
+    "pattern",
+    ["(?x) foo bar | baz qux ", "(?s)foo.bar|baz", "(?V1)foo|bar"],
+)
+def test_global_flags_disable_prefilter(pattern: str) -> None:
+    prefiltered = PrefilteredRegex(pattern)
+    assert prefiltered.literals is None
+    assert prefiltered.residual is None
+
+
+@pytest.mark.parametrize(
+    "alternative",
+    ["foo[[:alpha:]]bar", "(?:kitten){e<=1}", "abc[[:digit:]]{2}def", r"\p{L}foo", r"\mfoo\M", r"\L<words>foo", "x(?|(a)|(b))yz"],
+)
+def test_regex_only_syntax_is_not_gated(alternative: str) -> None:
+    assert extract_required_literals(alternative) is None
+
+
+def test_split_alternatives() -> None:
+    assert split_alternatives(r"a|(b|c)|[|]|\||d") == ["a", "(b|c)", "[|]", r"\|", "d"]
+    assert split_alternatives("[]|]|x") == ["[]|]", "x"]
+    # Unbalanced brackets mean we lost track, so we don't split at all
+    assert split_alternatives("[[:alpha:](]|x") == ["[[:alpha:](]|x"]
@@ -0,0 +1,193 @@
+# SPDX-FileCopyrightText: 2022 Konstantinos Thoukydidis <mail@dbzer0.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+from types import SimpleNamespace
+
+import pytest
+
+from horde.database.classes import WorkerCapabilityIndex
+from horde.model_reference import model_reference
+from tests.unit.factories import build_dict, build_namespace
+
+LATEST_REGEN = "AI Horde Worker reGen:9.0.0:https://github.com/Haidra-Org/horde-worker-reGen"
+OLD_REGEN = "AI Horde Worker reGen:4.1.0:https://github.com/Haidra-Org/horde-worker-reGen"
+OLD_WORKER = "AI Horde Worker:11:https://github.com/db0/AI-Horde-Worker"
+ALL_FEATURES = (1 << 12) - 1
+MODEL_REFERENCE = {
+    "sd_model": {"baseline": "stable diffusion 1"},
+    "sd_inpainting": {"baseline": "stable diffusion 1", "inpainting": True},
+    "flux_model": {"baseline": "flux_1"},
+    "sdxl_model": {"baseline": "stable_diffusion_xl"},
+    "cascade_model": {"baseline": "stable_cascade"},
+}
+SUMMARIZED_WORKER = {
+    "id": "11111111-1111-1111-1111-111111111111",
+    "user_id": 1,
+    "trusted": False,
+    "owner_only": False,
+    "capabilities": 0,
+    "features": ALL_FEATURES,
+    "limits": [1024 * 1024],
+    "models": ["sd_model"],
+    "bridge_agent": LATEST_REGEN,
+    "softprompts": [],
+    "needs_db_check": False,
+}
+IMAGE_REQUIREMENTS = {
+    "required": 0,
+    "limits": [512 * 512],
+    "models": ["sd_model"],
+    "workers": [],
+    "worker_blacklist": False,
+    "trusted_workers": False,
+    "user_id": 2,
+    "tricked_workers": [],
+    "features": WorkerCapabilityIndex.IMAGE_SUPPORTED_MODELS | WorkerCapabilityIndex.IMAGE_NOT_ONLY_INPAINTING,
+    "sampler": ["k_euler_a", True],
+    "post_processors": [],
+    "untrusted_workers": True,
+}
+IMAGE_WORKER = {
+    "bridge_agent": LATEST_REGEN,
+    "allow_img2img": True,
+    "allow_painting": True,
+    "allow_post_processing": True,
+    "allow_controlnet": True,
+    "allow_sdxl_controlnet": True,
+}
+
+
+def summarized_worker(**kwargs) -> dict:
+    return build_dict(SUMMARIZED_WORKER, **kwargs)
+
+
+def image_requirements(**kwargs) -> dict:
+    return build_dict(IMAGE_REQUIREMENTS, **kwargs)
+
+
+def image_worker(**kwargs) -> SimpleNamespace:
+    return build_namespace(IMAGE_WORKER, **kwargs)
+
+
+@pytest.fixture
+def known_models(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(model_reference, "reference", MODEL_REFERENCE)
+
+
+def test_matching_worker_is_valid() -> None:
+    index = WorkerCapabilityIndex([summarized_worker()])
+    assert index.has_valid_worker(image_requirements()) is True
+
+
+@pytest.mark.parametrize(
+    "requirements",
+    [
+        {"models": ["other_model"]},
+        {"limits": [2048 * 2048]},
+        {"required": 1},
+        {"features": WorkerCapabilityIndex.IMAGE_SUPPORTED_MODELS | WorkerCapabilityIndex.IMAGE_TILING},
+        {"trusted_workers": True},
+        {"untrusted_workers": False},
+        {"workers": ["22222222-2222-2222-2222-222222222222"]},
+        {"workers": ["11111111-1111-1111-1111-111111111111"], "worker_blacklist": True},
+        {"tricked_workers": ["11111111-1111-1111-1111-111111111111"]},
+    ],
+)
+def test_worker_not_meeting_requirements_is_invalid(requirements: dict) -> None:
+    index = WorkerCapabilityIndex([summarized_worker(features=WorkerCapabilityIndex.IMAGE_SUPPORTED_MODELS | 8)])
+    assert index.has_valid_worker(image_requirements(**requirements)) is False
+
+
+def test_bridge_samplers_and_post_processors_are_checked() -> None:
+    index = WorkerCapabilityIndex([summarized_worker(bridge_agent=OLD_WORKER)])
+    assert index.has_valid_worker(image_requirements(sampler=["k_euler", True])) is True
+    assert index.has_valid_worker(image_requirements(sampler=["lcm", False])) is False
+    assert index.has_valid_worker(image_requirements(post_processors=["GFPGAN"])) is True
+    assert index.has_valid_worker(image_requirements(post_processors=["strip_background"])) is False
+
+
+def test_owner_only_workers_serve_their_owner() -> None:
+    index = WorkerCapabilityIndex([summarized_worker(owner_only=True)])
+    assert index.has_valid_worker(image_requirements()) is False
+    assert index.has_valid_worker(image_requirements(user_id=1)) is True
+
+
+def test_unsummarized_workers_need_the_db() -> None:
+    index = WorkerCapabilityIndex([summarized_worker(needs_db_check=True)])
+    assert index.has_valid_worker(image_requirements()) is None
+    assert index.has_valid_worker(image_requirements(models=["other_model"])) is False
+    index = WorkerCapabilityIndex(
+        [summarized_worker(needs_db_check=True), summarized_worker(id="22222222-2222-2222-2222-222222222222")],
+    )
+    assert index.has_valid_worker(image_requirements()) is True
+
+
+def test_softprompts_are_checked() -> None:
+    index = WorkerCapabilityIndex([summarized_worker(features=0, softprompts=["a_softprompt"])])
+    text_requirements = {
+        "required": 0,
+        "limits": [80, 1024],
+        "models": [],
+        "workers": [],
+        "worker_blacklist": False,
+        "trusted_workers": False,
+        "user_id": 2,
+        "tricked_workers": [],
+        "softprompt": "a_softprompt",
+    }
+    assert index.has_valid_worker(text_requirements) is True
+    assert index.has_valid_worker({**text_requirements, "softprompt": ""}) is True
+    assert index.has_valid_worker({**text_requirements, "softprompt": "other_softprompt"}) is False
+
+
+@pytest.mark.usefixtures("known_models")
+def test_worker_features_follow_can_generate() -> None:
+    features = WorkerCapabilityIndex.get_worker_features("image", image_worker(), ["sd_model"])
+    assert features == ALL_FEATURES & ~WorkerCapabilityIndex.IMAGE_INPAINTING
+    features = WorkerCapabilityIndex.get_worker_features("image", image_worker(), ["sd_model", "sd_inpainting"])
+    assert features == ALL_FEATURES
+    features = WorkerCapabilityIndex.get_worker_features("image", image_worker(), ["sd_inpainting"])
+    assert not features & WorkerCapabilityIndex.IMAGE_NOT_ONLY_INPAINTING
+    features = WorkerCapabilityIndex.get_worker_features("image", image_worker(bridge_agent=OLD_REGEN), ["flux_model"])
+    assert not features & WorkerCapabilityIndex.IMAGE_SUPPORTED_MODELS
+    features = WorkerCapabilityIndex.get_worker_features("image", image_worker(allow_sdxl_controlnet=False), ["sdxl_model"])
+    assert not features & WorkerCapabilityIndex.IMAGE_QR_CODE
+    features = WorkerCapabilityIndex.get_worker_features("image", image_worker(bridge_agent=OLD_REGEN), ["cascade_model"])
+    assert not features & WorkerCapabilityIndex.IMAGE_HIRES_FIX
+    features = WorkerCapabilityIndex.get_worker_features("image", image_worker(bridge_agent=OLD_WORKER), ["sd_model"])
+    assert not features & (WorkerCapabilityIndex.IMAGE_TILING | WorkerCapabilityIndex.IMAGE_CLIP_SKIP)
+    assert WorkerCapabilityIndex.get_worker_features("text", image_worker(), ["sd_model"]) == 0
+
+
+def test_image_wp_requirements_follow_can_generate() -> None:
+    wp = SimpleNamespace(
+        params={"hires_fix": True, "clip_skip": 2, "loras": [{"name": "123", "is_version": True}]},
+        gen_payload={"sampler_name": "k_dpmpp_sde", "karras": False, "post_processing": ["GFPGAN", "strip_background"]},
+        source_image="https://example.com/source.webp",
+        source_processing="inpainting",
+        safe_ip=False,
+        user=SimpleNamespace(trusted=False),
+    )
+    requirements = WorkerCapabilityIndex.get_image_wp_requirements(wp)
+    assert requirements["features"] == (
+        WorkerCapabilityIndex.IMAGE_SUPPORTED_MODELS
+        | WorkerCapabilityIndex.IMAGE_IMG2IMG
+        | WorkerCapabilityIndex.IMAGE_INPAINTING
+        | WorkerCapabilityIndex.IMAGE_POST_PROCESSING
+        | WorkerCapabilityIndex.IMAGE_HIRES_FIX
+        | WorkerCapabilityIndex.IMAGE_CLIP_SKIP
+        | WorkerCapabilityIndex.IMAGE_LORA_VERSIONS
+    )
+    assert requirements["sampler"] == ["k_dpmpp_sde", False]
+    assert requirements["post_processors"] == ["GFPGAN", "strip_background"]
+    assert requirements["untrusted_workers"] is False
+
+
+@pytest.mark.usefixtures("known_models")
+def test_inpainting_only_workers_skip_txt2img() -> None:
+    features = WorkerCapabilityIndex.get_worker_features("image", image_worker(), ["sd_inpainting"])
+    index = WorkerCapabilityIndex([summarized_worker(features=features, models=["sd_inpainting"])])
+    assert index.has_valid_worker(image_requirements(models=["sd_inpainting"])) is False
+    inpainting_features = WorkerCapabilityIndex.IMAGE_SUPPORTED_MODELS | WorkerCapabilityIndex.IMAGE_INPAINTING
+    assert index.has_valid_worker(image_requirements(models=["sd_inpainting"], features=inpainting_features)) is True